@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the time sdw-launcher.py takes from invocation until the
+SecureDrop Client is launched.
+
+Each run starts the launcher in a new Python process, with a fixture status
+record that lets it launch the client directly, and a stub `qvm-run` on the
+PATH. Phase durations are read from the "Launch timing" line the launcher
+writes to its log, and reported as percentiles across all runs.
+
+Usage: python3 benchmarks/bench_launcher.py [--runs N]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+LAUNCHER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAUNCHER_PATH = os.path.join(LAUNCHER_DIR, "sdw-launcher.py")
+
+# Matches the phase durations in the launcher's "Launch timing" log line
+PHASE_DURATION = re.compile(r"(\w+)=([0-9.]+)s")
+
+PERCENTILES = [50, 90, 99]
+
+# Runs the launcher in the child process. The lock directory is redirected,
+# as /run/user/<uid> may not exist outside of a desktop session.
+CHILD_SCRIPT = """
+import sys
+from importlib.machinery import SourceFileLoader
+
+sys.path.insert(0, {launcher_dir!r})
+launcher = SourceFileLoader("sdw_launcher", {launcher_path!r}).load_module()
+launcher.Util.LOCK_DIRECTORY = {lock_dir!r}
+launcher.main([])
+"""
+
+
+def write_fixtures(home):
+    """
+    Creates a status record indicating that updates were applied just now,
+    and a stub qvm-run. Returns the directory containing the stub.
+    """
+    status_dir = os.path.join(home, ".securedrop_launcher")
+    os.makedirs(status_dir)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open(os.path.join(status_dir, "sdw-status.json"), "w") as f:
+        json.dump({"version": 1, "status": "0", "last_status_update": now}, f)
+
+    bin_dir = os.path.join(home, "bin")
+    os.makedirs(bin_dir)
+    qvm_run = os.path.join(bin_dir, "qvm-run")
+    with open(qvm_run, "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(qvm_run, 0o755)
+    return bin_dir
+
+
+def run_once(home, bin_dir):
+    """
+    Runs the launcher once, returning its phase durations
+    """
+    env = dict(os.environ, HOME=home, PATH=bin_dir + os.pathsep + os.environ["PATH"])
+    script = CHILD_SCRIPT.format(
+        launcher_dir=LAUNCHER_DIR, launcher_path=LAUNCHER_PATH, lock_dir=home
+    )
+    subprocess.check_call([sys.executable, "-c", script], env=env)
+
+    log_file = os.path.join(home, ".securedrop_launcher", "logs", "launcher.log")
+    with open(log_file) as f:
+        timing_lines = [line for line in f if "Launch timing:" in line]
+    return {phase: float(seconds) for phase, seconds in PHASE_DURATION.findall(timing_lines[-1])}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20, help="Number of launcher runs")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as home:
+        bin_dir = write_fixtures(home)
+        results = [run_once(home, bin_dir) for _ in range(args.runs)]
+
+    print("Launcher timing over {} runs (milliseconds)".format(args.runs))
+    header = ["{:>10}".format("p{}".format(p)) for p in PERCENTILES]
+    print("{:<14}".format("phase") + "".join(header))
+    for phase in results[0]:
+        durations = [result[phase] * 1000 for result in results]
+        columns = ["{:>10.1f}".format(percentile(durations, p)) for p in PERCENTILES]
+        print("{:<14}".format(phase) + "".join(columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,16 @@
 #!/usr/bin/env python3
-from sdw_updater_gui.UpdaterApp import UpdaterApp
-from sdw_util import Util
-from sdw_updater_gui import Updater
-from sdw_updater_gui.UpdaterApp import launch_securedrop_client
-from sdw_updater_gui.Updater import should_launch_updater
-import logging
-import sys
-import argparse
-
-if Util.get_qt_version() == 5:
-    print("Using Qt5 (experimental)")
-    from PyQt5.QtWidgets import QApplication
-else:
-    from PyQt4.QtGui import QApplication
+import time
+
+# Taken before all other imports, so that they are included in the launch
+# timing logged by main()
+START_TIME = time.monotonic()
+
+from sdw_util import Util  # noqa: E402
+from sdw_updater_gui import Updater  # noqa: E402
+from sdw_updater_gui.Updater import launch_securedrop_client, should_launch_updater  # noqa: E402
+import logging  # noqa: E402
+import sys  # noqa: E402
+import argparse  # noqa: E402
 
 
 DEFAULT_INTERVAL = 28800  # 8hr default for update interval
@@ -21,13 +19,26 @@ DEFAULT_INTERVAL = 28800  # 8hr default for update interval
 def parse_argv(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("--skip-delta", type=int)
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Download TemplateVM updates in the background, without installing them",
+    )
     return parser.parse_args(argv)
 
 
 def launch_updater():
     """
-    Start the updater GUI
+    Start the updater GUI. Qt is only imported here, as importing it makes up
+    most of the launcher's start-up time when the client is launched directly.
     """
+    from sdw_updater_gui.UpdaterApp import UpdaterApp
+
+    if Util.get_qt_version() == 5:
+        print("Using Qt5 (experimental)")
+        from PyQt5.QtWidgets import QApplication
+    else:
+        from PyQt4.QtGui import QApplication
 
     app = QApplication(sys.argv)
     form = UpdaterApp()
@@ -35,17 +46,51 @@ def launch_updater():
     sys.exit(app.exec_())
 
 
-def main(argv):
+def prefetch_updates():
+    """
+    Download pending TemplateVM updates, unless the launcher is running
+    """
+    sdlog = logging.getLogger(__name__)
+    if not Util.can_obtain_lock(Updater.LOCK_FILE):
+        sdlog.info("SecureDrop Launcher is running, not pre-fetching updates")
+        sys.exit(0)
+    lock_handle = Util.obtain_lock(Updater.PREFETCH_LOCK_FILE)
+    if lock_handle is None:
+        # Pre-fetch already running or problems accessing lockfile.
+        # Logged.
+        sys.exit(1)
+
+    if not Updater.prefetch_updates():
+        sys.exit(1)
+
+
+def main(argv, timer=None):
+    """
+    Launches the updater or the SecureDrop Client. The duration of each phase
+    until the client is launched or the updater is shown is logged; `timer`
+    is a Util.PhaseTimer started when the launcher was invoked.
+    """
+    if timer is None:
+        timer = Util.PhaseTimer(START_TIME)
+    timer.mark("imports")
+
     sdlog = logging.getLogger(__name__)
-    Util.configure_logging(Updater.LOG_FILE)
+    Util.configure_logging(Updater.LOG_FILE, use_queue=True)
+    timer.mark("logging")
+
+    args = parse_argv(argv)
+
+    if args.prefetch:
+        prefetch_updates()
+        return
+
     lock_handle = Util.obtain_lock(Updater.LOCK_FILE)
     if lock_handle is None:
         # Preflight updater already running or problems accessing lockfile.
         # Logged.
         sys.exit(1)
     sdlog.info("Starting SecureDrop Launcher")
-
-    args = parse_argv(argv)
+    timer.mark("lock")
 
     try:
         args.skip_delta
@@ -57,10 +102,22 @@ def main(argv):
 
     interval = int(args.skip_delta)
 
+    # Read separately from the decision below for timing; the status record
+    # is cached, so should_launch_updater() does not read it again.
+    Util.read_status()
+    timer.mark("status")
+
     if should_launch_updater(interval):
+        timer.mark("decision")
+        sdlog.info("Launch timing: {}".format(timer.summary()))
         launch_updater()
     else:
-        launch_securedrop_client()
+        timer.mark("decision")
+        try:
+            launch_securedrop_client()
+        finally:
+            timer.mark("client_spawn")
+            sdlog.info("Launch timing: {}".format(timer.summary()))
 
 
 if __name__ == "__main__":
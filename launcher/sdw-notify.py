@@ -3,50 +3,86 @@
 Displays a warning to the user if the workstation has been running continuously
 for too long without checking for security updates. Writes output to a logfile,
 not stdout. All settings are in Notify utility module.
+
+With --daemon, stays resident and only wakes up when a warning could be due,
+rather than checking once and exiting.
 """
 
+import argparse
 import sys
 
-from sdw_notify import Notify
-from sdw_updater_gui import Updater
-from sdw_util import Util
+from sdw_util import Lock
+
+# The QApplication, created when the first warning is shown
+app = None
 
-if Util.get_qt_version() == 5:
-    print("Using Qt5 (experimental)")
-    from PyQt5.QtWidgets import QApplication, QMessageBox
-else:
-    from PyQt4.QtGui import QApplication, QMessageBox
+
+def parse_argv(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=False,
+        help="Keep running, and show the warning whenever it becomes due",
+    )
+    return parser.parse_args(argv)
 
 
-def main():
+def main(argv):
     """
     Show security warning, if and only if a warning is not already displayed,
     the preflight updater is running, and certain checks suggest that the
     system has not been updated for a specified period
     """
+    args = parse_argv(argv)
 
-    Util.configure_logging(Notify.LOG_FILE)
+    # The daemon is restarted periodically, and is usually still running. Check
+    # for that before anything else is imported, and exit without logging.
+    if args.daemon and Lock.is_lock_held(Lock.NOTIFY_LOCK_FILE):
+        sys.exit(0)
 
-    if Util.is_conflicting_process_running(Notify.CONFLICTING_PROCESSES):
-        # Conflicting system process may be running in dom0. Logged.
-        sys.exit(1)
+    from sdw_notify import Notify
+    from sdw_util import Util
 
-    if Util.can_obtain_lock(Updater.LOCK_FILE) is False:
-        # Preflight updater is already running. Logged.
-        sys.exit(1)
+    Util.configure_logging(Notify.LOG_FILE, use_queue=True)
 
-    # Hold on to lock handle during execution
-    lock_handle = Util.obtain_lock(Notify.LOCK_FILE)
+    # Hold on to lock handle during execution. If the daemon has started since
+    # the check above, this is expected.
+    lock_handle = Util.obtain_lock(Notify.LOCK_FILE, quiet=args.daemon)  # noqa: F841
     if lock_handle is None:
         # Can't write to lockfile or notifier already running. Logged.
         sys.exit(1)
 
+    if args.daemon:
+        Notify.run_daemon(check_for_updates)
+
+    if check_for_updates() is None:
+        sys.exit(1)
+
+
+def check_for_updates():
+    """
+    Shows the security warning if it is due. Returns True if it was shown,
+    False if it was not due, and None if the check could not be performed.
+    """
+    from sdw_notify import Notify
+    from sdw_util import Util
+
+    if Util.is_conflicting_process_running(Notify.CONFLICTING_PROCESSES):
+        # Conflicting system process may be running in dom0. Logged.
+        return None
+
+    if Util.can_obtain_lock(Lock.LAUNCHER_LOCK_FILE) is False:
+        # Preflight updater is already running. Logged.
+        return None
+
     warning_should_be_shown = Notify.is_update_check_necessary()
     if warning_should_be_shown is None:
         # Data integrity issue with update timestamp. Logged.
-        sys.exit(1)
+        return None
     elif warning_should_be_shown is True:
         show_update_warning()
+    return warning_should_be_shown
 
 
 def show_update_warning():
@@ -54,7 +90,19 @@ def show_update_warning():
     Show a graphical warning reminding the user to check for security updates
     using the preflight updater.
     """
-    app = QApplication([])  # noqa: F841
+    global app
+
+    from sdw_util import Util
+
+    # Qt is only imported once a warning is due, so the daemon does not load
+    # it while sleeping
+    if Util.get_qt_version() == 5:
+        from PyQt5.QtWidgets import QApplication, QMessageBox
+    else:
+        from PyQt4.QtGui import QApplication, QMessageBox
+
+    if app is None:
+        app = QApplication([])
 
     QMessageBox.warning(
         None,
@@ -68,4 +116,4 @@ def show_update_warning():
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
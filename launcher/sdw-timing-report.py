@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Summarizes the durations of update phases and per-VM updates recorded by the
+preflight updater across runs, to find which phase or VM takes the most time.
+"""
+import argparse
+import sys
+
+from sdw_util import Util
+
+
+def parse_argv(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--runs", type=int, help="Only include the given number of most recent update runs"
+    )
+    return parser.parse_args(argv)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(records):
+    """
+    Returns a list of (type, name, count, median, p90, maximum) tuples, one for
+    each phase, VM and the total run duration, ordered by type and by the
+    time they took in total.
+    """
+    durations = {}
+    for record in records:
+        durations.setdefault((record["type"], record["name"]), []).append(record["duration"])
+
+    type_order = ["run", "phase", "vm"]
+    rows = sorted(
+        durations.items(),
+        key=lambda item: (type_order.index(item[0][0]), -sum(item[1]), item[0][1]),
+    )
+    return [
+        (kind, name, len(values), percentile(values, 50), percentile(values, 90), max(values))
+        for (kind, name), values in rows
+    ]
+
+
+def main(argv):
+    args = parse_argv(argv)
+    records = [
+        record
+        for record in Util.read_timing_records()
+        if record.get("type") in ("run", "phase", "vm")
+    ]
+    if not records:
+        print("No update timing has been recorded yet.")
+        return
+
+    runs = sorted(set(record["run"] for record in records))
+    if args.runs is not None:
+        first_run = max(len(runs) - args.runs, 0)
+        runs = runs[first_run:]
+        records = [record for record in records if record["run"] in runs]
+
+    print("Update timing over {} runs (seconds)".format(len(runs)))
+    print("{:<6}{:<28}{:>6}{:>10}{:>10}{:>10}".format("type", "name", "runs", "p50", "p90", "max"))
+    for row in summarize(records):
+        print("{:<6}{:<28}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}".format(*row))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,31 +2,35 @@
 Utility library for warning the user that security updates have not been applied
 in some time.
 """
+import ctypes
 import logging
 import os
+import select
+import struct
+import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-sdlog = logging.getLogger(__name__)
+from sdw_util import Lock, Util
 
-# The directory where status files and logs are stored
-BASE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".securedrop_launcher")
+sdlog = logging.getLogger(__name__)
 
-# The file and format that contains the timestamp of the last successful update
-LAST_UPDATED_FILE = os.path.join(BASE_DIRECTORY, "sdw-last-updated")
+# The format of the timestamp of the last successful update, which is stored
+# in the status record (see sdw_util)
 LAST_UPDATED_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 # The lockfile basename used to ensure this script can only be executed once.
 # Default path for lockfiles is specified in sdw_util
-LOCK_FILE = "sdw-notify.lock"
+LOCK_FILE = Lock.NOTIFY_LOCK_FILE
 
 # Log file name, base directories defined in sdw_util
 LOG_FILE = "sdw-notify.log"
 
-# Process names that should not be running while this script runs. We do not
+# Processes that should not be running while this script runs. We do not
 # want to encourage running the updater during provisioning or system updates.
-# Caution is advised in expanding this list; a more precise detection method
-# is generally preferable.
+# Caution is advised in expanding this list; processes are matched by their
+# exact name, and a pattern for their command line can be given to match them
+# more precisely (see Util.is_conflicting_process_running).
 CONFLICTING_PROCESSES = ["qubesctl", "make"]
 
 # The maximum uptime this script should permit (specified in seconds) before
@@ -38,6 +42,29 @@ UPTIME_GRACE_PERIOD = 1800  # 30 minutes
 # should permit before showing a warning to the user
 WARNING_THRESHOLD = 432000  # 5 days
 
+# The time (specified in seconds) after which the daemon shows a warning again
+# if it is still due, or retries a check that could not be performed. Also the
+# longest time it sleeps if the kernel cannot wake it at a given time of day.
+WARNING_REPEAT_INTERVAL = 3600  # 1 hour
+
+# inotify(7) and timerfd_create(2) constants, which are not exposed by the
+# standard library
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_EVENT_HEADER = struct.Struct("iIII")
+CLOCK_REALTIME = 0
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", Timespec), ("it_value", Timespec)]
+
 
 def is_update_check_necessary():
     """
@@ -45,22 +72,20 @@ def is_update_check_necessary():
     shown to the user, reminding them to check for available software updates
     using the preflight updater.
     """
-    last_updated_file_exists = os.path.exists(LAST_UPDATED_FILE)
+    last_update_time = Util.read_status().get("last_updated")
     # For consistent logging
     grace_period_hours = UPTIME_GRACE_PERIOD / 60 / 60
     warning_threshold_hours = WARNING_THRESHOLD / 60 / 60
 
     # Get timestamp from last update (if it exists)
-    if last_updated_file_exists:
-        with open(LAST_UPDATED_FILE, "r") as f:
-            last_update_time = f.readline().splitlines()[0]
+    if last_update_time is not None:
         try:
             last_update_time = datetime.strptime(last_update_time, LAST_UPDATED_FORMAT)
-        except ValueError:
+        except (TypeError, ValueError):
             sdlog.error(
                 "Data in {} not in the expected format. "
                 "Expecting a timestamp in format '{}'. "
-                "Showing security warning.".format(LAST_UPDATED_FILE, LAST_UPDATED_FORMAT)
+                "Showing security warning.".format(Util.STATUS_FILE, LAST_UPDATED_FORMAT)
             )
             return True
 
@@ -71,10 +96,10 @@ def is_update_check_necessary():
     uptime_seconds = get_uptime_seconds()
     uptime_hours = uptime_seconds / 60 / 60
 
-    if not last_updated_file_exists:
+    if last_update_time is None:
         sdlog.warning(
-            "Timestamp file '{}' does not exist. "
-            "Updater may never have run. Showing security warning.".format(LAST_UPDATED_FILE)
+            "Timestamp of last successful update not found in '{}'. "
+            "Updater may never have run. Showing security warning.".format(Util.STATUS_FILE)
         )
         return True
     else:
@@ -119,3 +144,164 @@ def get_uptime_seconds():
     with open("/proc/uptime", "r") as f:
         uptime_seconds = float(f.readline().split()[0])
     return uptime_seconds
+
+
+def get_warning_deadline(
+    last_updated, boot_time, warning_threshold=WARNING_THRESHOLD, grace_period=UPTIME_GRACE_PERIOD
+):
+    """
+    Returns the time (as a datetime) at which a security warning becomes due,
+    given the times of the last successful update and of the last boot: once
+    the warning threshold has passed since the update, but not before the
+    uptime grace period has elapsed.
+    """
+    return max(
+        last_updated + timedelta(seconds=warning_threshold),
+        boot_time + timedelta(seconds=grace_period),
+    )
+
+
+def get_boot_time():
+    """
+    Returns the time of the last boot, as a datetime. /proc/uptime is based on
+    CLOCK_BOOTTIME, which includes time spent in suspend, so this stays put
+    across a suspend and resume, like the real-time clock that the warning
+    deadline is waited for on.
+    """
+    return datetime.now() - timedelta(seconds=get_uptime_seconds())
+
+
+def get_next_warning_time():
+    """
+    Returns the time at which a security warning becomes due, based on the
+    status record. If the timestamp of the last successful update is missing
+    or invalid, the warning is due now, which is logged by
+    is_update_check_necessary().
+    """
+    last_update_time = Util.read_status().get("last_updated")
+    try:
+        last_update_time = datetime.strptime(last_update_time, LAST_UPDATED_FORMAT)
+    except (TypeError, ValueError):
+        return datetime.now()
+    return get_warning_deadline(last_update_time, get_boot_time())
+
+
+class StatusFileWatcher(object):
+    """
+    Waits until a given time, or until the status record is written. Uses
+    inotify to watch the directory of the status record, since it is replaced
+    atomically on every write, and a timerfd on the real-time clock, so that
+    time spent in suspend counts towards the wait. If either is unavailable,
+    waits for at most WARNING_REPEAT_INTERVAL seconds at a time instead.
+    """
+
+    def __init__(self, path=None):
+        path = path or Util.STATUS_FILE
+        self.name = os.fsencode(os.path.basename(path))
+        self.fd = None
+        self.timer_fd = None
+
+        directory = os.path.dirname(path)
+        fds = []
+        try:
+            os.makedirs(directory, exist_ok=True)
+            libc = ctypes.CDLL(None, use_errno=True)
+            fds.append(self._check(libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)))
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE
+            self._check(libc.inotify_add_watch(fds[0], os.fsencode(directory), mask))
+            flags = os.O_NONBLOCK | os.O_CLOEXEC
+            fds.append(self._check(libc.timerfd_create(CLOCK_REALTIME, flags)))
+        except (AttributeError, OSError) as e:
+            for fd in fds:
+                os.close(fd)
+            sdlog.error(
+                "Could not watch {} for changes, checking every {} seconds instead: "
+                "{}".format(path, WARNING_REPEAT_INTERVAL, e)
+            )
+            return
+        self.libc = libc
+        self.fd, self.timer_fd = fds
+
+    def _check(self, result):
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def wait(self, deadline):
+        """
+        Blocks until the status record has been written or the given time (a
+        datetime) has been reached. Returns True if the status record was
+        written. Also returns early if the system clock is changed.
+        """
+        if self.fd is None:
+            remaining = (deadline - datetime.now()).total_seconds()
+            time.sleep(max(0, min(remaining, WARNING_REPEAT_INTERVAL)))
+            return False
+
+        # A timer set to the epoch would be disarmed, so round up
+        timestamp = max(deadline.timestamp(), 1)
+        spec = Itimerspec()
+        spec.it_value.tv_sec = int(timestamp)
+        spec.it_value.tv_nsec = int((timestamp % 1) * 1e9)
+        flags = TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET
+        self._check(self.libc.timerfd_settime(self.timer_fd, flags, ctypes.byref(spec), None))
+
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.timer_fd, select.POLLIN)
+        while True:
+            ready = [fd for fd, _ in poller.poll()]
+            if self.fd in ready and self.status_file_changed(os.read(self.fd, 4096)):
+                return True
+            if self.timer_fd in ready:
+                # Reading fails with ECANCELED if the clock was changed
+                try:
+                    os.read(self.timer_fd, 8)
+                except OSError:
+                    pass
+                return False
+
+    def status_file_changed(self, data):
+        """
+        Returns True if any of the inotify events in the given buffer concerns
+        the status record, rather than another file in its directory.
+        """
+        offset = 0
+        while offset + IN_EVENT_HEADER.size <= len(data):
+            _, _, _, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            start = offset + IN_EVENT_HEADER.size
+            offset = start + length
+            name = data[start:offset].rstrip(b"\0")
+            if name == self.name:
+                return True
+        return False
+
+    def close(self):
+        for fd in (self.fd, self.timer_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = None
+        self.timer_fd = None
+
+
+def run_daemon(check, watcher=None):
+    """
+    Runs the given check when a security warning becomes due, and sleeps until
+    then. The deadline is recalculated whenever the status record is written,
+    e.g. by a successful update. While a warning remains due, the check is
+    repeated every WARNING_REPEAT_INTERVAL seconds. Does not return.
+    """
+    watcher = watcher or StatusFileWatcher()
+    while True:
+        deadline = get_next_warning_time()
+        if deadline <= datetime.now():
+            check()
+            deadline = datetime.now() + timedelta(seconds=WARNING_REPEAT_INTERVAL)
+        else:
+            sdlog.info(
+                "Next check for security updates at {}".format(
+                    deadline.strftime(LAST_UPDATED_FORMAT)
+                )
+            )
+        watcher.wait(deadline)
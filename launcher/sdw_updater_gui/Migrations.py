@@ -0,0 +1,97 @@
+"""
+Rules that determine whether the entire Salt configuration must be reapplied
+as part of an update ("migration"), e.g. after VMs have been renamed or moved
+to other templates. This adds about ~20m to an update, so we only do it when
+one of these rules applies.
+
+Each rule is evaluated against the same snapshot of the domain list, as
+returned by get_domains(). To add a rule, define a function that takes that
+snapshot and returns the names of the VMs that require a migration, and
+register it with the @migration_rule decorator.
+
+Reading a VM property other than its name and class costs a call to qubesd
+per VM, so domains only include the properties that rules use.
+"""
+import re
+import subprocess
+from collections import namedtuple
+
+SDW_DEFAULT_TAG = "sd-workstation"
+
+# A VM in a snapshot of the domain list
+Domain = namedtuple("Domain", ["name", "klass", "tags"])
+
+# A rule that applies, and the VMs that it applies to
+MigrationReason = namedtuple("MigrationReason", ["name", "vms"])
+
+# Name of the reason given when the rules could not be evaluated, in which
+# case a migration must be assumed to be required
+CHECK_FAILED = "migration-check-failed"
+
+MIGRATION_RULES = []
+
+
+def migration_rule(name):
+    """
+    Registers the decorated function as the migration rule with the given
+    name, which identifies it in logs.
+    """
+
+    def register(check):
+        MIGRATION_RULES.append((name, check))
+        return check
+
+    return register
+
+
+def get_domains(app=None):
+    """
+    Returns a snapshot of the domain list, as a list of Domains, via the given
+    Qubes Admin API connection, or via qvm-ls if none is given.
+    """
+    if app is not None:
+        domains = []
+        for vm in app.domains:
+            if vm.name == "dom0":
+                continue
+            domains.append(Domain(vm.name, vm.klass, set(vm.tags)))
+        return domains
+
+    output = subprocess.check_output(
+        ["qvm-ls", "--raw-data", "--fields", "NAME,CLASS,TAGS"], universal_newlines=True
+    )
+    domains = []
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or fields[0] == "dom0":
+            continue
+        name, klass, tags = fields
+        domains.append(Domain(name, klass, set(tag for tag in tags.split(",") if tag)))
+    return domains
+
+
+def get_migration_reasons(domains):
+    """
+    Evaluates all migration rules against the given snapshot of the domain
+    list, and returns a list of MigrationReasons for the rules that apply.
+    """
+    reasons = []
+    for name, check in MIGRATION_RULES:
+        vms = sorted(check(domains))
+        if vms:
+            reasons.append(MigrationReason(name, vms))
+    return reasons
+
+
+# Template consolidation. If old template names are found, then we must rerun
+# the full states to re-apply.
+OLD_TEMPLATE_NAME = re.compile(r"sd-(?!small|large).*-template")
+
+
+@migration_rule("template-consolidation")
+def _get_unconsolidated_templates(domains):
+    return [
+        domain.name
+        for domain in domains
+        if SDW_DEFAULT_TAG in domain.tags and OLD_TEMPLATE_NAME.search(domain.name)
+    ]
@@ -7,28 +7,63 @@ is opened by the user when clicking on the desktop, opening sdw-laucher.py
 from the parent directory.
 """
 
+import glob
+import importlib
 import json
 import logging
 import os
+import re
 import subprocess
+import sys
+import threading
+import time
 from datetime import datetime, timedelta
 from enum import Enum
 
+from sdw_updater_gui import Migrations
+from sdw_util import Lock, Util
+
+# The Qubes Admin API is only available in dom0. Without it, we fall back to
+# the qvm-* command line tools. It is imported by _import_qubesadmin() on first
+# use rather than here, as importing it (and asyncio, which it uses) takes
+# longer than the rest of the launcher's decision whether to run the updater.
+qubesadmin = None
+EventsDispatcher = None
+wait_for_domain_shutdown = None
+_qubesadmin_available = None
+
+
+class QubesException(Exception):
+    """
+    Replaced by qubesadmin's QubesException once qubesadmin is imported, which
+    is the only way it can be raised.
+    """
+
+
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
-DEFAULT_HOME = ".securedrop_launcher"
 FLAG_FILE_STATUS_SD_APP = "/home/user/.securedrop_client/sdw-update-status"
 FLAG_FILE_LAST_UPDATED_SD_APP = "/home/user/.securedrop_client/sdw-last-updated"
-FLAG_FILE_STATUS_DOM0 = os.path.join(DEFAULT_HOME, "sdw-update-status")
-FLAG_FILE_LAST_UPDATED_DOM0 = os.path.join(DEFAULT_HOME, "sdw-last-updated")
-LOCK_FILE = "sdw-launcher.lock"
+# Prefix of the features through which flags are published to sd-app, see
+# _publish_flag_to_sd_app()
+SD_APP_FLAG_FEATURE_PREFIX = "vm-config."
+LOCK_FILE = Lock.LAUNCHER_LOCK_FILE
+PREFETCH_LOCK_FILE = Lock.PREFETCH_LOCK_FILE
+# Maximum time (in seconds) the updater waits for a background pre-fetch of
+# updates to finish. After that, it downloads the remaining updates itself.
+PREFETCH_WAIT_TIMEOUT = 300
 LOG_FILE = "launcher.log"
 
 
-# We use a hardcoded temporary directory path in dom0. As dom0 is not
-# a multi-user environment, we can safely assume that only the Updater is
-# managing that filepath. Later on, we should consider porting the check-migration
-# logic to leverage the Qubes Python API.
-MIGRATION_DIR = "/tmp/sdw-migrations"  # nosec
+# Number of TemplateVMs to update at the same time. Every concurrent update
+# boots a TemplateVM and its management DispVM, so we keep this low to avoid
+# exhausting dom0 memory.
+UPDATE_WORKERS = 2
+
+# Selects how TemplateVM updates are applied, see apply_template_updates():
+# "parallel" runs one qubesctl process per TemplateVM, "batched" runs a single
+# qubesctl process targeting all TemplateVMs.
+UPDATE_ENGINE_ENV = "SDW_UPDATER_ENGINE"
+UPDATE_ENGINES = ["parallel", "batched"]
 
 sdlog = logging.getLogger(__name__)
 
@@ -48,61 +83,252 @@ current_vms = {
 
 current_templates = set([val for key, val in current_vms.items() if key != "dom0"])
 
+# SDW AppVMs that are power cycled after updates, in the order used for shutdown
+# when dependencies between VMs cannot be determined via the Qubes Admin API.
+sdw_vms_in_order = [
+    "sd-app",
+    "sd-proxy",
+    "sd-whonix",
+    "sd-gpg",
+    "sd-log",
+]
+
+# System VMs that can be safely shut down (order should not matter, but will
+# be respected).
+safe_sys_vms_in_order = ["sys-usb", "sys-whonix"]
+
+# System VMs that must be killed instead, because they may be in use as NetVMs
+# by any of the user's other VMs.
+unsafe_sys_vms_in_order = ["sys-firewall", "sys-net"]
+
+# TemplateVMs of the system VMs that are power cycled after updates
+sys_vm_templates = {
+    "sys-usb": current_vms["fedora"],
+    "sys-whonix": current_vms["sd-whonix"],
+    "sys-firewall": current_vms["fedora"],
+    "sys-net": current_vms["fedora"],
+}
+
+# NetVMs of the VMs that are power cycled after updates, used when they cannot
+# be determined via the Qubes Admin API
+default_netvms = {
+    "sd-proxy": "sd-whonix",
+    "sd-whonix": "sys-whonix",
+    "sys-whonix": "sys-firewall",
+    "sys-firewall": "sys-net",
+}
+
+# VM receiving logs from all other SDW VMs, which would start it back up if it
+# were shut down before them.
+LOG_VM = "sd-log"
+
+# Tag applied to all VMs managed by the SecureDrop Workstation
+SDW_DEFAULT_TAG = "sd-workstation"
+
+# Maximum number of VMs to shut down or start at the same time
+POWER_CYCLE_WORKERS = 4
+
+# Selects how VMs are managed: "qubesadmin" uses a single, shared Qubes Admin
+# API connection, "cli" runs the qvm-* command line tools. If unset, the Qubes
+# Admin API is used if available.
+VM_BACKEND_ENV = "SDW_UPDATER_BACKEND"
+
+# Time to wait for a VM to shut down (in seconds), same as qvm-shutdown
+SHUTDOWN_TIMEOUT = 60
+
+# Time (in seconds) for which a dom0 update check that found no updates is
+# reused, instead of fetching repository metadata via the UpdateVM again.
+# Set to 0 to always check for dom0 updates.
+DOM0_UPDATE_CHECK_TTL = 3600
+
+# Local files that change when dom0 repository configuration, repository
+# metadata or installed packages change. A cached dom0 update check is only
+# reused while all of these are unchanged.
+DOM0_UPDATE_CHECK_INPUTS = [
+    "/etc/yum.repos.d/*.repo",
+    "/var/lib/qubes/updates/repodata/repomd.xml",
+    "/var/lib/rpm/Packages",
+    "/var/lib/rpm/rpmdb.sqlite",
+]
+
+# Phases of an update run, in order, as measured by UpgradeThread. If the full
+# configuration must be reapplied, "full_install" replaces "template_updates".
+UPDATE_PHASES = ["dom0_update", "dom0_state", "template_updates", "power_cycle", "status_flags"]
+
+# Expected duration of each phase (in seconds), used to estimate progress
+# until durations have been recorded in the timing log
+DEFAULT_PHASE_DURATIONS = {
+    "dom0_update": 120,
+    "dom0_state": 180,
+    "template_updates": 900,
+    "full_install": 900,
+    "power_cycle": 120,
+    "status_flags": 5,
+}
+
+# Number of most recent durations of a phase or VM from which its expected
+# duration is estimated
+PROGRESS_HISTORY_RUNS = 10
+
+# Progress within a phase that is estimated from time alone, without any VMs
+# completing, is capped at this fraction until the phase ends
+MAX_ESTIMATED_PHASE_PROGRESS = 0.95
+
+_qubes_app = None
+_vm_state_cache = None
+_vm_state_cache_lock = threading.Lock()
+
+# Maps each TemplateVM updated in the current run to whether its update changed
+# any packages. Cleared at the start of each run.
+_template_changes = {}
 
-def get_dom0_path(folder):
-    return os.path.join(os.path.expanduser("~"), folder)
+# Maps each updated VM to the duration of its last update (in seconds)
+_update_durations = {}
 
 
-def run_full_install():
+def _import_qubesadmin():
+    """
+    Imports the Qubes Admin API, if it has not been imported yet. Returns
+    whether it is available.
+    """
+    global qubesadmin, EventsDispatcher, wait_for_domain_shutdown, QubesException
+    global _qubesadmin_available
+    if qubesadmin is not None:
+        return True
+    if _qubesadmin_available is None:
+        try:
+            import qubesadmin
+            from qubesadmin.events import EventsDispatcher
+            from qubesadmin.events.utils import wait_for_domain_shutdown
+            from qubesadmin.exc import QubesException
+        except ImportError:
+            qubesadmin = None
+        _qubesadmin_available = qubesadmin is not None
+    return _qubesadmin_available
+
+
+def _get_qubes_app():
+    """
+    Returns a Qubes Admin API connection, shared by all callers, or None
+    if the Qubes Admin API is not available or the command line tools were
+    selected via SDW_UPDATER_BACKEND.
+    """
+    global _qubes_app
+    if os.getenv(VM_BACKEND_ENV) == "cli":
+        return None
+    if _qubes_app is None and _import_qubesadmin():
+        try:
+            _qubes_app = qubesadmin.Qubes()
+        except Exception as e:
+            sdlog.error("Could not connect to the Qubes Admin API")
+            sdlog.error(str(e))
+    return _qubes_app
+
+
+def _get_vm_state_cache():
+    """
+    Returns a VMStateCache shared by all callers, which is kept up to date by
+    events from the Qubes Admin API, or None if the API is not available or
+    the cache has stopped listening for events.
+    """
+    global _vm_state_cache
+    app = _get_qubes_app()
+    # VMs are power cycled from several threads, which must share one cache
+    with _vm_state_cache_lock:
+        if _vm_state_cache is None and app is not None and qubesadmin is not None:
+            try:
+                _vm_state_cache = VMStateCache(app)
+                _vm_state_cache.start()
+            except Exception as e:
+                sdlog.error("Could not track VM states via the Qubes Admin API")
+                sdlog.error(str(e))
+                _vm_state_cache = None
+        # Once the listener has stopped, cached states may be outdated. It is
+        # not restarted, so callers query VM states directly from then on.
+        if _vm_state_cache is not None and not _vm_state_cache.listening:
+            return None
+        return _vm_state_cache
+
+
+def run_full_install(on_state=None):
     """
     Re-apply the entire Salt config via sdw-admin. Required to enforce
     VM state during major migrations, such as template consolidation.
+
+    If given, on_state is called for each Salt state as it completes (see
+    _run_salt()).
     """
     sdlog.info("Running sdw-admin apply")
     cmd = ["sdw-admin", "--apply"]
-    subprocess.check_call(cmd)
+    _run_salt(cmd, label="sdw-admin", on_state=on_state)
 
-    # Clean up flag requesting migration. Shell out since root created it.
-    subprocess.check_call(["sudo", "rm", "-rf", MIGRATION_DIR])
 
-
-def migration_is_required():
+def get_migration_reasons():
     """
-    Check whether a full run of the Salt config via sdw-admin is required.
+    Check whether a full run of the Salt config via sdw-admin is required, and
+    returns a list of Migrations.MigrationReasons, which is empty if it is not.
+    If the check cannot be run, a full run is required.
+
+    This must be called before the dom0 state is applied, as it may remove
+    the VMs that rules look for. The rules are reloaded first, so that rules
+    installed by a dom0 update apply to the current run.
     """
-    result = False
-    if os.path.exists(MIGRATION_DIR):
-        if len(os.listdir(MIGRATION_DIR)) > 0:
-            sdlog.info("Migration is required, will enforce full config during update")
-            result = True
-    return result
+    try:
+        importlib.reload(Migrations)
+    except Exception as e:
+        sdlog.error("Error reloading migration rules, using the rules loaded at startup")
+        sdlog.error(str(e))
+
+    try:
+        domains = Migrations.get_domains(_get_qubes_app())
+    except (OSError, subprocess.CalledProcessError, QubesException) as e:
+        sdlog.error(
+            "Error listing VMs to check whether migration is required, "
+            "will enforce full config during update"
+        )
+        sdlog.error(str(e))
+        return [Migrations.MigrationReason(Migrations.CHECK_FAILED, [])]
+
+    reasons = Migrations.get_migration_reasons(domains)
+    for reason in reasons:
+        sdlog.info(
+            "Migration is required for {} ({}), will enforce full config during update".format(
+                reason.name, ", ".join(reason.vms)
+            )
+        )
+    return reasons
 
 
-def apply_updates(vms=current_templates, progress_start=15, progress_end=75):
+def apply_updates(
+    vms=current_templates, progress_start=15, progress_end=75, max_workers=1, on_state=None
+):
     """
     Apply updates to all TemplateVMs.
 
     Returns a tuple of (vm_name, percentage_progress, upgrade_results),
     for use in updating the GUI progress bar.
+
+    If max_workers is greater than 1, up to that many TemplateVMs are updated
+    at the same time, and results are returned in order of completion. dom0 is
+    always updated on its own, before any TemplateVMs.
+
+    If given, on_state is called for each Salt state applied to a TemplateVM
+    as it completes (see _run_salt()), possibly from another thread.
     """
     sdlog.info("Applying all updates to VMs: {}".format(vms))
+    _template_changes.clear()
     # Figure out how much each completed VM should bump the progress bar.
     assert progress_end > progress_start
     progress_step = (progress_end - progress_start) // len(vms)
 
     progress_current = progress_start
 
-    for vm in vms:
-        upgrade_results = UpdateStatus.UPDATES_FAILED
-        if vm == "dom0":
-            dom0_status = _check_updates_dom0()
-            if dom0_status == UpdateStatus.UPDATES_REQUIRED:
-                upgrade_results = _apply_updates_dom0()
-            else:
-                upgrade_results = UpdateStatus.UPDATES_OK
-        else:
-            upgrade_results = _apply_updates_vm(vm)
+    if max_workers > 1:
+        completed_updates = _apply_updates_concurrently(vms, max_workers, on_state=on_state)
+    else:
+        completed_updates = ((vm, _apply_updates_to(vm, on_state=on_state)) for vm in vms)
 
+    for vm, upgrade_results in completed_updates:
         progress_current += progress_step
 
         # constrain progress_current to given progress range
@@ -114,6 +340,256 @@ def apply_updates(vms=current_templates, progress_start=15, progress_end=75):
         yield vm, progress_current, upgrade_results
 
 
+def apply_template_updates(progress_start=15, progress_end=75, on_state=None):
+    """
+    Apply updates to all TemplateVMs with the update engine selected via the
+    SDW_UPDATER_ENGINE environment variable (default: "parallel").
+
+    Returns the same generator as apply_updates(). on_state is passed on to
+    apply_updates(); the batched engine only reports results at the end.
+    """
+    engine = os.getenv(UPDATE_ENGINE_ENV, UPDATE_ENGINES[0])
+    if engine not in UPDATE_ENGINES:
+        sdlog.error("Unknown update engine '{}', using {}".format(engine, UPDATE_ENGINES[0]))
+        engine = UPDATE_ENGINES[0]
+
+    if engine == "batched":
+        return apply_updates_batched(
+            progress_start=progress_start,
+            progress_end=progress_end,
+            max_concurrency=UPDATE_WORKERS,
+        )
+    return apply_updates(
+        progress_start=progress_start,
+        progress_end=progress_end,
+        max_workers=UPDATE_WORKERS,
+        on_state=on_state,
+    )
+
+
+def apply_updates_batched(
+    vms=current_templates, progress_start=15, progress_end=75, max_concurrency=UPDATE_WORKERS
+):
+    """
+    Apply updates to all TemplateVMs with a single qubesctl invocation, so that
+    Salt only has to start up once.
+
+    Returns a tuple of (vm_name, percentage_progress, upgrade_results) for each
+    VM, like apply_updates(). Results are only available once all VMs have
+    been updated. dom0 is not supported; use apply_updates() for dom0.
+    """
+    assert "dom0" not in vms
+    assert progress_end > progress_start
+    progress_step = (progress_end - progress_start) // len(vms)
+
+    targets = ",".join(sorted(vms))
+    sdlog.info("Updating {} with a single qubesctl run".format(targets))
+    _template_changes.clear()
+    cmd = [
+        "sudo",
+        "qubesctl",
+        "--show-output",
+        "--skip-dom0",
+        "--targets",
+        targets,
+        "--max-concurrency",
+        str(max_concurrency),
+        "state.sls",
+        "update.qubes-vm",
+        "--out",
+        "json",
+    ]
+    try:
+        process = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        if process.returncode != 0:
+            sdlog.error("qubesctl returned non-zero exit status {}".format(process.returncode))
+            sdlog.error(str(process.stderr))
+        results = _parse_batched_update_output(process.stdout, vms)
+    except OSError as e:
+        sdlog.error("An error has occurred running qubesctl")
+        sdlog.error(str(e))
+        results = {vm: UpdateStatus.UPDATES_FAILED for vm in vms}
+
+    progress_current = progress_start
+    for vm in sorted(vms):
+        if results[vm] == UpdateStatus.UPDATES_OK:
+            sdlog.info("{} update successful".format(vm))
+        else:
+            sdlog.error(
+                "An error has occurred updating {}. Please contact your administrator.".format(vm)
+            )
+        progress_current = min(progress_current + progress_step, progress_end)
+        yield vm, progress_current, results[vm]
+
+
+def prefetch_updates(vms=current_templates, max_concurrency=UPDATE_WORKERS):
+    """
+    Download pending package updates into the package cache of the given
+    TemplateVMs, without installing them, so that a subsequent update does
+    not have to wait for downloads over Tor. Returns True if downloads
+    succeeded for all VMs, False otherwise.
+    """
+    targets = ",".join(sorted(vms))
+    sdlog.info("Pre-fetching updates for {}".format(targets))
+    cmd = [
+        "sudo",
+        "qubesctl",
+        "--skip-dom0",
+        "--targets",
+        targets,
+        "--max-concurrency",
+        str(max_concurrency),
+        "state.sls",
+        "sd-update-prefetch",
+    ]
+    try:
+        subprocess.check_call(cmd)
+    except subprocess.CalledProcessError as e:
+        sdlog.error("An error has occurred pre-fetching updates")
+        sdlog.error(str(e))
+        return False
+
+    sdlog.info("Updates have been pre-fetched for {}".format(targets))
+    return True
+
+
+# Per-target summary line printed by qubesctl, e.g. "fedora-32: OK"
+QUBESCTL_TARGET_STATUS = re.compile(r"^(?P<vm>[\w.-]+): (?P<status>OK|ERROR)\b")
+
+
+def _parse_batched_update_output(output, vms):
+    """
+    Parses the output of a multi-target qubesctl run, and returns a dict
+    mapping each of the given VMs to an UpdateStatus. Whether any packages
+    were changed is recorded for get_changed_templates().
+
+    With "--out json", Salt prints one JSON document per target, keyed by the
+    target name, with a "result" for each state. If a target's JSON cannot be
+    found, we fall back on the OK/ERROR summary line printed by qubesctl. VMs
+    for which neither is available are considered failed.
+    """
+    results = {}
+    summary = {}
+    document = None
+
+    for line in output.splitlines():
+        if document is None and line == "{":
+            document = [line]
+            continue
+        if document is not None:
+            document.append(line)
+            if line == "}":
+                results.update(_parse_salt_json_document("\n".join(document)))
+                document = None
+            continue
+
+        match = QUBESCTL_TARGET_STATUS.match(line)
+        if match:
+            if match.group("status") == "OK":
+                summary[match.group("vm")] = UpdateStatus.UPDATES_OK
+            else:
+                summary[match.group("vm")] = UpdateStatus.UPDATES_FAILED
+
+    status = {}
+    for vm in vms:
+        if vm in results:
+            status[vm] = results[vm]
+        else:
+            status[vm] = summary.get(vm, UpdateStatus.UPDATES_FAILED)
+        if status[vm] != UpdateStatus.UPDATES_OK or vm not in _template_changes:
+            _template_changes[vm] = True
+    return status
+
+
+def _parse_salt_json_document(document):
+    """
+    Returns a dict mapping each target of a Salt JSON return document to an
+    UpdateStatus, based on the result of all states applied to that target.
+    """
+    try:
+        contents = json.loads(document)
+    except ValueError:
+        sdlog.error("Could not parse Salt output: {}".format(document))
+        return {}
+
+    results = {}
+    for target, states in contents.items():
+        if isinstance(states, dict) and all(
+            isinstance(state, dict) and state.get("result") is True for state in states.values()
+        ):
+            results[target] = UpdateStatus.UPDATES_OK
+            _template_changes[target] = _salt_states_have_package_changes(states)
+            # Salt reports the duration of each state in milliseconds
+            durations = [state.get("duration") for state in states.values()]
+            if all(isinstance(duration, (int, float)) for duration in durations):
+                _update_durations[target] = sum(durations) / 1000
+        else:
+            results[target] = UpdateStatus.UPDATES_FAILED
+    return results
+
+
+def _salt_states_have_package_changes(states):
+    """
+    Returns whether any pkg state in the given Salt JSON return data for a
+    target reports changes. If there is no pkg state, we assume that there
+    were changes.
+    """
+    package_states = [
+        state for key, state in states.items() if key.split("_|-")[0] == SALT_PACKAGE_MODULE
+    ]
+    if not package_states:
+        return True
+    return any(state.get("changes") for state in package_states)
+
+
+def _apply_updates_concurrently(vms, max_workers, on_state=None):
+    """
+    Apply updates to the given VMs using a pool of max_workers threads.
+    Yields a tuple of (vm_name, upgrade_results) as each update finishes.
+    """
+    template_vms = [vm for vm in vms if vm != "dom0"]
+    if len(template_vms) < len(vms):
+        yield "dom0", _apply_updates_to("dom0")
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    sdlog.info("Updating up to {} VMs concurrently".format(max_workers))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_apply_updates_to, vm, on_state=on_state): vm for vm in template_vms
+        }
+        for future in as_completed(futures):
+            vm = futures[future]
+            try:
+                upgrade_results = future.result()
+            except Exception as e:
+                sdlog.error("An unexpected error has occurred updating {}".format(vm))
+                sdlog.error(str(e))
+                upgrade_results = UpdateStatus.UPDATES_FAILED
+            yield vm, upgrade_results
+
+
+def _apply_updates_to(vm, on_state=None):
+    """
+    Check for and apply updates to a single VM, which may be dom0. The
+    duration of the update is recorded for get_update_durations().
+    """
+    start = time.monotonic()
+    try:
+        if vm == "dom0":
+            dom0_status = _check_updates_dom0()
+            if dom0_status == UpdateStatus.UPDATES_REQUIRED:
+                return _apply_updates_dom0()
+            else:
+                return UpdateStatus.UPDATES_OK
+        else:
+            return _apply_updates_vm(vm, on_state=on_state)
+    finally:
+        _update_durations[vm] = time.monotonic() - start
+
+
 def _check_updates_dom0():
     """
     We need to reboot the system after every dom0 update. The update
@@ -122,7 +598,14 @@ def _check_updates_dom0():
 
     For this reason, we check for available updates first. The result of this
     check is cached, so it does not incur a significant performance penalty.
+    If a previous check found no updates within DOM0_UPDATE_CHECK_TTL, and
+    dom0 repository metadata and installed packages have not changed since,
+    its result is reused.
     """
+    if _read_dom0_update_check_cache():
+        sdlog.info("No updates available for dom0 (checked recently)")
+        return UpdateStatus.UPDATES_OK
+
     try:
         subprocess.check_call(["sudo", "qubes-dom0-update", "--check-only"])
     except subprocess.CalledProcessError as e:
@@ -131,9 +614,70 @@ def _check_updates_dom0():
         return UpdateStatus.UPDATES_REQUIRED
 
     sdlog.info("No updates available for dom0")
+    _write_dom0_update_check_cache()
     return UpdateStatus.UPDATES_OK
 
 
+def _get_dom0_update_check_fingerprint():
+    """
+    Returns a fingerprint of the modification times and sizes of the files in
+    DOM0_UPDATE_CHECK_INPUTS. Files that do not exist are skipped.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    for pattern in DOM0_UPDATE_CHECK_INPUTS:
+        for path in sorted(glob.glob(pattern)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digest.update("{}:{}:{}\n".format(path, stat.st_mtime_ns, stat.st_size).encode())
+    return digest.hexdigest()
+
+
+def _read_dom0_update_check_cache():
+    """
+    Returns True if a previous dom0 update check that found no updates can be
+    reused, i.e., it is more recent than DOM0_UPDATE_CHECK_TTL and the dom0
+    update check fingerprint has not changed since.
+    """
+    if DOM0_UPDATE_CHECK_TTL <= 0:
+        return False
+
+    try:
+        contents = Util.read_status()["dom0_update_check"]
+        checked_at = datetime.strptime(contents["last_check"], DATE_FORMAT)
+        fingerprint = contents["fingerprint"]
+    except Exception:
+        return False
+
+    age = datetime.now() - checked_at
+    if age < timedelta(0) or age > timedelta(seconds=DOM0_UPDATE_CHECK_TTL):
+        return False
+    return fingerprint == _get_dom0_update_check_fingerprint()
+
+
+def _write_dom0_update_check_cache():
+    """
+    Records that dom0 is up to date, along with the current dom0 update check
+    fingerprint. The fingerprint is computed after the check, as the check
+    itself refreshes repository metadata.
+    """
+    if DOM0_UPDATE_CHECK_TTL <= 0:
+        return
+
+    try:
+        dom0_update_check = {
+            "last_check": str(datetime.now().strftime(DATE_FORMAT)),
+            "fingerprint": _get_dom0_update_check_fingerprint(),
+        }
+        Util.write_status(dom0_update_check=dom0_update_check)
+    except Exception as e:
+        sdlog.error("Error writing dom0 update check cache")
+        sdlog.error(str(e))
+
+
 def _apply_updates_dom0():
     """
     Apply updates to dom0. Any update to dom0 will require a reboot after
@@ -151,54 +695,268 @@ def _apply_updates_dom0():
     return UpdateStatus.REBOOT_REQUIRED
 
 
-def _apply_updates_vm(vm):
+def _apply_updates_vm(vm, on_state=None):
     """
     Apply updates to a given TemplateVM. Any update to the base fedora template
     will require a reboot after the upgrade.
+
+    Whether any packages were changed is recorded for get_changed_templates().
     """
     sdlog.info("Updating {}".format(vm))
     try:
-        subprocess.check_call(
-            ["sudo", "qubesctl", "--skip-dom0", "--targets", vm, "state.sls", "update.qubes-vm"]
+        output = _run_salt(
+            [
+                "sudo",
+                "qubesctl",
+                "--show-output",
+                "--skip-dom0",
+                "--targets",
+                vm,
+                "state.sls",
+                "update.qubes-vm",
+            ],
+            label=vm,
+            on_state=on_state,
         )
     except subprocess.CalledProcessError as e:
         sdlog.error(
             "An error has occurred updating {}. Please contact your administrator.".format(vm)
         )
         sdlog.error(str(e))
+        _template_changes[vm] = True
         return UpdateStatus.UPDATES_FAILED
+    _template_changes[vm] = _salt_output_has_package_changes(output)
     sdlog.info("{} update successful".format(vm))
     return UpdateStatus.UPDATES_OK
 
 
+# Lines of a state printed by Salt's highstate outputter, e.g. "      ID: dom0-packages"
+# and "  Result: True", or a single line if state_output is "terse", e.g.
+# "  Name: vim - Function: pkg.installed - Result: Clean Started: ...". These are
+# only printed once the run has finished.
+SALT_STATE_ID = re.compile(r"^\s*ID: (?P<id>.+?)\s*$")
+SALT_STATE_RESULT = re.compile(r"^\s*Result: (?P<result>True|False|None)\s*$")
+SALT_TERSE_STATE = re.compile(
+    r"^\s*Name: (?P<id>.+?) - Function: (?P<function>\S+) - "
+    r"Result: (?P<result>Clean|Changed|Failed|Differs)\b"
+)
+
+# Lines logged by Salt at the info log level (-l info) as it runs each state,
+# e.g. "[INFO    ] Running state [vim] at time 12:00:00.000000" and
+# "[INFO    ] Completed state [vim] at time 12:00:01.000000 (duration_in_ms=1000.0)".
+# Salt logs why a state failed at the error level in between.
+SALT_LOG_RUNNING_STATE = re.compile(r"^\[INFO\s*\] Running state \[(?P<id>.*)\] at time ")
+SALT_LOG_COMPLETED_STATE = re.compile(r"^\[INFO\s*\] Completed state \[(?P<id>.*)\] at time ")
+SALT_LOG_ERROR = re.compile(r"^\[(?:ERROR|CRITICAL)\s*\]")
+
+
+def _run_salt(cmd, label, on_state=None):
+    """
+    Runs a command that applies Salt states and returns its output, like
+    subprocess.check_output(), but reads stdout and stderr line by line as the
+    command runs. Each line is logged at the debug level, prefixed with the
+    given label, and the output is logged if the command fails.
+
+    If given, on_state is called with the name of each state and whether it
+    succeeded. If the command runs Salt at the info log level (-l info), this
+    happens as each state completes, based on Salt's log. Otherwise, states
+    are only reported once their results are printed, which for qubesctl is at
+    the end of the run of each target.
+    """
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1,
+    )
+    output = []
+    # Whether states are reported from Salt's log rather than its results
+    logged = False
+    # The state that is running according to Salt's log, and whether it failed
+    running_state = None
+    running_state_failed = False
+    # The state whose results are being printed
+    state_id = None
+    with process.stdout:
+        for line in process.stdout:
+            output.append(line)
+            line = line.rstrip("\n")
+            sdlog.debug("[{}] {}".format(label, line))
+
+            match = SALT_LOG_RUNNING_STATE.match(line)
+            if match:
+                logged = True
+                running_state = match.group("id")
+                running_state_failed = False
+                continue
+            if running_state is not None and SALT_LOG_ERROR.match(line):
+                running_state_failed = True
+                continue
+            match = SALT_LOG_COMPLETED_STATE.match(line)
+            if match:
+                _report_salt_state(label, match.group("id"), not running_state_failed, on_state)
+                running_state = None
+                continue
+            if logged:
+                continue
+
+            result = None
+            match = SALT_STATE_ID.match(line)
+            if match:
+                state_id = match.group("id")
+                continue
+            match = SALT_STATE_RESULT.match(line)
+            if match and state_id is not None:
+                result = match.group("result") != "False"
+            else:
+                match = SALT_TERSE_STATE.match(line)
+                if match:
+                    state_id = match.group("id")
+                    result = match.group("result") != "Failed"
+            if result is not None:
+                _report_salt_state(label, state_id, result, on_state)
+                state_id = None
+
+    output = "".join(output)
+    returncode = process.wait()
+    if returncode != 0:
+        sdlog.error("[{}] Salt output:\n{}".format(label, output))
+        raise subprocess.CalledProcessError(returncode, cmd, output=output)
+    return output
+
+
+def _report_salt_state(label, state_id, result, on_state):
+    if not result:
+        sdlog.error("[{}] Salt state failed: {}".format(label, state_id))
+    if on_state is not None:
+        on_state(state_id, result)
+
+
+# Lines of a state printed by Salt's highstate outputter that give its function,
+# e.g. "    Function: pkg.uptodate", and start its changes, e.g. "     Changes:".
+# Changes are printed on the following lines, indented past the colon.
+SALT_STATE_FUNCTION = re.compile(r"^\s*Function: (?P<function>\S+)\s*$")
+SALT_STATE_CHANGES = re.compile(r"^(?P<key>\s*Changes:)(?P<value>.*)$")
+
+# The Salt module whose states change packages. Other states report changes
+# on every run, in particular the cmd.run state with which update.qubes-vm
+# notifies dom0 of the update status.
+SALT_PACKAGE_MODULE = "pkg"
+
+
+def _is_package_state(function):
+    return function.split(".")[0] == SALT_PACKAGE_MODULE
+
+
+def _salt_output_has_package_changes(output):
+    """
+    Returns whether the output of a Salt run reports changes by any pkg state.
+    If no pkg state can be found, we assume that there were changes.
+    """
+    found = False
+    function = None
+    changes_column = None
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        if changes_column is not None:
+            # Any line within the changes of a pkg state is a change
+            if len(line) - len(line.lstrip()) > changes_column:
+                return True
+            changes_column = None
+
+        match = SALT_TERSE_STATE.match(line)
+        if match:
+            if _is_package_state(match.group("function")):
+                found = True
+                if match.group("result") == "Changed":
+                    return True
+            continue
+        if SALT_STATE_ID.match(line):
+            function = None
+            continue
+        match = SALT_STATE_FUNCTION.match(line)
+        if match:
+            function = match.group("function")
+            continue
+        match = SALT_STATE_CHANGES.match(line)
+        if match and function is not None and _is_package_state(function):
+            found = True
+            if match.group("value").strip():
+                return True
+            changes_column = len(match.group("key")) - 1
+    return not found
+
+
+def get_changed_templates():
+    """
+    Returns the set of TemplateVMs whose last update changed any packages, or
+    for which this could not be determined.
+    """
+    return set(vm for vm, changed in _template_changes.items() if changed)
+
+
+def get_update_durations():
+    """
+    Returns a dict mapping each updated VM to the duration of its last update
+    (in seconds), where known.
+    """
+    return dict(_update_durations)
+
+
+def write_update_timing(timer, status, state_counts=None):
+    """
+    Appends timing records for an update run to the timing log: one for the
+    duration of each phase measured by the given Util.PhaseTimer, one for the
+    update duration of each VM, and one for the entire run and its resulting
+    UpdateStatus. All records of a run share the same "run" timestamp.
+
+    If given, state_counts maps phases to the number of Salt states that were
+    applied in them, which is added to their records as "states".
+    """
+    run = str(datetime.now().strftime(DATE_FORMAT))
+    records = []
+    for phase, duration in timer.phases:
+        record = {"run": run, "type": "phase", "name": phase, "duration": round(duration, 3)}
+        if state_counts and phase in state_counts:
+            record["states"] = state_counts[phase]
+        records.append(record)
+    for vm, duration in sorted(get_update_durations().items()):
+        records.append({"run": run, "type": "vm", "name": vm, "duration": round(duration, 3)})
+    records.append(
+        {
+            "run": run,
+            "type": "run",
+            "name": "total",
+            "duration": round(timer.total(), 3),
+            "status": status.value,
+        }
+    )
+
+    try:
+        Util.write_timing_records(records)
+    except OSError as e:
+        sdlog.error("Error writing update timing records")
+        sdlog.error(str(e))
+
+
 def _write_last_updated_flags_to_disk():
     """
     Writes the time of last successful upgrade to dom0 and sd-app
     """
     current_date = str(datetime.now().strftime(DATE_FORMAT))
 
-    flag_file_sd_app_last_updated = FLAG_FILE_LAST_UPDATED_SD_APP
-    flag_file_dom0_last_updated = get_dom0_path(FLAG_FILE_LAST_UPDATED_DOM0)
-
     try:
         sdlog.info("Setting last updated to {} in sd-app".format(current_date))
-        subprocess.check_call(
-            [
-                "qvm-run",
-                "sd-app",
-                "echo '{}' > {}".format(current_date, flag_file_sd_app_last_updated),
-            ]
-        )
-    except subprocess.CalledProcessError as e:
+        _publish_flag_to_sd_app(FLAG_FILE_LAST_UPDATED_SD_APP, current_date)
+    except (subprocess.CalledProcessError, QubesException, KeyError) as e:
         sdlog.error("Error writing last updated flag to sd-app")
         sdlog.error(str(e))
 
     try:
         sdlog.info("Setting last updated to {} in dom0".format(current_date))
-        if not os.path.exists(os.path.dirname(flag_file_dom0_last_updated)):
-            os.makedirs(os.path.dirname(flag_file_dom0_last_updated))
-        with open(flag_file_dom0_last_updated, "w") as f:
-            f.write(current_date)
+        Util.write_status(last_updated=current_date)
     except Exception as e:
         sdlog.error("Error writing last updated flag to dom0")
         sdlog.error(str(e))
@@ -209,28 +967,17 @@ def _write_updates_status_flag_to_disk(status):
     Writes the latest SecureDrop Workstation update status to disk, on both
     dom0 and sd-app for futher processing in the future.
     """
-    flag_file_path_sd_app = FLAG_FILE_STATUS_SD_APP
-    flag_file_path_dom0 = get_dom0_path(FLAG_FILE_STATUS_DOM0)
-
     try:
         sdlog.info("Setting update flag to {} in sd-app".format(status.value))
-        subprocess.check_call(
-            ["qvm-run", "sd-app", "echo '{}' > {}".format(status.value, flag_file_path_sd_app)]
-        )
-    except subprocess.CalledProcessError as e:
+        _publish_flag_to_sd_app(FLAG_FILE_STATUS_SD_APP, status.value)
+    except (subprocess.CalledProcessError, QubesException, KeyError) as e:
         sdlog.error("Error writing update status flag to sd-app")
         sdlog.error(str(e))
 
     try:
         sdlog.info("Setting update flag to {} in dom0".format(status.value))
-        if not os.path.exists(os.path.dirname(flag_file_path_dom0)):
-            os.makedirs(os.path.dirname(flag_file_path_dom0))
-
         current_date = str(datetime.now().strftime(DATE_FORMAT))
-
-        with open(flag_file_path_dom0, "w") as f:
-            flag_contents = {"last_status_update": current_date, "status": status.value}
-            json.dump(flag_contents, f)
+        Util.write_status(last_status_update=current_date, status=status.value)
     except Exception as e:
         sdlog.error("Error writing update status flag to dom0")
         sdlog.error(str(e))
@@ -286,19 +1033,21 @@ def read_dom0_update_flag_from_disk(with_timestamp=False):
     """
     Read the last updated SecureDrop Workstation update status from disk
     in dom0, and returns the corresponding UpdateStatus. If ivoked the
-    parameter `with_timestamp=True`, this function will return the full json.
+    parameter `with_timestamp=True`, this function will return the status
+    and the time it was last updated.
     """
-    flag_file_path_dom0 = get_dom0_path(FLAG_FILE_STATUS_DOM0)
+    contents = Util.read_status()
 
     try:
-        with open(flag_file_path_dom0, "r") as f:
-            contents = json.load(f)
-            for status in UpdateStatus:
-                if int(contents["status"]) == int(status.value):
-                    if with_timestamp:
-                        return contents
-                    else:
-                        return status
+        for status in UpdateStatus:
+            if int(contents["status"]) == int(status.value):
+                if with_timestamp:
+                    return {
+                        "last_status_update": contents["last_status_update"],
+                        "status": contents["status"],
+                    }
+                else:
+                    return status
     except Exception:
         sdlog.info("Cannot read dom0 status flag, assuming first run")
         return None
@@ -336,16 +1085,23 @@ def overall_update_status(results):
         return UpdateStatus.UPDATES_OK
 
 
-def apply_dom0_state():
+def apply_dom0_state(on_state=None):
     """
     Applies the dom0 state to ensure dom0 and AppVMs are properly
     Configured. This will *not* enforce configuration inside the AppVMs.
     Here, we call qubectl directly (instead of through sdw-admin) to
     ensure it is environment-specific.
+
+    If given, on_state is called for each Salt state as it completes (see
+    _run_salt()).
     """
     sdlog.info("Applying dom0 state")
     try:
-        subprocess.check_call(["sudo", "qubesctl", "--show-output", "state.highstate"])
+        _run_salt(
+            ["sudo", "qubesctl", "--show-output", "state.highstate", "-l", "info"],
+            label="dom0",
+            on_state=on_state,
+        )
         sdlog.info("Dom0 state applied")
         return UpdateStatus.UPDATES_OK
     except subprocess.CalledProcessError as e:
@@ -354,7 +1110,7 @@ def apply_dom0_state():
         return UpdateStatus.UPDATES_FAILED
 
 
-def shutdown_and_start_vms():
+def shutdown_and_start_vms(changed_templates=None):
     """
     Power cycles the vms to ensure. we should do them all in one shot to reduce complexity
     and likelihood of failure. Rebooting the VMs will ensure the TemplateVM
@@ -365,74 +1121,338 @@ def shutdown_and_start_vms():
     All system AppVMs (sys-net, sys-firewall and sys-usb) need to be restarted.
     We use qvm-kill for sys-firewall and sys-net, because a shutdown may fail
     if they are currently in use as NetVMs by any of the user's other VMs.
+
+    If the Qubes Admin API is available, the order of operations is derived
+    from the relationships between VMs, and VMs that do not depend on each
+    other are shut down and started at the same time.
+
+    If a set of changed_templates is given, only the VMs required for changes
+    to those TemplateVMs to take effect are power cycled.
     """
+    app = _get_qubes_app()
+    vms = sorted(current_templates) + sdw_vms_in_order
+    vms += safe_sys_vms_in_order + unsafe_sys_vms_in_order
+    if changed_templates is not None:
+        selected_vms = _get_vms_to_power_cycle(app, changed_templates)
+        if not selected_vms:
+            sdlog.info("No TemplateVMs were changed, skipping power cycling of VMs")
+            return
+        sdlog.info("Power cycling VMs affected by updates: {}".format(sorted(selected_vms)))
+        vms = [vm for vm in vms if vm in selected_vms]
+
+    if app is None:
+        _shutdown_and_start_vms_in_order(vms)
+    else:
+        _shutdown_and_start_vms_by_dependencies(app, vms)
 
-    sdw_vms_in_order = [
-        "sd-app",
-        "sd-proxy",
-        "sd-whonix",
-        "sd-gpg",
-        "sd-log",
-    ]
 
+def _get_vms_to_power_cycle(app, changed_templates):
+    """
+    Returns the set of VMs that must be power cycled for updates to the given
+    TemplateVMs to take effect: the TemplateVMs themselves, the SDW AppVMs and
+    system VMs based on them, and all VMs using any of those as their NetVM.
+    """
+    vm_templates = {vm: current_vms[vm] for vm in sdw_vms_in_order}
+    vm_templates.update(sys_vm_templates)
+    netvms = dict(default_netvms)
+    if app is not None:
+        for vm in vm_templates:
+            if vm in app.domains:
+                domain = app.domains[vm]
+                # StandaloneVMs, e.g. sys-net on some systems, have no template
+                template = getattr(domain, "template", None)
+                vm_templates[vm] = str(template) if template is not None else None
+                netvms[vm] = str(domain.netvm) if domain.netvm is not None else None
+
+    selected_vms = set(vm for vm in changed_templates if vm in current_templates)
+    selected_vms |= set(vm for vm, template in vm_templates.items() if template in selected_vms)
+
+    # A VM cannot be shut down while it is in use as a NetVM
+    while True:
+        dependent_vms = set(
+            vm for vm, netvm in netvms.items() if netvm in selected_vms and vm in vm_templates
+        )
+        if dependent_vms <= selected_vms:
+            break
+        selected_vms |= dependent_vms
+    return selected_vms
+
+
+def _shutdown_and_start_vms_in_order(vms):
+    """
+    Power cycles the given VMs one by one, in a fixed order.
+    """
     sdlog.info("Shutting down SDW TemplateVMs for updates")
     for vm in sorted(current_templates):
-        _safely_shutdown_vm(vm)
+        if vm in vms:
+            _safely_shutdown_vm(vm)
 
     sdlog.info("Shutting down SDW AppVMs for updates")
     for vm in sdw_vms_in_order:
-        _safely_shutdown_vm(vm)
+        if vm in vms:
+            _safely_shutdown_vm(vm)
 
-    # System VMs that can be safely shut down (order should not matter, but will
-    # be respected).
-    safe_sys_vms_in_order = ["sys-usb", "sys-whonix"]
     for vm in safe_sys_vms_in_order:
-        sdlog.info("Safely shutting down system VM: {}".format(vm))
-        _safely_shutdown_vm(vm)
+        if vm in vms:
+            sdlog.info("Safely shutting down system VM: {}".format(vm))
+            _safely_shutdown_vm(vm)
 
     # TODO: Use of qvm-kill should be considered unsafe and may have unexpected
     # side effects. We should aim for a more graceful shutdown strategy.
-    unsafe_sys_vms_in_order = ["sys-firewall", "sys-net"]
     for vm in unsafe_sys_vms_in_order:
-        sdlog.info("Killing system VM: {}".format(vm))
-        try:
-            subprocess.check_output(["qvm-kill", vm], stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            sdlog.error("Error while killing system VM: {}".format(vm))
-            sdlog.error(str(e))
-            sdlog.error(str(e.stderr))
+        if vm in vms:
+            sdlog.info("Killing system VM: {}".format(vm))
+            _safely_kill_vm(vm)
 
     all_sys_vms_in_order = safe_sys_vms_in_order + unsafe_sys_vms_in_order
     sdlog.info("Starting fedora-based system VMs after updates")
     for vm in reversed(all_sys_vms_in_order):
-        _safely_start_vm(vm)
+        if vm in vms:
+            _safely_start_vm(vm)
 
     sdlog.info("Starting SDW VMs after updates")
     for vm in reversed(sdw_vms_in_order):
-        _safely_start_vm(vm)
+        if vm in vms:
+            _safely_start_vm(vm)
+
+
+def _shutdown_and_start_vms_by_dependencies(app, vms):
+    """
+    Power cycles the given VMs, shutting down (and later starting) all VMs
+    whose dependents have already been handled at the same time. TemplateVMs
+    are shut down, but not started again.
+    """
+    dependencies = _get_vm_dependencies(app, vms)
+    shutdown_tiers = _get_shutdown_tiers(dependencies)
+
+    for tier in shutdown_tiers:
+        sdlog.info("Shutting down VMs for updates: {}".format(", ".join(tier)))
+        _run_concurrently(_shutdown_or_kill_vm, tier)
+
+    startable_vms = set(sdw_vms_in_order + safe_sys_vms_in_order + unsafe_sys_vms_in_order)
+    for tier in reversed(shutdown_tiers):
+        tier = [vm for vm in tier if vm in startable_vms]
+        if tier:
+            sdlog.info("Starting VMs after updates: {}".format(", ".join(tier)))
+            _run_concurrently(_safely_start_vm, tier)
+
+
+def _get_vm_dependencies(app, vms):
+    """
+    Returns a dict mapping each of the given VMs that exists to the set of
+    given VMs it depends on, i.e., its NetVM and its TemplateVM. All SDW VMs
+    also depend on the logging VM, which they send their logs to, except for
+    TemplateVMs, which are shut down after the VMs based on them, including
+    the logging VM.
+    """
+    domains = {vm: app.domains[vm] for vm in vms if vm in app.domains}
+    dependencies = {}
+    for name, vm in domains.items():
+        depends_on = set()
+        for prop in ["netvm", "template"]:
+            try:
+                dependency = getattr(vm, prop)
+            except AttributeError:
+                # Property is not defined for this type of VM
+                continue
+            if dependency is not None and str(dependency) in domains:
+                depends_on.add(str(dependency))
+        sends_logs = SDW_DEFAULT_TAG in vm.tags and vm.klass != "TemplateVM"
+        if sends_logs and name != LOG_VM and LOG_VM in domains:
+            depends_on.add(LOG_VM)
+        dependencies[name] = depends_on
+    return dependencies
+
+
+def _get_shutdown_tiers(dependencies):
+    """
+    Groups VMs into tiers for shutdown, based on a dict mapping each VM to
+    the VMs it depends on. All VMs depending on a given VM are in an earlier
+    tier than that VM, so VMs within a tier can be shut down at the same time,
+    and tiers can be started in reverse order.
+    """
+    remaining = set(dependencies)
+    tiers = []
+    while remaining:
+        tier = set(
+            vm
+            for vm in remaining
+            if not any(vm in dependencies[other] for other in remaining if other != vm)
+        )
+        if not tier:
+            sdlog.error("Circular dependency between VMs: {}".format(", ".join(sorted(remaining))))
+            tier = remaining
+        tiers.append(sorted(tier))
+        remaining -= tier
+    return tiers
+
+
+def _run_concurrently(func, vms):
+    """
+    Calls func for each of the given VMs, with up to POWER_CYCLE_WORKERS
+    calls at the same time, and waits for all calls to complete.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=POWER_CYCLE_WORKERS) as executor:
+        list(executor.map(func, vms))
+
+
+def _shutdown_or_kill_vm(vm):
+    # TODO: Use of qvm-kill should be considered unsafe and may have unexpected
+    # side effects. We should aim for a more graceful shutdown strategy.
+    if vm in unsafe_sys_vms_in_order:
+        sdlog.info("Killing system VM: {}".format(vm))
+        _safely_kill_vm(vm)
+    else:
+        _safely_shutdown_vm(vm)
+
+
+def _safely_kill_vm(vm):
+    app = _get_qubes_app()
+    try:
+        if app is not None:
+            domain = app.domains[vm]
+            if domain.is_running():
+                domain.kill()
+        else:
+            subprocess.check_output(["qvm-kill", vm], stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        sdlog.error("Error while killing system VM: {}".format(vm))
+        sdlog.error(str(e))
+        sdlog.error(str(e.stderr))
+    except (QubesException, KeyError) as e:
+        sdlog.error("Error while killing system VM: {}".format(vm))
+        sdlog.error(str(e))
 
 
 def _safely_shutdown_vm(vm):
+    import asyncio
+
+    app = _get_qubes_app()
     try:
-        subprocess.check_output(["qvm-shutdown", "--wait", vm], stderr=subprocess.PIPE)
+        if app is not None:
+            domain = app.domains[vm]
+            vm_states = _get_vm_state_cache()
+            if vm_states is not None:
+                if vm_states.get_state(vm) != "Halted":
+                    domain.shutdown()
+                    if vm_states.wait_for_state(vm, "Halted", SHUTDOWN_TIMEOUT):
+                        pass
+                    elif vm_states.listening:
+                        raise asyncio.TimeoutError("Timed out waiting for {}".format(vm))
+                    elif domain.is_running():
+                        # The cache stopped listening for events while waiting
+                        _wait_for_shutdown([domain], SHUTDOWN_TIMEOUT)
+            elif domain.is_running():
+                domain.shutdown()
+                _wait_for_shutdown([domain], SHUTDOWN_TIMEOUT)
+        else:
+            subprocess.check_output(["qvm-shutdown", "--wait", vm], stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         sdlog.error("Failed to shut down {}".format(vm))
         sdlog.error(str(e))
         sdlog.error(str(e.stderr))
         return UpdateStatus.UPDATES_FAILED
+    except (QubesException, KeyError, asyncio.TimeoutError) as e:
+        sdlog.error("Failed to shut down {}".format(vm))
+        sdlog.error(str(e))
+        return UpdateStatus.UPDATES_FAILED
 
 
 def _safely_start_vm(vm):
+    app = _get_qubes_app()
     try:
-        running_vms = subprocess.check_output(
-            ["qvm-ls", "--running", "--raw-list"], stderr=subprocess.PIPE
-        )
-        sdlog.info("VMs running before start of {}: {}".format(vm, running_vms))
-        subprocess.check_output(["qvm-start", "--skip-if-running", vm], stderr=subprocess.PIPE)
+        if app is not None:
+            vm_states = _get_vm_state_cache()
+            if vm_states is not None:
+                running_vms = vm_states.get_running_vms()
+                is_running = vm_states.get_state(vm) not in ["Halted", "Halting"]
+            else:
+                running_vms = [domain.name for domain in app.domains if domain.is_running()]
+                is_running = app.domains[vm].is_running()
+            sdlog.info("VMs running before start of {}: {}".format(vm, running_vms))
+            if not is_running:
+                app.domains[vm].start()
+        else:
+            running_vms = subprocess.check_output(
+                ["qvm-ls", "--running", "--raw-list"], stderr=subprocess.PIPE
+            )
+            sdlog.info("VMs running before start of {}: {}".format(vm, running_vms))
+            subprocess.check_output(["qvm-start", "--skip-if-running", vm], stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         sdlog.error("Error while starting {}".format(vm))
         sdlog.error(str(e))
         sdlog.error(str(e.stderr))
+    except (QubesException, KeyError) as e:
+        sdlog.error("Error while starting {}".format(vm))
+        sdlog.error(str(e))
+
+
+def _wait_for_shutdown(domains, timeout):
+    """
+    Blocks until all given domains have shut down, based on events from the
+    Qubes Admin API. Raises asyncio.TimeoutError after timeout seconds.
+    """
+    import asyncio
+
+    # Power cycling uses worker threads, which do not have an event loop by default
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(asyncio.wait_for(wait_for_domain_shutdown(domains), timeout))
+    finally:
+        loop.close()
+
+
+def _publish_flag_to_sd_app(flag_file, value):
+    """
+    Publishes the value of a flag file to sd-app as a vm-config feature, e.g.
+    "vm-config.sdw-update-status", which Qubes exposes in sd-app's QubesDB.
+    sd-app writes the flag file from QubesDB when it starts, or when the
+    feature changes while it is running. Unlike running a command in sd-app,
+    this neither requires a qrexec call nor starts sd-app.
+
+    vm-config features are only supported as of Qubes 4.1; on Qubes 4.0, the
+    flag file is written in sd-app directly instead.
+    """
+    qubes_version = Util.get_qubes_version()
+    if qubes_version is not None and "4.0" in qubes_version:
+        _run_in_vm("sd-app", "echo '{}' > {}".format(value, flag_file))
+        return
+
+    feature = SD_APP_FLAG_FEATURE_PREFIX + os.path.basename(flag_file)
+    app = _get_qubes_app()
+    if app is not None:
+        app.domains["sd-app"].features[feature] = value
+    else:
+        subprocess.check_call(["qvm-features", "sd-app", feature, value])
+
+
+def _run_in_vm(vm, command):
+    """
+    Runs a shell command in the given VM, starting it if necessary. Raises
+    subprocess.CalledProcessError or QubesException if the command fails, and
+    KeyError if the VM does not exist.
+    """
+    app = _get_qubes_app()
+    if app is not None:
+        app.domains[vm].run(command)
+    else:
+        subprocess.check_call(["qvm-run", vm, command])
+
+
+def launch_securedrop_client():
+    """
+    Helper function to launch the SecureDrop Client
+    """
+    try:
+        sdlog.info("Launching SecureDrop client")
+        subprocess.Popen(["qvm-run", "sd-app", "gtk-launch securedrop-client"])
+    except subprocess.CalledProcessError as e:
+        sdlog.error("Error while launching SecureDrop client")
+        sdlog.error(str(e))
+    sys.exit(0)
 
 
 def should_launch_updater(interval):
@@ -492,6 +1512,295 @@ def _interval_expired(interval, status):
     return True
 
 
+class VMStateCache:
+    """
+    Tracks the power state of all VMs. The state of every VM is read once,
+    and then kept up to date by listening to events from the Qubes Admin API
+    in a background thread, so looking up a VM's state does not require a
+    call to qubesd. If the listener stops, listening is set to False and the
+    cached states must no longer be used.
+    """
+
+    # Power state of a VM after each event
+    EVENT_STATES = {
+        "domain-pre-start": "Transient",
+        "domain-start": "Running",
+        "domain-start-failed": "Halted",
+        "domain-paused": "Paused",
+        "domain-unpaused": "Running",
+        "domain-pre-shutdown": "Halting",
+        "domain-shutdown": "Halted",
+    }
+
+    def __init__(self, app):
+        self.app = app
+        self._states = {}
+        self._condition = threading.Condition()
+        self.listening = False
+
+    def start(self):
+        """
+        Reads the current state of all VMs, and starts listening for events.
+        """
+        self._refresh()
+        self.listening = True
+        listener = threading.Thread(target=self._listen, name="VMStateCache", daemon=True)
+        listener.start()
+
+    def get_state(self, vm):
+        """
+        Returns the power state of the given VM, e.g. "Running" or "Halted",
+        or None if the VM is unknown.
+        """
+        with self._condition:
+            return self._states.get(vm)
+
+    def get_running_vms(self):
+        """
+        Returns a sorted list of the names of all running VMs.
+        """
+        with self._condition:
+            return sorted(vm for vm, state in self._states.items() if state == "Running")
+
+    def wait_for_state(self, vm, state, timeout):
+        """
+        Blocks until the given VM is in the given state, for at most timeout
+        seconds, or until the cache stops listening for events. Returns True if
+        the VM reached that state, False otherwise.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._states.get(vm) == state or not self.listening, timeout
+            )
+            return self._states.get(vm) == state
+
+    def _refresh(self, *args, **kwargs):
+        states = {domain.name: domain.get_power_state() for domain in self.app.domains}
+        with self._condition:
+            self._states = states
+            self._condition.notify_all()
+
+    def _on_event(self, subject, event, **kwargs):
+        with self._condition:
+            self._states[str(subject)] = self.EVENT_STATES[event]
+            self._condition.notify_all()
+
+    def _listen(self):
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        dispatcher = EventsDispatcher(self.app)
+        for event in self.EVENT_STATES:
+            dispatcher.add_handler(event, self._on_event)
+        # Events may have been missed before (re)connecting to qubesd
+        dispatcher.add_handler("connection-established", self._refresh)
+        try:
+            loop.run_until_complete(dispatcher.listen_for_events())
+        except Exception as e:
+            sdlog.error("Stopped listening for VM state changes")
+            sdlog.error(str(e))
+        finally:
+            loop.close()
+            with self._condition:
+                self.listening = False
+                self._condition.notify_all()
+
+
+class ProgressEstimator:
+    """
+    Estimates the progress of an update run, and the time remaining, from the
+    durations of its phases and of the updates of individual VMs in previous
+    runs, as read from the timing log (see write_update_timing()).
+
+    Within a phase, progress is estimated from the time elapsed, from the
+    expected durations of the VMs that have completed, and from the number of
+    Salt states that have completed compared to previous runs, so that it
+    advances continuously. The methods of this class may be called from any
+    thread.
+    """
+
+    def __init__(self, phases=UPDATE_PHASES, records=None):
+        if records is None:
+            try:
+                records = Util.read_timing_records()
+            except OSError as e:
+                sdlog.error("Error reading update timing records")
+                sdlog.error(str(e))
+                records = []
+
+        self._expected = _get_expected_durations(records)
+        self._expected_states = _get_expected_state_counts(records)
+        self._phases = list(phases)
+        self._completed_phases = []
+        self._current_phase = None
+        self._phase_start = None
+        self._vms = []
+        self._completed_vms = set()
+        self._state_counts = {}
+        self._lock = threading.Lock()
+
+    def replace_phase(self, phase, new_phase):
+        """
+        Replaces a phase that has not started yet, e.g. if the run takes a
+        different path than expected.
+        """
+        with self._lock:
+            self._phases[self._phases.index(phase)] = new_phase
+
+    def start_phase(self, phase, vms=()):
+        """
+        Ends the current phase, if any, and starts the given phase, in which
+        the given VMs will be updated.
+        """
+        with self._lock:
+            if self._current_phase is not None:
+                self._completed_phases.append(self._current_phase)
+            self._current_phase = phase
+            self._phase_start = time.monotonic()
+            self._vms = list(vms)
+            self._completed_vms = set()
+
+    def complete_vm(self, vm):
+        """
+        Records that the given VM of the current phase has been updated.
+        """
+        with self._lock:
+            self._completed_vms.add(vm)
+
+    def complete_state(self, state_id=None, result=True):
+        """
+        Records that a Salt state of the current phase has completed. The
+        arguments match the on_state callback of apply_updates().
+        """
+        with self._lock:
+            if self._current_phase is not None:
+                count = self._state_counts.get(self._current_phase, 0)
+                self._state_counts[self._current_phase] = count + 1
+
+    def get_state_counts(self):
+        """
+        Returns a dict mapping each phase to the number of Salt states that
+        have completed in it, for write_update_timing().
+        """
+        with self._lock:
+            return dict(self._state_counts)
+
+    def progress(self):
+        """
+        Returns the estimated progress of the run, from 0.0 to 1.0.
+        """
+        with self._lock:
+            total = sum(self._get_expected_phase_duration(phase) for phase in self._phases)
+            done = sum(self._get_expected_phase_duration(phase) for phase in self._completed_phases)
+            if self._current_phase is not None:
+                fraction, _ = self._get_current_phase_progress()
+                done += self._get_expected_phase_duration(self._current_phase) * fraction
+        if total <= 0:
+            return 0.0
+        return min(done / total, 1.0)
+
+    def remaining(self):
+        """
+        Returns the estimated time remaining (in seconds), or None if the
+        current phase is already taking longer than expected.
+        """
+        with self._lock:
+            pending = [
+                phase
+                for phase in self._phases
+                if phase not in self._completed_phases and phase != self._current_phase
+            ]
+            remaining = sum(self._get_expected_phase_duration(phase) for phase in pending)
+            if self._current_phase is not None:
+                fraction, overdue = self._get_current_phase_progress()
+                if overdue:
+                    return None
+                expected = self._get_expected_phase_duration(self._current_phase)
+                remaining += expected * (1 - fraction)
+        return remaining
+
+    def _get_expected_phase_duration(self, phase):
+        return self._expected.get(("phase", phase), DEFAULT_PHASE_DURATIONS.get(phase, 60))
+
+    def _get_current_phase_progress(self):
+        """
+        Returns a tuple of the estimated progress of the current phase (0.0 to
+        1.0), and whether it is taking longer than expected.
+        """
+        expected = self._get_expected_phase_duration(self._current_phase)
+        elapsed = time.monotonic() - self._phase_start
+        if expected > 0:
+            time_fraction = min(elapsed / expected, MAX_ESTIMATED_PHASE_PROGRESS)
+        else:
+            time_fraction = MAX_ESTIMATED_PHASE_PROGRESS
+
+        vm_fraction = 0.0
+        if self._vms:
+            known = [self._expected[("vm", vm)] for vm in self._vms if ("vm", vm) in self._expected]
+            default = sorted(known)[len(known) // 2] if known else 1.0
+            weights = {vm: self._expected.get(("vm", vm), default) for vm in self._vms}
+            total = sum(weights.values())
+            if total > 0:
+                completed = sum(weights[vm] for vm in self._completed_vms if vm in weights)
+                vm_fraction = completed / total
+            else:
+                vm_fraction = len(self._completed_vms) / len(self._vms)
+
+        # The number of states may differ from previous runs, so progress
+        # based on it is capped like progress based on time
+        state_fraction = 0.0
+        expected_states = self._expected_states.get(self._current_phase)
+        if expected_states:
+            completed_states = self._state_counts.get(self._current_phase, 0)
+            state_fraction = min(completed_states / expected_states, MAX_ESTIMATED_PHASE_PROGRESS)
+
+        overdue = elapsed > expected and vm_fraction < 1.0
+        return max(time_fraction, vm_fraction, state_fraction), overdue
+
+
+def _get_expected_durations(records):
+    """
+    Returns a dict mapping each ("phase", name) and ("vm", name) in the given
+    timing records to the median of its PROGRESS_HISTORY_RUNS most recent
+    durations.
+    """
+    durations = {}
+    for record in records:
+        try:
+            key = (record["type"], record["name"])
+            duration = float(record["duration"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if key[0] in ("phase", "vm"):
+            durations.setdefault(key, []).append(duration)
+
+    expected = {}
+    for key, values in durations.items():
+        recent = sorted(values[-PROGRESS_HISTORY_RUNS:])
+        expected[key] = recent[len(recent) // 2]
+    return expected
+
+
+def _get_expected_state_counts(records):
+    """
+    Returns a dict mapping each phase in the given timing records to the
+    median of its PROGRESS_HISTORY_RUNS most recent numbers of Salt states.
+    """
+    counts = {}
+    for record in records:
+        if not isinstance(record, dict) or record.get("type") != "phase":
+            continue
+        if isinstance(record.get("states"), int):
+            counts.setdefault(record.get("name"), []).append(record["states"])
+
+    expected = {}
+    for phase, values in counts.items():
+        recent = sorted(values[-PROGRESS_HISTORY_RUNS:])
+        expected[phase] = recent[len(recent) // 2]
+    return expected
+
+
 class UpdateStatus(Enum):
     """
     Standardizes return codes for update/upgrade methods
@@ -1,6 +1,6 @@
 from sdw_updater_gui import strings
 from sdw_updater_gui import Updater
-from sdw_updater_gui.Updater import UpdateStatus
+from sdw_updater_gui.Updater import UpdateStatus, launch_securedrop_client
 from sdw_util import Util
 import logging
 import subprocess
@@ -8,28 +8,23 @@ import sys
 
 if Util.get_qt_version() == 5:
     from PyQt5.QtWidgets import QDialog
-    from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot
+    from PyQt5.QtCore import QThread, QTimer, pyqtSignal, pyqtSlot
     from sdw_updater_gui.UpdaterAppUiQt5 import Ui_UpdaterDialog
 else:
     from PyQt4.QtGui import QDialog
-    from PyQt4.QtCore import QThread, pyqtSignal, pyqtSlot
+    from PyQt4.QtCore import QThread, QTimer, pyqtSignal, pyqtSlot
     from sdw_updater_gui.UpdaterAppUi import Ui_UpdaterDialog
 
 
 logger = logging.getLogger(__name__)
 
+# Interval (in milliseconds) at which the progress bar is advanced from the
+# estimated progress of the update run between progress signals
+PROGRESS_POLL_INTERVAL = 1000
 
-def launch_securedrop_client():
-    """
-    Helper function to launch the SecureDrop Client
-    """
-    try:
-        logger.info("Launching SecureDrop client")
-        subprocess.Popen(["qvm-run", "sd-app", "gtk-launch securedrop-client"])
-    except subprocess.CalledProcessError as e:
-        logger.error("Error while launching SecureDrop client")
-        logger.error(str(e))
-    sys.exit(0)
+# Range of the progress bar covered by the estimated progress of the update run
+PROGRESS_START = 5
+PROGRESS_END = 95
 
 
 class UpdaterApp(QDialog, Ui_UpdaterDialog):
@@ -68,6 +63,10 @@ class UpdaterApp(QDialog, Ui_UpdaterDialog):
         self.progressBar.setProperty("value", self.progress)
         self.progressBar.hide()
 
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setInterval(PROGRESS_POLL_INTERVAL)
+        self.progress_timer.timeout.connect(self.poll_progress)
+
     @pyqtSlot(dict)
     def upgrade_status(self, result):
         """
@@ -75,7 +74,9 @@ class UpdaterApp(QDialog, Ui_UpdaterDialog):
         is used to check for TemplateVM upgrades
         """
         logger.info("Signal: upgrade_status {}".format(str(result)))
+        self.progress_timer.stop()
         self.progress = 100
+        self.progressBar.setFormat("%p%")
         self.progressBar.setProperty("value", self.progress)
 
         if result["recommended_action"] == UpdateStatus.REBOOT_REQUIRED:
@@ -115,16 +116,38 @@ class UpdaterApp(QDialog, Ui_UpdaterDialog):
             current_progress = 100
 
         logger.info("Signal: Progress {}%".format(current_progress))
-        self.progress = current_progress
+        self.progress = max(self.progress, current_progress)
         self.progressBar.setProperty("value", self.progress)
 
+    def poll_progress(self):
+        """
+        Advances the progress bar from the estimated progress of the
+        UpgradeThread, and shows the estimated time remaining.
+        """
+        estimator = self.upgrade_thread.estimator
+        estimate = get_progress_value(estimator.progress())
+        self.progress = max(self.progress, estimate)
+        self.progressBar.setProperty("value", self.progress)
+
+        remaining = estimator.remaining()
+        if remaining is None:
+            self.progressBar.setFormat(strings.progress_taking_longer)
+        elif remaining < 60:
+            self.progressBar.setFormat(strings.progress_eta_less_than_a_minute)
+        else:
+            minutes = int(round(remaining / 60))
+            if minutes == 1:
+                self.progressBar.setFormat(strings.progress_eta_one_minute)
+            else:
+                self.progressBar.setFormat(strings.progress_eta.format(minutes))
+
     def apply_all_updates(self):
         """
         Method used by the applyUpdatesButton that will create and start an
         UpgradeThread to apply updates to TemplateVMs
         """
         logger.info("Starting UpgradeThread")
-        self.progress = 5
+        self.progress = PROGRESS_START
         self.progressBar.setProperty("value", self.progress)
         self.progressBar.show()
         self.headline.setText(strings.headline_applying_updates)
@@ -136,6 +159,7 @@ class UpdaterApp(QDialog, Ui_UpdaterDialog):
         self.upgrade_thread.start()
         self.upgrade_thread.upgrade_signal.connect(self.upgrade_status)
         self.upgrade_thread.progress_signal.connect(self.update_progress_bar)
+        self.progress_timer.start()
 
     def reboot_workstation(self):
         """
@@ -170,42 +194,87 @@ class UpgradeThread(QThread):
 
     def __init__(self):
         QThread.__init__(self)
+        # Estimates progress from the durations of previous runs, and is also
+        # polled by UpdaterApp to advance the progress bar between signals
+        self.estimator = Updater.ProgressEstimator()
 
-    def run(self):
+    def emit_progress(self):
+        self.progress_signal.emit(get_progress_value(self.estimator.progress()))
 
-        # Update dom0 first, then apply dom0 state. If full state run
-        # is required, the dom0 state will drop a flag.
-        self.progress_signal.emit(5)
-        upgrade_generator = Updater.apply_updates(vms=["dom0"], progress_start=5, progress_end=10)
+    def complete_state(self, state_id, result):
+        """
+        Called as each Salt state completes, possibly from another thread.
+        """
+        self.estimator.complete_state(state_id, result)
+        self.emit_progress()
+
+    def run(self):
+        # Phase durations are written to the timing log at the end of the run
+        timer = Util.PhaseTimer()
+
+        # Let a background pre-fetch finish first, so that it does not manage
+        # the same VMs as this update. If it takes too long, e.g. because Tor
+        # is slow, the update goes ahead without its result.
+        if not Util.wait_for_lock(
+            Updater.PREFETCH_LOCK_FILE, timeout=Updater.PREFETCH_WAIT_TIMEOUT
+        ):
+            logger.warning("Continuing without waiting for the pre-fetch of updates")
+        timer.mark("wait_for_prefetch")
+
+        # Update dom0 first, then apply dom0 state. Whether a full state run
+        # is required is checked in between, with the updated migration rules.
+        self.estimator.start_phase("dom0_update", vms=["dom0"])
+        self.emit_progress()
+        upgrade_generator = Updater.apply_updates(vms=["dom0"])
 
         results = {}
         for vm, progress, result in upgrade_generator:
             results[vm] = result
-            self.progress_signal.emit(progress)
+            self.estimator.complete_vm(vm)
+            self.emit_progress()
+        timer.mark("dom0_update")
+
+        # Check whether the full config must be reapplied before applying the
+        # dom0 state, which removes outdated VMs
+        migration_reasons = Updater.get_migration_reasons()
 
         # apply dom0 state
-        self.progress_signal.emit(10)
-        result = Updater.apply_dom0_state()
+        self.estimator.start_phase("dom0_state")
+        self.emit_progress()
+        result = Updater.apply_dom0_state(on_state=self.complete_state)
         # add to results dict, if it fails it will show error message
         results["apply_dom0"] = result.value
+        timer.mark("dom0_state")
 
-        self.progress_signal.emit(15)
-        # rerun full config if dom0 checks determined it's required,
+        # rerun full config if migration checks determined it's required,
         # otherwise proceed with per-VM package updates
-        if Updater.migration_is_required():
-            # Progress bar will freeze for ~15m during full state run
-            self.progress_signal.emit(35)
-            Updater.run_full_install()
-            self.progress_signal.emit(75)
+        if migration_reasons:
+            self.estimator.replace_phase("template_updates", "full_install")
+            self.estimator.start_phase("full_install")
+            self.emit_progress()
+            Updater.run_full_install(on_state=self.complete_state)
+            # The full state run may have changed any VM
+            changed_templates = None
+            timer.mark("full_install")
         else:
-            upgrade_generator = Updater.apply_updates(progress_start=15, progress_end=75)
+            self.estimator.start_phase("template_updates", vms=Updater.current_templates)
+            self.emit_progress()
+            upgrade_generator = Updater.apply_template_updates(on_state=self.complete_state)
             for vm, progress, result in upgrade_generator:
                 results[vm] = result
-                self.progress_signal.emit(progress)
-
-        # reboot vms
-        Updater.shutdown_and_start_vms()
-
+                self.estimator.complete_vm(vm)
+                self.emit_progress()
+            changed_templates = Updater.get_changed_templates()
+            timer.mark("template_updates")
+
+        # reboot vms whose TemplateVMs have changed
+        self.estimator.start_phase("power_cycle")
+        self.emit_progress()
+        Updater.shutdown_and_start_vms(changed_templates=changed_templates)
+        timer.mark("power_cycle")
+
+        self.estimator.start_phase("status_flags")
+        self.emit_progress()
         # write flags to disk
         run_results = Updater.overall_update_status(results)
         Updater._write_updates_status_flag_to_disk(run_results)
@@ -213,7 +282,17 @@ class UpgradeThread(QThread):
         # after applying upgrades, regardless of whether a reboot is still pending.
         if run_results in {UpdateStatus.UPDATES_OK, UpdateStatus.REBOOT_REQUIRED}:
             Updater._write_last_updated_flags_to_disk()
+        timer.mark("status_flags")
+        Updater.write_update_timing(timer, run_results, self.estimator.get_state_counts())
         # populate signal results
         message = results  # copy all information from updater call
         message["recommended_action"] = run_results
         self.upgrade_signal.emit(message)
+
+
+def get_progress_value(fraction):
+    """
+    Returns the progress bar value for the given estimated progress (0.0 to
+    1.0) of an update run.
+    """
+    return PROGRESS_START + int((PROGRESS_END - PROGRESS_START) * fraction)
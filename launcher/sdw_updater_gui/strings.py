@@ -17,6 +17,12 @@ description_status_applying_updates = (
     "The screensaver will not affect it.</p>"
 )
 
+# Progress bar formats while updates are in progress; "%p%" is the percentage
+progress_eta = "%p% (about {} minutes remaining)"
+progress_eta_one_minute = "%p% (about 1 minute remaining)"
+progress_eta_less_than_a_minute = "%p% (less than a minute remaining)"
+progress_taking_longer = "%p% (taking longer than usual, please wait)"
+
 headline_status_updates_complete = "All updates complete!"
 description_status_updates_complete = (
     "Click <em>Continue</em> to launch the SecureDrop Client. No reboot is necessary."
@@ -0,0 +1,40 @@
+"""
+Names and location of the lock files of the launcher, updater and notifier.
+Only the standard library is imported here, so that a process can check a
+lock before loading anything else.
+"""
+
+import fcntl
+import os
+
+# Directory for lock files to avoid contention or multiple instantiation.
+LOCK_DIRECTORY = os.path.join("/run/user", str(os.getuid()))
+
+# Held by the launcher and updater while they run
+LAUNCHER_LOCK_FILE = "sdw-launcher.lock"
+
+# Held by a background pre-fetch of TemplateVM updates
+PREFETCH_LOCK_FILE = "sdw-prefetch.lock"
+
+# Held by the notifier, to ensure it only runs once
+NOTIFY_LOCK_FILE = "sdw-notify.lock"
+
+
+def is_lock_held(basename):
+    """
+    Returns True if the given lock file in LOCK_DIRECTORY is held by another
+    process, without logging anything. Returns False if the lock file does not
+    exist or cannot be read, leaving errors to be reported when it is obtained.
+    """
+    try:
+        lh = open(os.path.join(LOCK_DIRECTORY, basename), "r")
+    except OSError:
+        return False
+
+    with lh:
+        try:
+            # Obtain a nonblocking, shared lock
+            fcntl.lockf(lh, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return True
+    return False
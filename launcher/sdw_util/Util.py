@@ -2,56 +2,194 @@
 Utility functions used by both the launcher and notifier scripts
 """
 
+import atexit
 import fcntl
+import json
 import os
 import logging
-import subprocess
+import queue
+import re
+import tempfile
+import threading
+import time
 
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from sdw_util import Lock
 
 # The directory where status files and logs are stored
 BASE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".securedrop_launcher")
 
 # Directory for lock files to avoid contention or multiple instantiation.
-LOCK_DIRECTORY = os.path.join("/run/user", str(os.getuid()))
+LOCK_DIRECTORY = Lock.LOCK_DIRECTORY
 
 # Folder where logs are stored
 LOG_DIRECTORY = os.path.join(BASE_DIRECTORY, "logs")
 
+# Log of timing records (one JSON object per line), in LOG_DIRECTORY
+TIMING_LOG_FILE = "timing.jsonl"
+
+# Number of most recent records kept in the timing log, i.e., about 100 runs
+# of the updater
+TIMING_LOG_MAX_RECORDS = 2000
+
+# Versioned status record shared by the launcher, updater and notifier
+STATUS_FILE = os.path.join(BASE_DIRECTORY, "sdw-status.json")
+STATUS_VERSION = 1
+
+# Files that held the status before STATUS_FILE was introduced. They are only
+# read if STATUS_FILE does not exist yet.
+LEGACY_STATUS_FILE = os.path.join(BASE_DIRECTORY, "sdw-update-status")
+LEGACY_LAST_UPDATED_FILE = os.path.join(BASE_DIRECTORY, "sdw-last-updated")
+
 # File that contains Qubes version information (overridden by tests)
 OS_RELEASE_FILE = "/etc/os-release"
 
+# Process table scanned for conflicting processes (overridden by tests)
+PROC_DIRECTORY = "/proc"
+
+# The kernel truncates process names (comm) to this many characters
+PROCESS_NAME_LENGTH = 15
+
+# Interval (in seconds) at which a lock is checked when waiting for it with a
+# timeout, see wait_for_lock()
+LOCK_POLL_INTERVAL = 1
+
 # Shared error string
 LOCK_ERROR = "Error obtaining lock on '{}'. Process may already be running."
 
 # Format for those logs
 LOG_FORMAT = "%(asctime)s - %(name)s:%(lineno)d(%(funcName)s) " "%(levelname)s: %(message)s"
 
+# Maximum number of log records waiting to be written when logging through a
+# queue. Records are dropped rather than blocking the caller when it is full.
+LOG_QUEUE_SIZE = 10000
+
 sdlog = logging.getLogger(__name__)
 
+# Thread writing queued log records, if logging through a queue
+_log_listener = None
+
+# Last status record read from or written to STATUS_FILE, along with the
+# identity of the file it corresponds to
+_status_cache = None
+_status_lock = threading.Lock()
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats log records as JSON objects, one per line, for consumers that
+    parse logs rather than read them.
+    """
 
-def configure_logging(log_file):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "line": record.lineno,
+            "function": record.funcName,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queues log records without ever blocking the caller. If the queue is full,
+    records are dropped, and the number of dropped records is logged once
+    there is room again.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord(
+                        {
+                            "name": __name__,
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": "Dropped {} log records".format(self.dropped),
+                        }
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BlockingStopQueueListener(QueueListener):
+    """
+    A QueueListener that waits for room in a full queue when stopping, rather
+    than failing, so that queued records are written before exiting.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def configure_logging(log_file, use_queue=False, json_format=False):
     """
     All logging related settings are set up by this function.
+
+    If `use_queue` is True, records are written to the log file by a
+    background thread, so that logging never blocks the caller on file I/O
+    (including rollover). If `json_format` is True, records are written as
+    JSON objects rather than in LOG_FORMAT.
     """
+    global _log_listener
 
     if not os.path.exists(LOG_DIRECTORY):
         os.makedirs(LOG_DIRECTORY)
 
-    formatter = logging.Formatter((LOG_FORMAT))
+    if json_format:
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter((LOG_FORMAT))
 
     handler = TimedRotatingFileHandler(os.path.join(LOG_DIRECTORY, log_file))
     handler.setFormatter(formatter)
     handler.setLevel(logging.INFO)
 
+    if use_queue:
+        stop_log_listener()
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _log_listener = BlockingStopQueueListener(log_queue, handler, respect_handler_level=True)
+        _log_listener.start()
+        atexit.register(stop_log_listener)
+        handler = DroppingQueueHandler(log_queue)
+
     log = logging.getLogger()
     log.setLevel(logging.INFO)
     log.addHandler(handler)
 
 
-def obtain_lock(basename):
+def stop_log_listener():
+    """
+    Writes all queued log records and stops the thread writing them, if
+    logging through a queue.
+    """
+    global _log_listener
+
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def obtain_lock(basename, quiet=False):
     """
     Obtain an exclusive lock during the execution of this process.
+
+    If `quiet` is True, a lock held by another process is only logged at the
+    info level, for callers that expect this to happen routinely.
     """
     lock_file = os.path.join(LOCK_DIRECTORY, basename)
     try:
@@ -67,7 +205,10 @@ def obtain_lock(basename):
         # Obtain an exclusive, nonblocking lock
         fcntl.lockf(lh, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except IOError:
-        sdlog.error(LOCK_ERROR.format(lock_file))
+        if quiet:
+            sdlog.info(LOCK_ERROR.format(lock_file))
+        else:
+            sdlog.error(LOCK_ERROR.format(lock_file))
         return None
 
     return lh
@@ -98,21 +239,290 @@ def can_obtain_lock(basename):
     return True
 
 
+def wait_for_lock(basename, timeout=None):
+    """
+    Blocks until no other process holds an exclusive lock on a lockfile, i.e.,
+    until the associated process has finished, or until `timeout` seconds have
+    passed, if given. Returns True if the lock is not held (anymore), False if
+    the wait timed out.
+
+    `basename` is the basename of a lockfile situated in the LOCK_DIRECTORY.
+    """
+    lock_file = os.path.join(LOCK_DIRECTORY, basename)
+    try:
+        lh = open(lock_file, "r")
+    except FileNotFoundError:  # noqa: F821
+        # Process may not have run during this session, safe to continue
+        return True
+
+    with lh:
+        try:
+            fcntl.lockf(lh, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            sdlog.info("Waiting for lock on '{}' to be released".format(lock_file))
+
+        if timeout is None:
+            fcntl.lockf(lh, fcntl.LOCK_SH)
+            return True
+
+        # lockf() cannot time out, so the lock is polled instead
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                sdlog.warning(
+                    "Timed out after {} seconds waiting for lock on '{}'".format(timeout, lock_file)
+                )
+                return False
+            time.sleep(min(LOCK_POLL_INTERVAL, remaining))
+            try:
+                fcntl.lockf(lh, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                pass
+
+
 def is_conflicting_process_running(list):
     """
-    Check if any process of the given name is currently running. Aborts on the
-    first match.
+    Check if any process matching one of the given specs is currently running.
+    Aborts on the first match.
+
+    A spec is either the exact name of a process, or a tuple of the exact name
+    and a regular expression that must match somewhere in its command line
+    (with arguments separated by spaces). The process table is scanned once
+    for all specs, and command lines are only read for processes whose name
+    matches a spec with a regular expression.
     """
-    for name in list:
-        result = subprocess.run(
-            args=["pgrep", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-        if result.returncode == 0:
+    specs = []
+    for spec in list:
+        if isinstance(spec, str):
+            spec = (spec, None)
+        name, pattern = spec
+        specs.append((name, name[:PROCESS_NAME_LENGTH], re.compile(pattern) if pattern else None))
+
+    own_pid = str(os.getpid())
+    try:
+        pids = [pid for pid in os.listdir(PROC_DIRECTORY) if pid.isdigit() and pid != own_pid]
+    except OSError as e:
+        sdlog.error("Error listing processes")
+        sdlog.error(str(e))
+        return False
+
+    for pid in pids:
+        # Processes may exit at any time while we scan the process table
+        try:
+            with open(os.path.join(PROC_DIRECTORY, pid, "comm")) as f:
+                comm = f.read().rstrip("\n")
+        except OSError:
+            continue
+
+        cmdline = None
+        for name, truncated_name, pattern in specs:
+            if comm != truncated_name:
+                continue
+            if pattern is not None:
+                if cmdline is None:
+                    cmdline = _read_cmdline(pid)
+                if cmdline is None or not pattern.search(cmdline):
+                    continue
             sdlog.error("Conflicting process '{}' is currently running.".format(name))
             return True
     return False
 
 
+def _read_cmdline(pid):
+    """
+    Returns the command line of the given process, with arguments separated
+    by spaces, or None if it cannot be read.
+    """
+    try:
+        with open(os.path.join(PROC_DIRECTORY, pid, "cmdline"), "rb") as f:
+            cmdline = f.read()
+    except OSError:
+        return None
+    return cmdline.rstrip(b"\0").replace(b"\0", b" ").decode(errors="replace")
+
+
+def read_status():
+    """
+    Returns the status record as a dict, which is empty if no status has been
+    recorded yet. The status file is only read and parsed again if it has
+    changed since it was last read.
+    """
+    with _status_lock:
+        return dict(_read_status())
+
+
+def write_status(**changes):
+    """
+    Updates the given fields of the status record. The record is written to
+    a temporary file that then replaces the status file, so that readers never
+    see a partially written record, even if the system loses power.
+    """
+    global _status_cache
+    with _status_lock:
+        record = dict(_read_status())
+        record.update(changes)
+        record["version"] = STATUS_VERSION
+
+        status_directory = os.path.dirname(STATUS_FILE)
+        if not os.path.exists(status_directory):
+            os.makedirs(status_directory)
+
+        fd, temp_file = tempfile.mkstemp(dir=status_directory, prefix=".sdw-status-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(record, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, STATUS_FILE)
+        except Exception:
+            os.unlink(temp_file)
+            raise
+
+        # Persist the rename itself
+        directory_fd = os.open(status_directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+        _status_cache = (_get_status_file_identity(), record)
+
+
+def _get_status_file_identity():
+    stat = os.stat(STATUS_FILE)
+    return (STATUS_FILE, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _read_status():
+    """
+    Returns the cached status record, reading it from disk first if the status
+    file has changed. Must be called with _status_lock held.
+    """
+    global _status_cache
+    try:
+        identity = _get_status_file_identity()
+    except FileNotFoundError:  # noqa: F821
+        return _read_legacy_status()
+
+    if _status_cache is None or _status_cache[0] != identity:
+        try:
+            with open(STATUS_FILE, "r") as f:
+                record = json.load(f)
+            if not isinstance(record, dict) or not isinstance(record.get("version"), int):
+                raise ValueError("Status record has no version")
+        except (OSError, ValueError) as e:
+            sdlog.error("Error reading status file '{}'".format(STATUS_FILE))
+            sdlog.error(str(e))
+            record = {}
+        _status_cache = (identity, record)
+
+    return _status_cache[1]
+
+
+def _read_legacy_status():
+    """
+    Returns a status record assembled from the legacy status files.
+    """
+    record = {}
+    try:
+        with open(LEGACY_STATUS_FILE, "r") as f:
+            contents = json.load(f)
+        record.update(status=contents["status"], last_status_update=contents["last_status_update"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        with open(LEGACY_LAST_UPDATED_FILE, "r") as f:
+            record["last_updated"] = f.readline().strip()
+    except OSError:
+        pass
+
+    return record
+
+
+class PhaseTimer:
+    """
+    Measures the duration of consecutive phases of a process with a monotonic
+    clock. Each call to mark() ends the current phase and starts the next one.
+    """
+
+    def __init__(self, start=None):
+        self.start = time.monotonic() if start is None else start
+        self.phases = []
+        self._phase_start = self.start
+
+    def mark(self, phase):
+        """
+        Ends the phase with the given name, returning its duration in seconds.
+        """
+        now = time.monotonic()
+        duration = now - self._phase_start
+        self.phases.append((phase, duration))
+        self._phase_start = now
+        return duration
+
+    def total(self):
+        return self._phase_start - self.start
+
+    def summary(self):
+        """
+        Returns the phase durations as a string for logging, e.g.
+        "imports=0.412s lock=0.001s total=0.413s"
+        """
+        durations = ["{}={:.3f}s".format(phase, duration) for phase, duration in self.phases]
+        durations.append("total={:.3f}s".format(self.total()))
+        return " ".join(durations)
+
+
+def write_timing_records(records):
+    """
+    Appends the given timing records (dicts) to the timing log, keeping only
+    the most recent TIMING_LOG_MAX_RECORDS records. The log is replaced
+    atomically, so an interrupted write cannot corrupt any records.
+    """
+    if not os.path.exists(LOG_DIRECTORY):
+        os.makedirs(LOG_DIRECTORY)
+
+    timing_log = os.path.join(LOG_DIRECTORY, TIMING_LOG_FILE)
+    try:
+        with open(timing_log, "r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:  # noqa: F821
+        lines = []
+    lines.extend(json.dumps(record, sort_keys=True) for record in records)
+
+    fd, temp_file = tempfile.mkstemp(dir=LOG_DIRECTORY, prefix=".timing-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            for line in lines[-TIMING_LOG_MAX_RECORDS:]:
+                f.write(line + "\n")
+        os.replace(temp_file, timing_log)
+    except Exception:
+        os.unlink(temp_file)
+        raise
+
+
+def read_timing_records():
+    """
+    Returns all records in the timing log, skipping lines that cannot be
+    parsed, e.g. if a write was interrupted.
+    """
+    records = []
+    try:
+        with open(os.path.join(LOG_DIRECTORY, TIMING_LOG_FILE), "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:  # noqa: F821
+        pass
+    return records
+
+
 def get_qubes_version():
     """
     Helper function for checking the Qubes version. Returns None if not on Qubes.
@@ -0,0 +1,132 @@
+import os
+import pytest
+import time
+
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+
+relpath_destroy_vm = "../../scripts/destroy-vm"
+path_to_destroy_vm = os.path.join(os.path.dirname(os.path.abspath(__file__)), relpath_destroy_vm)
+destroy_vm = SourceFileLoader("DestroyVM", path_to_destroy_vm).load_module()
+
+
+class FakeDomains(dict):
+    """
+    Domains of a fake Qubes app, which records the VMs deleted from it. Deleting
+    a VM takes the given time, or fails with the given error.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.deleted = []
+        self.delays = {}
+        self.errors = {}
+
+    def __delitem__(self, name):
+        time.sleep(self.delays.get(name, 0))
+        if name in self.errors:
+            raise self.errors[name]
+        self.deleted.append(name)
+        super().__delitem__(name)
+
+
+def get_vm(name, template=None, netvm=None, default_dispvm=None, running=False):
+    vm = mock.MagicMock()
+    vm.name = name
+    vm.tags = [destroy_vm.SDW_DEFAULT_TAG]
+    vm.template = template
+    vm.netvm = netvm
+    vm.default_dispvm = default_dispvm
+    vm.is_running.return_value = running
+    return vm
+
+
+def get_app(vms):
+    app = mock.MagicMock()
+    app.domains = FakeDomains({vm.name: vm for vm in vms})
+    return app
+
+
+def test_destroy_vm():
+    vm = get_vm("sd-app", running=True)
+    app = get_app([vm])
+    with mock.patch.object(destroy_vm, "q", app, create=True):
+        destroy_vm.destroy_vm(vm)
+    vm.kill.assert_called_once_with()
+    assert app.domains.deleted == ["sd-app"]
+
+
+def test_destroy_vm_not_managed():
+    vm = get_vm("sys-net")
+    vm.tags = []
+    app = get_app([vm])
+    with mock.patch.object(destroy_vm, "q", app, create=True):
+        with pytest.raises(AssertionError):
+            destroy_vm.destroy_vm(vm)
+    assert app.domains.deleted == []
+
+
+def test_get_dependencies():
+    vm = get_vm("sd-app", template="sd-small-buster-template", netvm=None)
+    type(vm).default_dispvm = mock.PropertyMock(side_effect=destroy_vm.QubesException())
+    assert destroy_vm.get_dependencies(vm) == {"sd-small-buster-template"}
+
+
+def test_destroy_vms_dependents_first():
+    vms = [
+        get_vm("sd-app", default_dispvm="sd-viewer"),
+        get_vm("sd-viewer"),
+        get_vm("sd-proxy", template="sd-large-buster-template", netvm="sd-whonix"),
+        get_vm("sd-whonix", netvm="sys-whonix"),
+        get_vm("sd-large-buster-template"),
+    ]
+    app = get_app(vms)
+    # Without ordering, the VMs they use would be deleted first
+    app.domains.delays = {"sd-app": 0.1, "sd-proxy": 0.1}
+    with mock.patch.object(destroy_vm, "q", app, create=True):
+        destroy_vm.destroy_vms(vms)
+
+    deleted = app.domains.deleted
+    assert sorted(deleted) == sorted(vm.name for vm in vms)
+    assert deleted.index("sd-app") < deleted.index("sd-viewer")
+    assert deleted.index("sd-proxy") < deleted.index("sd-whonix")
+    assert deleted.index("sd-proxy") < deleted.index("sd-large-buster-template")
+
+
+def test_destroy_vms_failed_keeps_dependencies(capsys):
+    vms = [
+        get_vm("sd-app", default_dispvm="sd-viewer"),
+        get_vm("sd-viewer"),
+        get_vm("sd-proxy", template="sd-large-buster-template", netvm="sd-whonix"),
+        get_vm("sd-whonix", template="whonix-gw-15"),
+        get_vm("sd-large-buster-template"),
+        get_vm("whonix-gw-15"),
+    ]
+    app = get_app(vms)
+    error = destroy_vm.QubesException("Domain is in use")
+    app.domains.errors = {"sd-proxy": error}
+    with mock.patch.object(destroy_vm, "q", app, create=True):
+        with pytest.raises(destroy_vm.QubesException) as e:
+            destroy_vm.destroy_vms(vms)
+    assert e.value is error
+
+    # VMs that do not depend on the failed VM are still destroyed
+    assert sorted(app.domains.deleted) == ["sd-app", "sd-viewer"]
+    err = capsys.readouterr().err
+    assert "Error destroying VM 'sd-proxy': Domain is in use" in err
+    assert "Not destroying VMs in use: sd-large-buster-template, sd-whonix, whonix-gw-15" in err
+
+
+def test_destroy_vms_circular_dependency(capsys):
+    vms = [
+        get_vm("sd-app"),
+        get_vm("sd-proxy", netvm="sd-whonix"),
+        get_vm("sd-whonix", netvm="sd-proxy"),
+    ]
+    app = get_app(vms)
+    with mock.patch.object(destroy_vm, "q", app, create=True):
+        with pytest.raises(SystemExit) as e:
+            destroy_vm.destroy_vms(vms)
+    assert e.value.code == 1
+    assert app.domains.deleted == ["sd-app"]
+    assert "Not destroying VMs in use: sd-proxy, sd-whonix" in capsys.readouterr().err
@@ -0,0 +1,269 @@
+import os
+import pytest
+import time
+
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+
+relpath_handle_upgrade = "../../dom0/securedrop-handle-upgrade"
+path_to_handle_upgrade = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), relpath_handle_upgrade
+)
+handle_upgrade = SourceFileLoader("HandleUpgrade", path_to_handle_upgrade).load_module()
+
+
+class FakeDomains(dict):
+    """
+    Domains of a fake Qubes app, which records the VMs removed from it
+    """
+
+    def __init__(self, events, *args):
+        super().__init__(*args)
+        self.events = events
+
+    def __delitem__(self, name):
+        self.events.append(("remove", name))
+        super().__delitem__(name)
+
+
+class FakeDomain:
+    """
+    A running domain, which records when it is shut down or killed
+    """
+
+    def __init__(self, name, events, template=None, netvm=None):
+        self.name = name
+        self.template = template
+        self.netvm = netvm
+        self.running = True
+        self.events = events
+        self.delay = 0
+
+    def __str__(self):
+        return self.name
+
+    def is_running(self):
+        return self.running
+
+    def shutdown(self):
+        time.sleep(self.delay)
+        self.events.append(("shutdown", self.name))
+        self.running = False
+
+    def kill(self):
+        self.events.append(("kill", self.name))
+        self.running = False
+
+
+def get_app(vms):
+    """
+    Returns a fake Qubes app and a dict of its domains, given a dict mapping
+    the names of VMs to the names of their template and NetVM, along with the
+    list of events recorded by both.
+    """
+    events = []
+    domains = {
+        name: FakeDomain(name, events, template=template, netvm=netvm)
+        for name, (template, netvm) in vms.items()
+    }
+    app = mock.MagicMock()
+    app.default_dispvm = "sd-viewer"
+    app.domains = FakeDomains(events, domains)
+    return app, domains, events
+
+
+def index(events, event):
+    assert event in events
+    return events.index(event)
+
+
+@mock.patch("HandleUpgrade.wait_for_shutdown")
+def test_prepare(mocked_wait):
+    app, domains, events = get_app(
+        {
+            "sd-app": ("sd-app-buster-template", "sd-proxy"),
+            "sd-viewer": ("sd-viewer-buster-template", None),
+            "sd-devices-dvm": ("sd-devices-buster-template", None),
+            "sd-devices": ("sd-devices-dvm", None),
+            "sd-proxy": ("sd-large-buster-template", "sd-whonix"),
+            "sd-whonix": ("whonix-gw-14", "sys-whonix"),
+            "sys-whonix": ("whonix-gw-14", "sys-firewall"),
+            "sd-gpg": ("sd-small-buster-template", None),
+            "sd-log": ("sd-log-buster-template", None),
+            "sys-firewall": ("fedora-32", "sys-net"),
+        }
+    )
+    handle_upgrade.prepare(app, domains)
+
+    shutdowns = [event for event in events if event[0] in ["shutdown", "kill"]]
+    assert sorted(shutdowns) == [
+        ("kill", "sys-whonix"),
+        ("shutdown", "sd-app"),
+        ("shutdown", "sd-devices"),
+        ("shutdown", "sd-devices-dvm"),
+        ("shutdown", "sd-log"),
+        ("shutdown", "sd-proxy"),
+        ("shutdown", "sd-viewer"),
+        ("shutdown", "sd-whonix"),
+    ]
+    assert mocked_wait.call_count == len(shutdowns)
+
+    # sd-log is shut down after all other VMs, as they would start it again
+    assert shutdowns[-1] == ("shutdown", "sd-log")
+
+    # VMs are shut down before their NetVM and template
+    assert index(events, ("shutdown", "sd-proxy")) < index(events, ("shutdown", "sd-whonix"))
+    assert index(events, ("shutdown", "sd-whonix")) < index(events, ("kill", "sys-whonix"))
+    assert index(events, ("shutdown", "sd-devices")) < index(events, ("shutdown", "sd-devices-dvm"))
+
+    # VMs are removed after all VMs have been shut down, and before their template
+    removals = [event for event in events if event[0] == "remove"]
+    assert sorted(removals) == [
+        ("remove", "sd-devices"),
+        ("remove", "sd-devices-dvm"),
+        ("remove", "sd-viewer"),
+    ]
+    assert events == shutdowns + removals
+    assert removals.index(("remove", "sd-devices")) < removals.index(("remove", "sd-devices-dvm"))
+    assert app.default_dispvm == ""
+
+
+@mock.patch("HandleUpgrade.wait_for_shutdown")
+def test_prepare_up_to_date(mocked_wait):
+    app, domains, events = get_app(
+        {
+            "sd-app": ("sd-small-buster-template", "sd-proxy"),
+            "sd-viewer": ("sd-large-buster-template", None),
+            "sd-proxy": ("sd-large-buster-template", "sd-whonix"),
+            "sd-whonix": ("whonix-gw-15", "sys-whonix"),
+            "sys-whonix": ("whonix-gw-15", "sys-firewall"),
+            "sd-log": ("sd-small-buster-template", None),
+        }
+    )
+    handle_upgrade.prepare(app, domains)
+
+    assert events == []
+    assert not mocked_wait.called
+    assert app.default_dispvm == "sd-viewer"
+
+
+@mock.patch("HandleUpgrade.wait_for_shutdown")
+def test_shutdown_vm_not_running(mocked_wait):
+    app, domains, events = get_app({"sys-whonix": ("whonix-gw-14", None)})
+    domains["sys-whonix"].running = False
+    handle_upgrade.shutdown_vm(domains["sys-whonix"])
+
+    assert events == []
+    assert not mocked_wait.called
+
+
+@mock.patch("HandleUpgrade.wait_for_shutdown")
+def test_remove(mocked_wait):
+    app, domains, events = get_app(
+        {
+            "sd-app-buster-template": (None, None),
+            "sd-log-buster-template": (None, None),
+            "sd-small-buster-template": (None, None),
+            "sd-app": ("sd-small-buster-template", None),
+        }
+    )
+    domains["sd-log-buster-template"].running = False
+    handle_upgrade.remove(app, domains)
+
+    assert events[0] == ("shutdown", "sd-app-buster-template")
+    assert sorted(events[1:]) == [
+        ("remove", "sd-app-buster-template"),
+        ("remove", "sd-log-buster-template"),
+    ]
+    mocked_wait.assert_called_once_with(domains["sd-app-buster-template"])
+    assert sorted(app.domains) == ["sd-app", "sd-small-buster-template"]
+
+
+@mock.patch("HandleUpgrade.wait_for_shutdown")
+def test_shutdown_and_remove_dependent_first(mocked_wait):
+    app, domains, events = get_app(
+        {
+            "sd-proxy": ("sd-large-buster-template", "sd-whonix"),
+            "sd-large-buster-template": (None, None),
+            "sd-whonix": ("whonix-gw-15", None),
+        }
+    )
+    # Without ordering, the template and NetVM would be shut down first
+    domains["sd-proxy"].delay = 0.1
+    vms = {"sd-proxy", "sd-large-buster-template", "sd-whonix"}
+    handle_upgrade.shutdown_and_remove(app, domains, vms, vms)
+
+    assert events[0] == ("shutdown", "sd-proxy")
+    assert sorted(events[1:3]) == [
+        ("shutdown", "sd-large-buster-template"),
+        ("shutdown", "sd-whonix"),
+    ]
+    assert events[3] == ("remove", "sd-proxy")
+    assert sorted(events[4:]) == [
+        ("remove", "sd-large-buster-template"),
+        ("remove", "sd-whonix"),
+    ]
+
+
+def test_get_dependents():
+    app, domains, events = get_app(
+        {
+            "sd-proxy": ("sd-large-buster-template", "sd-whonix"),
+            "sd-whonix": ("whonix-gw-14", "sys-whonix"),
+            "sd-log": ("sd-small-buster-template", None),
+            "sd-large-buster-template": (None, None),
+        }
+    )
+    names = ["sd-proxy", "sd-whonix", "sd-log", "sd-large-buster-template"]
+    assert handle_upgrade.get_dependents(domains, names) == {
+        "sd-proxy": set(),
+        "sd-whonix": {"sd-proxy"},
+        "sd-log": {"sd-proxy", "sd-whonix", "sd-large-buster-template"},
+        "sd-large-buster-template": {"sd-proxy"},
+    }
+
+
+def test_get_dependents_reference_error():
+    app, domains, events = get_app({"sd-proxy": (None, None), "sd-whonix": (None, None)})
+    with mock.patch.object(
+        FakeDomain, "netvm", new_callable=mock.PropertyMock, create=True
+    ) as mocked_netvm:
+        mocked_netvm.side_effect = handle_upgrade.QubesException()
+        dependents = handle_upgrade.get_dependents(domains, ["sd-proxy", "sd-whonix"])
+    assert dependents == {"sd-proxy": set(), "sd-whonix": set()}
+
+
+def test_run_in_order_circular_dependency(capsys):
+    action = mock.MagicMock()
+    domains = {"sd-proxy": "sd-proxy", "sd-whonix": "sd-whonix", "sd-app": "sd-app"}
+    dependents = {"sd-proxy": {"sd-whonix"}, "sd-whonix": {"sd-proxy"}, "sd-app": set()}
+    with handle_upgrade.ThreadPoolExecutor() as executor:
+        with pytest.raises(SystemExit) as e:
+            handle_upgrade.run_in_order(executor, action, domains, dependents)
+    assert e.value.code == 1
+
+    # VMs that are not part of the cycle are still handled
+    action.assert_called_once_with("sd-app")
+    assert "Circular dependency between sd-proxy, sd-whonix" in capsys.readouterr().out
+
+
+def test_run_in_order_error(capsys):
+    action = mock.MagicMock(side_effect=[RuntimeError("timed out")])
+    domains = {"sd-proxy": "sd-proxy", "sd-whonix": "sd-whonix"}
+    dependents = {"sd-proxy": set(), "sd-whonix": {"sd-proxy"}}
+    with handle_upgrade.ThreadPoolExecutor() as executor:
+        with pytest.raises(SystemExit) as e:
+            handle_upgrade.run_in_order(executor, action, domains, dependents)
+    assert e.value.code == 1
+
+    # The NetVM is not handled if its dependent failed
+    action.assert_called_once_with("sd-proxy")
+    assert "Error handling sd-proxy: timed out" in capsys.readouterr().err
+
+
+def test_main_invalid_task(capsys):
+    with mock.patch("sys.argv", ["securedrop-handle-upgrade", "upgrade"]):
+        with pytest.raises(SystemExit) as e:
+            handle_upgrade.main()
+    assert e.value.code == 1
+    assert "Please specify prepare or remove" in capsys.readouterr().out
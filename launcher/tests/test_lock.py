@@ -0,0 +1,76 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+from tempfile import TemporaryDirectory
+
+relpath_lock = "../sdw_util/Lock.py"
+path_to_lock = os.path.join(os.path.dirname(os.path.abspath(__file__)), relpath_lock)
+lock = SourceFileLoader("Lock", path_to_lock).load_module()
+
+relpath_notify_script = "../sdw-notify.py"
+path_to_notify_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), relpath_notify_script
+)
+notify_script = SourceFileLoader("NotifyScript", path_to_notify_script).load_module()
+
+# Holds an exclusive lock on the given file until stdin is closed
+HOLD_LOCK_SCRIPT = """
+import fcntl, sys
+lh = open(sys.argv[1], "w")
+fcntl.lockf(lh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+print("locked", flush=True)
+sys.stdin.read()
+"""
+
+
+def hold_lock(lock_directory, basename):
+    """
+    Returns a process holding the given lock, which is released when its stdin
+    is closed. fcntl locks are per process, so this process cannot hold it.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-c", HOLD_LOCK_SCRIPT, os.path.join(lock_directory, basename)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert process.stdout.readline() == "locked\n"
+    return process
+
+
+def release_lock(process):
+    process.stdin.close()
+    process.stdout.close()
+    process.wait()
+
+
+def test_lock_is_held():
+    with TemporaryDirectory() as tmpdir, mock.patch("Lock.LOCK_DIRECTORY", tmpdir):
+        basename = "test-lock-is-held.lock"
+        assert lock.is_lock_held(basename) is False
+
+        process = hold_lock(tmpdir, basename)
+        try:
+            assert lock.is_lock_held(basename) is True
+        finally:
+            release_lock(process)
+        assert lock.is_lock_held(basename) is False
+
+
+@mock.patch("sdw_util.Util.configure_logging")
+def test_notifier_daemon_exits_quietly_if_running(mocked_logging):
+    with TemporaryDirectory() as tmpdir, mock.patch.object(
+        notify_script.Lock, "LOCK_DIRECTORY", tmpdir
+    ):
+        process = hold_lock(tmpdir, lock.NOTIFY_LOCK_FILE)
+        try:
+            with pytest.raises(SystemExit) as e:
+                notify_script.main(["--daemon"])
+        finally:
+            release_lock(process)
+    assert e.value.code == 0
+    assert not mocked_logging.called
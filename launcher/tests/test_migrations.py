@@ -0,0 +1,94 @@
+import os
+import pytest
+import subprocess
+
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+
+relpath_migrations = "../sdw_updater_gui/Migrations.py"
+path_to_migrations = os.path.join(os.path.dirname(os.path.abspath(__file__)), relpath_migrations)
+migrations = SourceFileLoader("Migrations", path_to_migrations).load_module()
+
+Domain = migrations.Domain
+MigrationReason = migrations.MigrationReason
+
+
+class FakeVM(object):
+    def __init__(self, name, klass, tags):
+        self.name = name
+        self.klass = klass
+        self.tags = tags
+
+    @property
+    def template(self):
+        raise AssertionError("Reading the template of a VM requires a call to qubesd")
+
+
+def test_get_domains_via_admin_api():
+    app = mock.MagicMock()
+    app.domains = [
+        FakeVM("dom0", "AdminVM", []),
+        FakeVM("sd-app", "AppVM", ["sd-workstation", "sd-client"]),
+        FakeVM("sd-small-buster-template", "TemplateVM", ["sd-workstation"]),
+    ]
+    assert migrations.get_domains(app) == [
+        Domain("sd-app", "AppVM", {"sd-workstation", "sd-client"}),
+        Domain("sd-small-buster-template", "TemplateVM", {"sd-workstation"}),
+    ]
+
+
+@mock.patch("subprocess.check_output")
+def test_get_domains_via_qvm_ls(mocked_output):
+    mocked_output.return_value = (
+        "dom0|AdminVM|\n"
+        "sd-app|AppVM|sd-client,sd-workstation\n"
+        "sd-small-buster-template|TemplateVM|sd-workstation\n"
+        "sys-net|AppVM|\n"
+    )
+    assert migrations.get_domains() == [
+        Domain("sd-app", "AppVM", {"sd-workstation", "sd-client"}),
+        Domain("sd-small-buster-template", "TemplateVM", {"sd-workstation"}),
+        Domain("sys-net", "AppVM", set()),
+    ]
+    mocked_output.assert_called_once_with(
+        ["qvm-ls", "--raw-data", "--fields", "NAME,CLASS,TAGS"], universal_newlines=True
+    )
+
+
+@mock.patch("subprocess.check_output", side_effect=subprocess.CalledProcessError(1, "qvm-ls"))
+def test_get_domains_via_qvm_ls_fails(mocked_output):
+    with pytest.raises(subprocess.CalledProcessError):
+        migrations.get_domains()
+
+
+@pytest.mark.parametrize(
+    "name,tags,required",
+    [
+        ("sd-app-buster-template", {"sd-workstation"}, True),
+        ("sd-svs-disp-template", {"sd-workstation"}, True),
+        ("sd-small-buster-template", {"sd-workstation"}, False),
+        ("sd-large-buster-template", {"sd-workstation"}, False),
+        ("sd-app-buster-template", set(), False),
+        ("fedora-32", {"sd-workstation"}, False),
+    ],
+)
+def test_template_consolidation(name, tags, required):
+    domains = [Domain(name, "TemplateVM", tags)]
+    reasons = migrations.get_migration_reasons(domains)
+    if required:
+        assert reasons == [MigrationReason("template-consolidation", [name])]
+    else:
+        assert reasons == []
+
+
+def test_migration_rule_registration():
+    with mock.patch.object(migrations, "MIGRATION_RULES", []):
+
+        @migrations.migration_rule("sd-app-networked")
+        def _get_networked_vms(domains):
+            return [domain.name for domain in domains if domain.name == "sd-app"]
+
+        domains = [Domain("sd-app", "AppVM", set()), Domain("sd-log", "AppVM", set())]
+        assert migrations.get_migration_reasons(domains) == [
+            MigrationReason("sd-app-networked", ["sd-app"])
+        ]
@@ -18,7 +18,7 @@ updater = SourceFileLoader("Updater", path_to_updater).load_module()
 
 # Regex for warning log if the last-updated timestamp does not exist (updater
 # has never run)
-NO_TIMESTAMP_REGEX = r"Timestamp file '.*' does not exist."
+NO_TIMESTAMP_REGEX = r"Timestamp of last successful update not found in '.*'."
 
 # Regex for warning log if we've updated too long ago, and grace period has elapsed
 UPDATER_WARNING_REGEX = (
@@ -38,10 +38,23 @@ NO_WARNING_REGEX = (
     r"Last successful update \(.* hours ago\) is below the warning threshold " r"\(.* hours\)."
 )
 
-# Regex for bad contents in `sdw-last-updated` file
+# Regex for a bad last-updated timestamp in the status record
 BAD_TIMESTAMP_REGEX = r"Data in .* not in the expected format."
 
 
+def mock_status_files(tmpdir):
+    """
+    Points the status record and the legacy status files to the given
+    directory.
+    """
+    return mock.patch.multiple(
+        notify.Util,
+        STATUS_FILE=os.path.join(tmpdir, "sdw-status.json"),
+        LEGACY_STATUS_FILE=os.path.join(tmpdir, "sdw-update-status"),
+        LEGACY_LAST_UPDATED_FILE=os.path.join(tmpdir, "sdw-last-updated"),
+    )
+
+
 @mock.patch("Notify.sdlog.error")
 @mock.patch("Notify.sdlog.warning")
 @mock.patch("Notify.sdlog.info")
@@ -51,9 +64,7 @@ def test_warning_shown_if_updater_never_ran(mocked_info, mocked_warning, mocked_
     never run.
     """
     # We're going to look for a nonexistent file in an existing tmpdir
-    with TemporaryDirectory() as tmpdir, mock.patch(
-        "Notify.LAST_UPDATED_FILE", os.path.join(tmpdir, "not-a-file")
-    ):
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
 
         warning_should_be_shown = notify.is_update_check_necessary()
 
@@ -87,13 +98,10 @@ def test_warning_shown_if_warning_threshold_exceeded(
     threshold? Expected result varies based on whether system uptime exceeds
     a grace period (for the user to launch the app on their own).
     """
-    with TemporaryDirectory() as tmpdir, mock.patch(
-        "Notify.LAST_UPDATED_FILE", os.path.join(tmpdir, "sdw-last-updated")
-    ):
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
         # Write a "last successfully updated" date well in the past for check
         historic_date = datetime.date(2013, 6, 5).strftime(updater.DATE_FORMAT)
-        with open(notify.LAST_UPDATED_FILE, "w") as f:
-            f.write(historic_date)
+        notify.Util.write_status(last_updated=historic_date)
 
         with mock.patch("Notify.get_uptime_seconds") as mocked_uptime:
             mocked_uptime.return_value = uptime
@@ -123,13 +131,10 @@ def test_warning_not_shown_if_warning_threshold_not_exceeded(
     Another high priority case: we don't want to warn the user if they've
     recently run the updater successfully.
     """
-    with TemporaryDirectory() as tmpdir, mock.patch(
-        "Notify.LAST_UPDATED_FILE", os.path.join(tmpdir, "sdw-last-updated")
-    ):
-        # Write current timestamp into the file
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        # Write current timestamp into the status record
         just_now = datetime.datetime.now().strftime(updater.DATE_FORMAT)
-        with open(notify.LAST_UPDATED_FILE, "w") as f:
-            f.write(just_now)
+        notify.Util.write_status(last_updated=just_now)
         warning_should_be_shown = notify.is_update_check_necessary()
         assert warning_should_be_shown is False
         assert not mocked_error.called
@@ -143,15 +148,12 @@ def test_warning_not_shown_if_warning_threshold_not_exceeded(
 @mock.patch("Notify.sdlog.info")
 def test_corrupt_timestamp_file_handled(mocked_info, mocked_warning, mocked_error):
     """
-    The LAST_UPDATED_FILE must contain a timestamp in a specified format;
+    The status record must contain a timestamp in a specified format;
     if it doesn't, we show the warning and log the error.
     """
-    with TemporaryDirectory() as tmpdir, mock.patch(
-        "Notify.LAST_UPDATED_FILE", os.path.join(tmpdir, "sdw-last-updated")
-    ):
-        with open(notify.LAST_UPDATED_FILE, "w") as f:
-            # With apologies to HAL 9000
-            f.write("daisy, daisy, give me your answer do")
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        # With apologies to HAL 9000
+        notify.Util.write_status(last_updated="daisy, daisy, give me your answer do")
         warning_should_be_shown = notify.is_update_check_necessary()
         assert warning_should_be_shown is True
         mocked_error.assert_called_once()
@@ -159,6 +161,24 @@ def test_corrupt_timestamp_file_handled(mocked_info, mocked_warning, mocked_erro
         assert re.search(BAD_TIMESTAMP_REGEX, error_string) is not None
 
 
+@mock.patch("Notify.sdlog.error")
+@mock.patch("Notify.sdlog.warning")
+@mock.patch("Notify.sdlog.info")
+def test_legacy_timestamp_file_is_read(mocked_info, mocked_warning, mocked_error):
+    """
+    If the updater has not written a status record yet, the timestamp of the
+    last successful update is read from the legacy `sdw-last-updated` file.
+    """
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        just_now = datetime.datetime.now().strftime(updater.DATE_FORMAT)
+        with open(notify.Util.LEGACY_LAST_UPDATED_FILE, "w") as f:
+            f.write(just_now)
+        warning_should_be_shown = notify.is_update_check_necessary()
+        assert warning_should_be_shown is False
+        assert not mocked_error.called
+        assert not mocked_warning.called
+
+
 def test_uptime_is_sane():
     """
     Even in a CI container this should be greater than zero :-)
@@ -166,3 +186,106 @@ def test_uptime_is_sane():
     seconds = notify.get_uptime_seconds()
     assert isinstance(seconds, float)
     assert seconds > 0
+
+
+@pytest.mark.parametrize(
+    "updated_hours_ago,booted_hours_ago,due_in_hours",
+    [
+        # Updated recently: due once the warning threshold is reached
+        (1, 2, notify.WARNING_THRESHOLD / 3600 - 1),
+        # Updated long ago, but just booted: due once the grace period has elapsed
+        (1000, 0, notify.UPTIME_GRACE_PERIOD / 3600),
+        # Updated long ago, and grace period has elapsed: overdue since the boot
+        (1000, 2, notify.UPTIME_GRACE_PERIOD / 3600 - 2),
+    ],
+)
+def test_warning_deadline(updated_hours_ago, booted_hours_ago, due_in_hours):
+    now = datetime.datetime(2020, 6, 1, 12, 0, 0)
+    deadline = notify.get_warning_deadline(
+        now - datetime.timedelta(hours=updated_hours_ago),
+        now - datetime.timedelta(hours=booted_hours_ago),
+    )
+    assert deadline == now + datetime.timedelta(hours=due_in_hours)
+
+
+def test_warning_deadline_with_custom_thresholds():
+    last_updated = datetime.datetime(2020, 6, 1, 12, 0, 0)
+    boot_time = datetime.datetime(2020, 6, 1, 13, 0, 0)
+    assert notify.get_warning_deadline(
+        last_updated, boot_time, warning_threshold=600, grace_period=60
+    ) == datetime.datetime(2020, 6, 1, 13, 1, 0)
+
+
+def test_next_warning_time_from_status():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        notify.Util.write_status(last_updated="2020-06-01 12:00:00")
+        with mock.patch("Notify.get_uptime_seconds", return_value=60):
+            deadline = notify.get_next_warning_time()
+        expected = datetime.datetime(2020, 6, 1, 12, 0, 0) + datetime.timedelta(
+            seconds=notify.WARNING_THRESHOLD
+        )
+        # The grace period started less than a minute ago, so it is later
+        assert deadline > expected
+        assert deadline > datetime.datetime.now()
+
+
+@pytest.mark.parametrize("last_updated", [None, "not a timestamp"])
+def test_next_warning_time_without_valid_timestamp(last_updated):
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        if last_updated is not None:
+            notify.Util.write_status(last_updated=last_updated)
+        with mock.patch("Notify.get_uptime_seconds", return_value=60):
+            assert notify.get_next_warning_time() <= datetime.datetime.now()
+
+
+def test_status_file_watcher_detects_status_writes():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        watcher = notify.StatusFileWatcher()
+        try:
+            # Other files in the same directory are ignored
+            with open(os.path.join(tmpdir, "other-file"), "w") as f:
+                f.write("ignored")
+            soon = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+            assert watcher.wait(soon) is False
+            assert datetime.datetime.now() >= soon
+
+            notify.Util.write_status(last_updated="2020-01-01 00:00:00")
+            later = datetime.datetime.now() + datetime.timedelta(seconds=5)
+            assert watcher.wait(later) is True
+        finally:
+            watcher.close()
+
+
+def test_status_file_watcher_falls_back_to_sleeping():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        with mock.patch("ctypes.CDLL", side_effect=OSError()), mock.patch(
+            "Notify.sdlog.error"
+        ) as mocked_error:
+            watcher = notify.StatusFileWatcher()
+        mocked_error.assert_called_once()
+        # Sleeps are capped, since they do not account for suspend
+        next_week = datetime.datetime.now() + datetime.timedelta(days=7)
+        with mock.patch("time.sleep") as mocked_sleep:
+            assert watcher.wait(next_week) is False
+        mocked_sleep.assert_called_once_with(notify.WARNING_REPEAT_INTERVAL)
+
+
+@mock.patch("Notify.sdlog.info")
+def test_daemon_sleeps_until_warning_is_due(mocked_info):
+    """
+    The check only runs once a warning is due, and is then repeated every
+    WARNING_REPEAT_INTERVAL seconds while it remains due.
+    """
+    now = datetime.datetime.now()
+    next_week = now + datetime.timedelta(days=7)
+    watcher = mock.MagicMock()
+    check = mock.MagicMock(side_effect=[True, StopIteration()])
+    deadlines = [next_week, now, now]
+    with mock.patch("Notify.get_next_warning_time", side_effect=deadlines):
+        with pytest.raises(StopIteration):
+            notify.run_daemon(check, watcher)
+    assert check.call_count == 2
+    assert watcher.wait.call_count == 2
+    assert watcher.wait.call_args_list[0] == mock.call(next_week)
+    repeat_at = watcher.wait.call_args_list[1][0][0]
+    assert (repeat_at - now).total_seconds() >= notify.WARNING_REPEAT_INTERVAL
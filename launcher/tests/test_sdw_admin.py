@@ -0,0 +1,508 @@
+import io
+import os
+import pytest
+import subprocess
+
+from unittest import mock
+from unittest.mock import call
+from importlib.machinery import SourceFileLoader
+from tempfile import TemporaryDirectory
+
+relpath_admin = "../../scripts/sdw-admin.py"
+path_to_admin = os.path.join(os.path.dirname(os.path.abspath(__file__)), relpath_admin)
+admin = SourceFileLoader("SDWAdmin", path_to_admin).load_module()
+
+relpath_top_file = "../../dom0/sd-workstation.top"
+path_to_top_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), relpath_top_file)
+
+TOP_FILE = """base:
+  dom0:
+    - sd-dom0-files
+  # A comment
+  sd-app:
+    - sd-app-config
+
+  qubes:type:template:
+    - match: pillar
+    - topd
+  sd-log:
+    - sd-logging-setup
+"""
+
+
+def write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def salt_root():
+    with TemporaryDirectory() as tmpdir, mock.patch.object(admin, "SALT_ROOT", tmpdir):
+        yield tmpdir
+
+
+def test_get_top_targets():
+    targets = admin.get_top_targets(path_to_top_file)
+    assert targets["sd-proxy"] == ["sd-proxy-files", "sd-mime-handling"]
+    assert targets["sys-firewall"] == ["sd-sys-firewall-files"]
+    assert targets["dom0"][0] == "sd-sys-vms"
+    assert not any(":" in target for target in targets)
+    assert not any("topd" in states for states in targets.values())
+
+
+def test_get_top_targets_after_unsupported_target(salt_root):
+    top_file = os.path.join(salt_root, "sd-workstation.top")
+    write_file(top_file, TOP_FILE)
+    assert admin.get_top_targets(top_file) == {
+        "dom0": ["sd-dom0-files"],
+        "sd-app": ["sd-app-config"],
+        "sd-log": ["sd-logging-setup"],
+    }
+
+
+def test_get_referenced_paths(salt_root):
+    state = os.path.join(salt_root, "sd-app.sls")
+    write_file(
+        state,
+        '{% import_json "sd/config.json" as d %}\n'
+        "include:\n"
+        "  - sd-logging-setup\n"
+        "  - sd.sd-app-files\n"
+        "sd-app-config:\n"
+        "  file.managed:\n"
+        "    - source: salt://sd/sd-app/config.json.j2\n",
+    )
+    assert sorted(admin._get_referenced_paths(state)) == sorted(
+        [
+            os.path.join(salt_root, "sd/config.json"),
+            os.path.join(salt_root, "sd-logging-setup.sls"),
+            os.path.join(salt_root, "sd/sd-app-files.sls"),
+            os.path.join(salt_root, "sd/sd-app/config.json.j2"),
+        ]
+    )
+
+
+def test_get_referenced_paths_missing_file(salt_root):
+    assert admin._get_referenced_paths(os.path.join(salt_root, "missing.sls")) == []
+
+
+def test_get_state_fingerprints(salt_root):
+    write_file(os.path.join(salt_root, "sd-app.sls"), "include:\n  - sd-logging-setup\n")
+    write_file(
+        os.path.join(salt_root, "sd-logging-setup.sls"),
+        "config:\n  file.managed:\n    - source: salt://sd/logging/config.j2\n",
+    )
+    write_file(os.path.join(salt_root, "sd/logging/config.j2"), "v1")
+    write_file(os.path.join(salt_root, "sd-log.sls"), "log: {}\n")
+    targets = {"sd-app": ["sd-app"], "sd-log": ["sd-log"]}
+
+    fingerprints = admin.get_state_fingerprints(targets)
+    assert admin.get_state_fingerprints(targets) == fingerprints
+    assert fingerprints["sd-app"] != fingerprints["sd-log"]
+
+    # Changing a file installed by an included state only changes the fingerprint
+    # of the targets which include it
+    write_file(os.path.join(salt_root, "sd/logging/config.j2"), "v2")
+    changed_fingerprints = admin.get_state_fingerprints(targets)
+    assert changed_fingerprints["sd-app"] != fingerprints["sd-app"]
+    assert changed_fingerprints["sd-log"] == fingerprints["sd-log"]
+
+    # Unrelated files are not included
+    write_file(os.path.join(salt_root, "sd/other.j2"), "v1")
+    assert admin.get_state_fingerprints(targets) == changed_fingerprints
+
+
+def test_applied_fingerprints(salt_root):
+    applied_states_file = os.path.join(salt_root, "state", "applied-states.json")
+    with mock.patch.object(admin, "APPLIED_STATES_FILE", applied_states_file):
+        assert admin.read_applied_fingerprints() == {}
+        admin.write_applied_fingerprints({"sd-app": "abc"})
+        assert admin.read_applied_fingerprints() == {"sd-app": "abc"}
+
+        write_file(applied_states_file, "{")
+        assert admin.read_applied_fingerprints() == {}
+
+
+@mock.patch.object(admin.subprocess, "check_call")
+@mock.patch.object(admin, "apply_highstate", side_effect=lambda vms: set(vms))
+def test_provision_vms(mocked_apply, mocked_call):
+    calls = mock.MagicMock()
+    calls.attach_mock(mocked_apply, "apply_highstate")
+    calls.attach_mock(mocked_call, "check_call")
+    on_applied = mock.MagicMock()
+
+    admin.provision_vms(
+        ["sd-app", "sys-usb", "whonix-gw-15", "sd-log", "sd-small-buster-template"],
+        on_applied=on_applied,
+    )
+
+    assert calls.mock_calls == [
+        call.apply_highstate({"sd-log", "sd-small-buster-template"}),
+        call.check_call(["qvm-shutdown", "--wait", "sd-log"]),
+        call.check_call(["qvm-start", "sd-log"]),
+        call.apply_highstate({"whonix-gw-15"}),
+        call.check_call(["qvm-shutdown", "--wait", "whonix-gw-15"]),
+        call.apply_highstate({"sd-app"}),
+        call.apply_highstate({"sys-usb"}),
+    ]
+    assert on_applied.call_count == 4
+
+    # Each VM is provisioned exactly once
+    provisioned = [vm for c in mocked_apply.call_args_list for vm in c[0][0]]
+    assert sorted(provisioned) == sorted(set(provisioned))
+
+
+@mock.patch.object(admin.subprocess, "check_call")
+@mock.patch.object(admin, "apply_highstate", return_value=set())
+def test_provision_vms_fails(mocked_apply, mocked_call):
+    on_applied = mock.MagicMock()
+    with pytest.raises(admin.SDWAdminException):
+        admin.provision_vms(["sd-log", "sd-app"], on_applied=on_applied)
+    on_applied.assert_called_once_with(set())
+    assert not mocked_call.called
+
+
+def run_incremental(changed, created_vms=(), succeeded=None):
+    """
+    Runs apply_incremental() with the given targets changed, and returns the
+    mocks of the steps it runs and the fingerprints it recorded.
+    """
+    fingerprints = {
+        target: "new"
+        for target in ["dom0", "sys-firewall", "sd-log", "sd-app", "sd-proxy", "sd-viewer"]
+    }
+    applied = {target: "new" if target not in changed else "old" for target in fingerprints}
+    existing_vms = set(fingerprints) - {"dom0"} - set(created_vms)
+    written = []
+
+    steps = mock.MagicMock()
+
+    def provision_vms(vms, on_applied):
+        steps.provision_vms(vms)
+        on_applied(set(vms) if succeeded is None else succeeded)
+
+    with mock.patch.multiple(
+        admin,
+        get_top_targets=mock.DEFAULT,
+        get_state_fingerprints=mock.Mock(return_value=fingerprints),
+        read_applied_fingerprints=mock.Mock(return_value=applied),
+        write_applied_fingerprints=mock.Mock(side_effect=lambda f: written.append(dict(f))),
+        list_vms=mock.Mock(side_effect=[set(existing_vms), existing_vms | set(created_vms)]),
+        configure_sys_vms=steps.configure_sys_vms,
+        apply_sys_firewall_files=steps.apply_sys_firewall_files,
+        apply_dom0_highstate=steps.apply_dom0_highstate,
+        provision_vms=provision_vms,
+    ):
+        admin.apply_incremental()
+    return steps, written
+
+
+def test_apply_incremental_unchanged():
+    steps, written = run_incremental(changed=[])
+    assert steps.mock_calls == []
+    assert written == []
+
+
+def test_apply_incremental_vms():
+    steps, written = run_incremental(changed=["sd-app", "sd-log"])
+    assert steps.mock_calls == [call.provision_vms({"sd-app", "sd-log"})]
+    assert written[-1]["sd-app"] == "new"
+    assert written[-1]["sd-log"] == "new"
+
+
+def test_apply_incremental_sys_firewall():
+    steps, written = run_incremental(changed=["sys-firewall", "sd-app"])
+    assert steps.mock_calls == [call.apply_sys_firewall_files(), call.provision_vms({"sd-app"})]
+    assert written[-1]["sys-firewall"] == "new"
+
+
+def test_apply_incremental_dom0():
+    steps, written = run_incremental(changed=["dom0", "sd-app"], created_vms=["sd-viewer"])
+    # sys-firewall is configured along with the other system VMs, and VMs
+    # created by the dom0 highstate are provisioned
+    assert steps.mock_calls == [
+        call.configure_sys_vms(),
+        call.apply_dom0_highstate(),
+        call.provision_vms({"sd-app", "sd-viewer"}),
+    ]
+    assert written[0]["dom0"] == "new"
+    assert written[-1]["sd-viewer"] == "new"
+
+
+def test_apply_incremental_records_only_succeeded_vms():
+    steps, written = run_incremental(changed=["sd-app", "sd-proxy"], succeeded={"sd-proxy"})
+    assert written[-1]["sd-proxy"] == "new"
+    assert written[-1]["sd-app"] == "old"
+
+
+def test_apply_incremental_fails():
+    with mock.patch.multiple(
+        admin,
+        get_top_targets=mock.DEFAULT,
+        get_state_fingerprints=mock.Mock(return_value={"sys-firewall": "new"}),
+        read_applied_fingerprints=mock.Mock(return_value={}),
+        list_vms=mock.Mock(return_value={"sys-firewall"}),
+        apply_sys_firewall_files=mock.Mock(
+            side_effect=subprocess.CalledProcessError(1, "qubesctl")
+        ),
+        write_applied_fingerprints=mock.DEFAULT,
+    ) as mocks:
+        with pytest.raises(admin.SDWAdminException):
+            admin.apply_incremental()
+    assert not mocks["write_applied_fingerprints"].called
+
+
+XL_INFO_OUTPUT = """host                   : dom0
+release                : 5.4.88-1.qubes.x86_64
+total_memory           : 16250
+free_memory            : 6200
+sharing_freed_memory   : 0
+"""
+
+# Output of qubesctl for two VMs, one of which failed to start its management DispVM
+QUBESCTL_UNCLEAN_OUTPUT = """sd-app:
+  ----------
+            ID: sd-app-config
+      Result: True
+sd-log:
+  sd-log: Salt call 'state.highstate' did not return clean data.
+sd-app: OK
+sd-log: ERROR (exit code 20, details in /var/log/qubes/mgmt-sd-log.log)
+"""
+
+QUBESCTL_OK_OUTPUT = """sd-log:
+  ----------
+            ID: sd-logging-setup
+      Result: True
+sd-log: OK
+"""
+
+QUBESCTL_ERROR_OUTPUT = """sd-log:
+  ----------
+            ID: sd-logging-setup
+      Result: False
+sd-log: ERROR (exit code 20, details in /var/log/qubes/mgmt-sd-log.log)
+"""
+
+
+def qubesctl_process(output):
+    """
+    Returns a mock of a qubesctl process printing the given output.
+    """
+    process = mock.MagicMock()
+    process.stdout = io.StringIO(output)
+    return process
+
+
+@pytest.mark.parametrize(
+    "output,expected",
+    [
+        (XL_INFO_OUTPUT, 6200),
+        ("free_memory : unknown\n", None),
+        ("host : dom0\n", None),
+        (subprocess.CalledProcessError(1, "xl"), None),
+    ],
+)
+def test_get_available_memory(output, expected):
+    with mock.patch.object(admin.subprocess, "check_output", side_effect=[output]) as mocked_call:
+        assert admin.get_available_memory() == expected
+    mocked_call.assert_called_once_with(["sudo", "xl", "info"], universal_newlines=True)
+
+
+@pytest.mark.parametrize(
+    "memory,expected",
+    [(None, 2), (0, 2), (1536 * 2 - 1, 2), (6200, 4), (1536 * 20, admin.MAX_CONCURRENCY)],
+)
+def test_get_initial_concurrency(memory, expected):
+    with mock.patch.object(admin, "get_available_memory", return_value=memory):
+        assert admin.get_initial_concurrency() == expected
+
+
+@mock.patch.object(admin.sys, "stdout")
+@mock.patch.object(admin.subprocess, "Popen")
+def test_run_highstate(mocked_popen, mocked_stdout):
+    mocked_popen.return_value = qubesctl_process(QUBESCTL_UNCLEAN_OUTPUT)
+    assert admin.run_highstate({"sd-app", "sd-log"}, max_concurrency=2) == ({"sd-app"}, {"sd-log"})
+    assert mocked_popen.call_args[0][0] == [
+        "sudo",
+        "qubesctl",
+        "--show-output",
+        "--max-concurrency",
+        "2",
+        "--skip-dom0",
+        "--targets",
+        "sd-app,sd-log",
+        "state.highstate",
+    ]
+    # Output is printed as it is received
+    mocked_stdout.write.assert_any_call("sd-app: OK\n")
+
+
+@mock.patch.object(admin.sys, "stdout")
+@mock.patch.object(admin.subprocess, "Popen")
+def test_run_highstate_unattributed_unclean_data(mocked_popen, mocked_stdout):
+    mocked_popen.return_value = qubesctl_process(
+        "Salt call 'state.highstate' did not return clean data.\nsd-app: OK\n"
+    )
+    assert admin.run_highstate({"sd-app", "sd-log", "sd-gpg"}, max_concurrency=3) == (
+        {"sd-app"},
+        {"sd-log", "sd-gpg"},
+    )
+
+
+@mock.patch.object(admin.sys, "stdout")
+@mock.patch.object(admin, "get_initial_concurrency", return_value=4)
+@mock.patch.object(admin.subprocess, "Popen")
+def test_apply_highstate_retries_unclean_data(mocked_popen, mocked_concurrency, mocked_stdout):
+    mocked_popen.side_effect = [
+        qubesctl_process(QUBESCTL_UNCLEAN_OUTPUT),
+        qubesctl_process(QUBESCTL_OK_OUTPUT),
+    ]
+    assert admin.apply_highstate(["sd-app", "sd-log", "sd-gpg"]) == {"sd-app", "sd-log"}
+
+    # Only the VM that did not return clean data is retried, with half the concurrency
+    first_cmd, retry_cmd = [c[0][0] for c in mocked_popen.call_args_list]
+    assert first_cmd[first_cmd.index("--max-concurrency") + 1] == "3"
+    assert first_cmd[first_cmd.index("--targets") + 1] == "sd-app,sd-gpg,sd-log"
+    assert retry_cmd[retry_cmd.index("--max-concurrency") + 1] == "1"
+    assert retry_cmd[retry_cmd.index("--targets") + 1] == "sd-log"
+
+
+@mock.patch.object(admin.sys, "stdout")
+@mock.patch.object(admin, "get_initial_concurrency", return_value=8)
+@mock.patch.object(admin.subprocess, "Popen")
+def test_apply_highstate_stops_retrying(mocked_popen, mocked_concurrency, mocked_stdout):
+    mocked_popen.side_effect = lambda *args, **kwargs: qubesctl_process(
+        "sd-log: Salt call 'state.highstate' did not return clean data.\n"
+    )
+    assert admin.apply_highstate(["sd-log"]) == set()
+    assert mocked_popen.call_count == admin.CLEAN_DATA_RETRIES + 1
+
+
+@mock.patch.object(admin.sys, "stdout")
+@mock.patch.object(admin, "get_initial_concurrency", return_value=8)
+@mock.patch.object(admin.subprocess, "Popen")
+def test_apply_highstate_does_not_retry_errors(mocked_popen, mocked_concurrency, mocked_stdout):
+    mocked_popen.return_value = qubesctl_process(QUBESCTL_ERROR_OUTPUT)
+    assert admin.apply_highstate(["sd-log"]) == set()
+    assert mocked_popen.call_count == 1
+
+
+@mock.patch.object(admin, "provision_vms")
+@mock.patch.object(admin.subprocess, "check_output", return_value="sd-app\nsd-log\n")
+@mock.patch.object(admin.subprocess, "check_call")
+def test_provision_all(mocked_call, mocked_output, mocked_provision):
+    admin.provision_all()
+    assert mocked_call.call_args_list == [
+        call(["sudo", "qubesctl", "--show-output", "state.sls", "sd-sys-vms"]),
+        call(
+            [
+                "sudo",
+                "qubesctl",
+                "--show-output",
+                "--skip-dom0",
+                "--targets",
+                "sys-firewall",
+                "state.sls",
+                "sd-sys-firewall-files",
+            ]
+        ),
+        call(["sudo", "qubesctl", "--show-output", "state.highstate"]),
+    ]
+    mocked_provision.assert_called_once_with(
+        ["sd-log", "sd-small-buster-template", "whonix-gw-15", "sd-app", "sd-log", "sys-usb"]
+    )
+
+
+@mock.patch.object(admin, "provision_vms")
+@mock.patch.object(
+    admin.subprocess, "check_call", side_effect=subprocess.CalledProcessError(1, "qubesctl")
+)
+def test_provision_all_fails(mocked_call, mocked_provision):
+    with pytest.raises(admin.SDWAdminException):
+        admin.provision_all()
+    assert not mocked_provision.called
+
+
+def test_apply_twice_without_changes(capsys):
+    """
+    Applying unchanged configuration again neither synchronizes Salt nor
+    applies any states, even though the secret key can only be fingerprinted
+    by its modification time.
+    """
+    with TemporaryDirectory() as tmpdir:
+        scripts_path = os.path.join(tmpdir, "scripts")
+        salt_root = os.path.join(tmpdir, "salt")
+        state_path = os.path.join(tmpdir, "state")
+        salt_path = os.path.join(salt_root, "sd")
+        write_file(os.path.join(scripts_path, "config.json"), "{}")
+        write_file(os.path.join(scripts_path, "sd-journalist.sec"), "secret")
+        # The configuration was copied into place some time before
+        for name in ["config.json", "sd-journalist.sec"]:
+            os.utime(os.path.join(scripts_path, name), (1000000000, 1000000000))
+        write_file(
+            os.path.join(salt_root, "sd-workstation.top"),
+            "base:\n  dom0:\n    - sd-dom0-files\n  sd-gpg:\n    - sd-gpg-files\n",
+        )
+        write_file(
+            os.path.join(salt_root, "sd-dom0-files.sls"),
+            "{% import_json 'sd/config.json' as d %}\n",
+        )
+        write_file(
+            os.path.join(salt_root, "sd-gpg-files.sls"),
+            "key:\n  file.managed:\n    - source: salt://sd/sd-journalist.sec\n",
+        )
+        os.makedirs(salt_path)
+        os.makedirs(os.path.join(tmpdir, "cache"))
+
+        real_check_call = subprocess.check_call
+
+        def check_call(cmd):
+            # Run copies without sudo, and skip everything else
+            if cmd[:2] == ["sudo", "cp"]:
+                real_check_call(cmd[1:])
+
+        real_open = open
+        get_top_targets = admin.get_top_targets
+        provision_vms = mock.Mock(side_effect=lambda vms, on_applied: on_applied(set(vms)))
+
+        def open_as_user(path, *args, **kwargs):
+            # The secret key is only readable by root once copied into place
+            if path.startswith(salt_root) and path.endswith(".sec"):
+                raise PermissionError(path)
+            return real_open(path, *args, **kwargs)
+
+        with mock.patch.multiple(
+            admin,
+            SCRIPTS_PATH=scripts_path,
+            SALT_ROOT=salt_root,
+            SALT_PATH=salt_path,
+            get_top_targets=mock.Mock(
+                side_effect=lambda: get_top_targets(os.path.join(salt_root, "sd-workstation.top"))
+            ),
+            SALT_CACHE_PATH=os.path.join(tmpdir, "cache"),
+            SALT_SYNC_FILE=os.path.join(state_path, "salt-sync.json"),
+            APPLIED_STATES_FILE=os.path.join(state_path, "applied-states.json"),
+            list_vms=mock.Mock(return_value={"sd-gpg"}),
+            configure_sys_vms=mock.DEFAULT,
+            apply_dom0_highstate=mock.DEFAULT,
+            provision_vms=provision_vms,
+        ), mock.patch.object(
+            admin.subprocess, "check_call", side_effect=check_call
+        ) as mocked_call, mock.patch.object(
+            admin, "open", side_effect=open_as_user, create=True
+        ):
+            for run in range(2):
+                mocked_call.reset_mock()
+                provision_vms.reset_mock()
+                admin.copy_config()
+                admin.refresh_salt()
+                admin.apply_incremental()
+
+    # Only the copies are run the second time
+    assert [c[0][0][:2] for c in mocked_call.call_args_list] == [["sudo", "cp"]] * 2
+    assert not provision_vms.called
+    output = capsys.readouterr().out
+    assert "Salt files have not changed since Salt was last synchronized" in output
+    assert "Salt states have not changed since they were last applied" in output
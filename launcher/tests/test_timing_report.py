@@ -0,0 +1,81 @@
+import os
+import pytest
+
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+from tempfile import TemporaryDirectory
+
+relpath_report = "../sdw-timing-report.py"
+path_to_report = os.path.join(os.path.dirname(os.path.abspath(__file__)), relpath_report)
+report = SourceFileLoader("TimingReport", path_to_report).load_module()
+
+
+def make_records(runs):
+    """
+    Returns timing records for the given list of runs, each a dict mapping
+    (type, name) tuples to durations.
+    """
+    records = []
+    for run, durations in enumerate(runs):
+        for (kind, name), duration in sorted(durations.items()):
+            records.append(
+                {"run": "run-{}".format(run), "type": kind, "name": name, "duration": duration}
+            )
+    return records
+
+
+@pytest.mark.parametrize(
+    "values,p,expected",
+    [([5], 50, 5), ([3, 1, 2], 50, 2), ([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 90, 9), ([1, 2], 100, 2)],
+)
+def test_percentile(values, p, expected):
+    assert report.percentile(values, p) == expected
+
+
+def test_summarize():
+    records = make_records(
+        [
+            {("run", "total"): 100, ("phase", "dom0_update"): 10, ("vm", "fedora-32"): 60},
+            {("run", "total"): 200, ("phase", "dom0_update"): 30, ("vm", "fedora-32"): 40},
+            {("phase", "power_cycle"): 50, ("vm", "whonix-gw-15"): 20},
+        ]
+    )
+    assert report.summarize(records) == [
+        ("run", "total", 2, 100, 200, 200),
+        # Phases and VMs are ordered by the time they took in total
+        ("phase", "power_cycle", 1, 50, 50, 50),
+        ("phase", "dom0_update", 2, 10, 30, 30),
+        ("vm", "fedora-32", 2, 40, 60, 60),
+        ("vm", "whonix-gw-15", 1, 20, 20, 20),
+    ]
+
+
+@pytest.mark.parametrize(
+    "argv,runs,row",
+    [
+        ([], 3, "run total 3 200.0 300.0 300.0"),
+        (["--runs", "2"], 2, "run total 2 100.0 200.0 200.0"),
+        (["--runs", "5"], 3, "run total 3 200.0 300.0 300.0"),
+    ],
+)
+def test_main(capsys, argv, runs, row):
+    records = make_records([{("run", "total"): duration} for duration in [300, 100, 200]])
+    # Launcher timing records are not included
+    records.append({"run": "launch", "type": "launch", "name": "imports", "duration": 1.0})
+
+    with TemporaryDirectory() as tmpdir, mock.patch.object(report.Util, "LOG_DIRECTORY", tmpdir):
+        report.Util.write_timing_records(records)
+        report.main(argv)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Update timing over {} runs (seconds)".format(runs)
+    assert [line.split() for line in lines[1:]] == [
+        ["type", "name", "runs", "p50", "p90", "max"],
+        row.split(),
+    ]
+
+
+def test_main_without_records(capsys):
+    with TemporaryDirectory() as tmpdir, mock.patch.object(report.Util, "LOG_DIRECTORY", tmpdir):
+        report.main([])
+    assert capsys.readouterr().out == "No update timing has been recorded yet.\n"
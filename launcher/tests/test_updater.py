@@ -2,6 +2,9 @@ import json
 import os
 import pytest
 import subprocess
+import sys
+import threading
+import time
 from importlib.machinery import SourceFileLoader
 from datetime import datetime, timedelta
 from tempfile import TemporaryDirectory
@@ -16,6 +19,20 @@ from Updater import current_templates  # noqa: E402
 from Updater import current_vms  # noqa: E402
 
 temp_dir = TemporaryDirectory().name
+status_file = os.path.join(temp_dir, "sdw-status.json")
+
+
+def mock_status_files():
+    """
+    Points the status record and the legacy status files to temp_dir
+    """
+    return mock.patch.multiple(
+        updater.Util,
+        STATUS_FILE=status_file,
+        LEGACY_STATUS_FILE=os.path.join(temp_dir, "sdw-update-status"),
+        LEGACY_LAST_UPDATED_FILE=os.path.join(temp_dir, "sdw-last-updated"),
+    )
+
 
 debian_based_vms = [
     "sd-app",
@@ -137,7 +154,7 @@ def test_apply_updates_required(
         "fedora": UpdateStatus.UPDATES_OK,
         "sd-app": UpdateStatus.UPDATES_REQUIRED,
     }
-    calls = [call("fedora"), call("sd-app")]
+    calls = [call("fedora", on_state=None), call("sd-app", on_state=None)]
     apply_vm.assert_has_calls(calls)
 
     assert results == {
@@ -150,41 +167,226 @@ def test_apply_updates_required(
     assert not apply_dom0.called
 
 
+@mock.patch("Updater._apply_updates_vm")
+@mock.patch("Updater._apply_updates_dom0")
+@mock.patch("Updater._check_updates_dom0", return_value=UpdateStatus.UPDATES_OK)
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_apply_updates_concurrently(mocked_info, mocked_error, check_dom0, apply_dom0, apply_vm):
+    apply_vm.side_effect = lambda vm, on_state: (
+        UpdateStatus.UPDATES_FAILED if vm == "fedora-32" else UpdateStatus.UPDATES_OK
+    )
+    vms = ["dom0"] + sorted(current_templates)
+    upgrade_generator = updater.apply_updates(vms, 15, 75, max_workers=4)
+    results = {}
+    progress_values = []
+
+    for vm, progress, result in upgrade_generator:
+        results[vm] = result
+        progress_values.append(progress)
+
+    # dom0 is always handled first, outside of the worker pool
+    assert list(results.keys())[0] == "dom0"
+    assert results == {
+        "dom0": UpdateStatus.UPDATES_OK,
+        "fedora-32": UpdateStatus.UPDATES_FAILED,
+        "sd-large-buster-template": UpdateStatus.UPDATES_OK,
+        "sd-small-buster-template": UpdateStatus.UPDATES_OK,
+        "whonix-gw-15": UpdateStatus.UPDATES_OK,
+    }
+    assert progress_values == sorted(progress_values)
+    assert all(15 <= progress <= 75 for progress in progress_values)
+    check_dom0.assert_called_once_with()
+    assert not apply_dom0.called
+    apply_vm.assert_has_calls(
+        [call(vm, on_state=None) for vm in sorted(current_templates)], any_order=True
+    )
+    assert not mocked_error.called
+
+
+@mock.patch("Updater._template_changes", {"whonix-gw-15": True})
+@mock.patch("Updater._apply_updates_vm", return_value=UpdateStatus.UPDATES_OK)
+@mock.patch("Updater.sdlog.info")
+def test_apply_updates_clears_changes_of_previous_run(mocked_info, apply_vm):
+    list(updater.apply_updates(["fedora-32"]))
+    assert updater.get_changed_templates() == set()
+
+
+@mock.patch("Updater._apply_updates_vm", side_effect=[UpdateStatus.UPDATES_OK, OSError("boom")])
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_apply_updates_concurrently_unexpected_error(mocked_info, mocked_error, apply_vm):
+    upgrade_generator = updater.apply_updates(["fedora-32", "whonix-gw-15"], max_workers=2)
+    results = [result for vm, progress, result in upgrade_generator]
+
+    # An unexpected error in one worker must not prevent other results from being returned
+    assert sorted(results, key=lambda status: status.value) == [
+        UpdateStatus.UPDATES_OK,
+        UpdateStatus.UPDATES_FAILED,
+    ]
+    mocked_error.assert_has_calls([call("boom")])
+
+
+BATCHED_UPDATE_OUTPUT = """{
+    "fedora-32": {
+        "pkg_|-update_|-update_|-uptodate": {
+            "result": true,
+            "changes": {},
+            "duration": 1000.5
+        },
+        "cmd_|-notify-updates_|-/usr/lib/qubes/upgrades-status-notify_|-run": {
+            "result": true,
+            "changes": {"pid": 1234, "retcode": 0},
+            "duration": 500.0
+        }
+    }
+}
+{
+    "whonix-gw-15": {
+        "pkg_|-update_|-update_|-uptodate": {
+            "result": false,
+            "changes": {}
+        }
+    }
+}
+sd-small-buster-template: OK
+fedora-32: OK
+whonix-gw-15: ERROR (exception Command failed)
+"""
+
+
+@mock.patch("Updater._update_durations", {})
+@mock.patch("Updater._template_changes", {})
+def test_parse_batched_update_output():
+    vms = ["fedora-32", "whonix-gw-15", "sd-small-buster-template", "sd-large-buster-template"]
+    results = updater._parse_batched_update_output(BATCHED_UPDATE_OUTPUT, vms)
+    assert updater.get_changed_templates() >= {
+        "whonix-gw-15",
+        "sd-small-buster-template",
+        "sd-large-buster-template",
+    }
+    assert "fedora-32" not in updater.get_changed_templates()
+    assert results == {
+        # Parsed from Salt JSON output
+        "fedora-32": UpdateStatus.UPDATES_OK,
+        "whonix-gw-15": UpdateStatus.UPDATES_FAILED,
+        # Parsed from qubesctl summary
+        "sd-small-buster-template": UpdateStatus.UPDATES_OK,
+        # Missing from output entirely
+        "sd-large-buster-template": UpdateStatus.UPDATES_FAILED,
+    }
+    # Durations are only known from Salt JSON output
+    assert updater.get_update_durations() == {"fedora-32": 1.5005}
+
+
+@mock.patch("Updater.sdlog.error")
+def test_parse_batched_update_output_bad_json(mocked_error):
+    output = "{\nnot json\n}\nfedora-32: OK\n"
+    results = updater._parse_batched_update_output(output, ["fedora-32"])
+    assert results == {"fedora-32": UpdateStatus.UPDATES_OK}
+    assert mocked_error.called
+
+
+@mock.patch("subprocess.run")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_apply_updates_batched(mocked_info, mocked_error, mocked_run):
+    mocked_run.return_value = subprocess.CompletedProcess(
+        args=[], returncode=20, stdout=BATCHED_UPDATE_OUTPUT, stderr=""
+    )
+    vms = ["fedora-32", "whonix-gw-15", "sd-small-buster-template"]
+    upgrade_generator = updater.apply_updates_batched(vms, 15, 75, max_concurrency=3)
+
+    results = {}
+    for vm, progress, result in upgrade_generator:
+        results[vm] = result
+        assert 15 < progress <= 75
+
+    assert results == {
+        "fedora-32": UpdateStatus.UPDATES_OK,
+        "whonix-gw-15": UpdateStatus.UPDATES_FAILED,
+        "sd-small-buster-template": UpdateStatus.UPDATES_OK,
+    }
+    mocked_run.assert_called_once_with(
+        [
+            "sudo",
+            "qubesctl",
+            "--show-output",
+            "--skip-dom0",
+            "--targets",
+            "fedora-32,sd-small-buster-template,whonix-gw-15",
+            "--max-concurrency",
+            "3",
+            "state.sls",
+            "update.qubes-vm",
+            "--out",
+            "json",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    mocked_error.assert_has_calls(
+        [call("An error has occurred updating whonix-gw-15. Please contact your administrator.")]
+    )
+
+
+@mock.patch("subprocess.run", side_effect=FileNotFoundError("qubesctl"))
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_apply_updates_batched_fails(mocked_info, mocked_error, mocked_run):
+    results = {vm: result for vm, _, result in updater.apply_updates_batched(["fedora-32"])}
+    assert results == {"fedora-32": UpdateStatus.UPDATES_FAILED}
+    mocked_error.assert_has_calls([call("An error has occurred running qubesctl")])
+
+
+@pytest.mark.parametrize(
+    "engine,expected", [(None, "apply_updates"), ("batched", "apply_updates_batched")]
+)
+@mock.patch("Updater.apply_updates_batched")
+@mock.patch("Updater.apply_updates")
+def test_apply_template_updates_engine(mocked_parallel, mocked_batched, engine, expected):
+    env = {} if engine is None else {updater.UPDATE_ENGINE_ENV: engine}
+    with mock.patch.dict(os.environ, env, clear=True):
+        updater.apply_template_updates()
+    engines = {"apply_updates": mocked_parallel, "apply_updates_batched": mocked_batched}
+    for name, mocked_engine in engines.items():
+        assert mocked_engine.called is (name == expected)
+
+
 @pytest.mark.parametrize("status", UpdateStatus)
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
+@mock.patch("Updater.Util.get_qubes_version", return_value="4.1")
 @mock.patch("subprocess.check_call")
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
 def test_write_updates_status_flag_to_disk(
-    mocked_info, mocked_error, mocked_call, mocked_expand, status
+    mocked_info, mocked_error, mocked_call, mocked_version, status
 ):
-    flag_file_sd_app = updater.FLAG_FILE_STATUS_SD_APP
-    flag_file_dom0 = updater.get_dom0_path(updater.FLAG_FILE_STATUS_DOM0)
-
     updater._write_updates_status_flag_to_disk(status)
 
     mocked_call.assert_called_once_with(
-        ["qvm-run", "sd-app", "echo '{}' > {}".format(status.value, flag_file_sd_app)]
+        ["qvm-features", "sd-app", "vm-config.sdw-update-status", status.value]
     )
 
-    assert os.path.exists(flag_file_dom0)
+    assert os.path.exists(status_file)
     try:
-        with open(flag_file_dom0, "r") as f:
+        with open(status_file, "r") as f:
             contents = json.load(f)
             assert contents["status"] == status.value
+            assert contents["version"] == updater.Util.STATUS_VERSION
     except Exception:
         pytest.fail("Error reading file")
-    assert "tmp" in flag_file_dom0
     assert not mocked_error.called
 
 
 @pytest.mark.parametrize("status", UpdateStatus)
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
 @mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
 def test_write_updates_status_flag_to_disk_failure_app(
-    mocked_info, mocked_error, mocked_call, mocked_expand, status
+    mocked_info, mocked_error, mocked_call, status
 ):
 
     error_calls = [
@@ -197,12 +399,12 @@ def test_write_updates_status_flag_to_disk_failure_app(
 
 @pytest.mark.parametrize("status", UpdateStatus)
 @mock.patch("os.path.exists", side_effect=OSError("os_error"))
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
 @mock.patch("subprocess.check_call")
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
 def test_write_updates_status_flag_to_disk_failure_dom0(
-    mocked_info, mocked_error, mocked_call, mocked_expand, mocked_open, status
+    mocked_info, mocked_error, mocked_call, mocked_open, status
 ):
 
     error_calls = [call("Error writing update status flag to dom0"), call("os_error")]
@@ -210,38 +412,37 @@ def test_write_updates_status_flag_to_disk_failure_dom0(
     mocked_error.assert_has_calls(error_calls)
 
 
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
+@mock.patch("Updater.Util.get_qubes_version", return_value="4.1")
 @mock.patch("subprocess.check_call")
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
-def test_write_last_updated_flags_to_disk(mocked_info, mocked_error, mocked_call, mocked_expand):
-    flag_file_sd_app = updater.FLAG_FILE_LAST_UPDATED_SD_APP
-    flag_file_dom0 = updater.get_dom0_path(updater.FLAG_FILE_LAST_UPDATED_DOM0)
+def test_write_last_updated_flags_to_disk(mocked_info, mocked_error, mocked_call, mocked_version):
     current_time = str(datetime.now().strftime(updater.DATE_FORMAT))
 
     updater._write_last_updated_flags_to_disk()
     subprocess_command = [
-        "qvm-run",
+        "qvm-features",
         "sd-app",
-        "echo '{}' > {}".format(current_time, flag_file_sd_app),
+        "vm-config.sdw-last-updated",
+        current_time,
     ]
     mocked_call.assert_called_once_with(subprocess_command)
     assert not mocked_error.called
-    assert os.path.exists(flag_file_dom0)
+    assert os.path.exists(status_file)
     try:
-        contents = open(flag_file_dom0, "r").read()
-        assert contents == current_time
+        with open(status_file, "r") as f:
+            contents = json.load(f)
+            assert contents["last_updated"] == current_time
     except Exception:
         pytest.fail("Error reading file")
 
 
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
 @mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
-def test_write_last_updated_flags_to_disk_fails(
-    mocked_info, mocked_error, mocked_call, mocked_expand
-):
+def test_write_last_updated_flags_to_disk_fails(mocked_info, mocked_error, mocked_call):
     error_log = [
         call("Error writing last updated flag to sd-app"),
         call("Command 'check_call' returned non-zero exit status 1."),
@@ -251,13 +452,39 @@ def test_write_last_updated_flags_to_disk_fails(
     mocked_error.assert_has_calls(error_log)
 
 
+@mock_status_files()
+@mock.patch("Updater.Util.get_qubes_version", return_value="4.1")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_write_flags_to_disk_without_sd_app(mocked_info, mocked_error, mocked_version):
+    """
+    If sd-app does not exist, the flags are still written in dom0
+    """
+    app = mock.MagicMock()
+    app.domains = {}
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        updater._write_last_updated_flags_to_disk()
+        updater._write_updates_status_flag_to_disk(UpdateStatus.UPDATES_OK)
+
+    mocked_error.assert_has_calls(
+        [
+            call("Error writing last updated flag to sd-app"),
+            call("Error writing update status flag to sd-app"),
+        ],
+        any_order=True,
+    )
+    status = updater.Util.read_status()
+    assert status["last_updated"] is not None
+    assert status["status"] == UpdateStatus.UPDATES_OK.value
+
+
 @mock.patch("os.path.exists", return_value=False)
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
 @mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
 def test_write_last_updated_flags_dom0_folder_creation_fail(
-    mocked_info, mocked_error, mocked_call, mocked_expand, mocked_path_exists
+    mocked_info, mocked_error, mocked_call, mocked_path_exists
 ):
     error_log = [
         call("Error writing last updated flag to sd-app"),
@@ -309,35 +536,270 @@ def test_apply_updates_dom0_failure(mocked_info, mocked_error, mocked_call):
 
 
 @pytest.mark.parametrize("vm", current_templates)
-@mock.patch("subprocess.check_call", side_effect="0")
+@mock.patch("Updater._template_changes", {})
+@mock.patch("Updater._run_salt", return_value="Succeeded: 2 (changed=1)\n")
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
-def test_apply_updates_vms(mocked_info, mocked_error, mocked_call, vm):
+def test_apply_updates_vms(mocked_info, mocked_error, mocked_output, vm):
     if vm != "dom0":
         result = updater._apply_updates_vm(vm)
         assert result == UpdateStatus.UPDATES_OK
 
-        mocked_call.assert_called_once_with(
-            ["sudo", "qubesctl", "--skip-dom0", "--targets", vm, "state.sls", "update.qubes-vm"]
+        mocked_output.assert_called_once_with(
+            [
+                "sudo",
+                "qubesctl",
+                "--show-output",
+                "--skip-dom0",
+                "--targets",
+                vm,
+                "state.sls",
+                "update.qubes-vm",
+            ],
+            label=vm,
+            on_state=None,
         )
         assert not mocked_error.called
+        assert vm in updater.get_changed_templates()
 
 
 @pytest.mark.parametrize("vm", current_templates)
-@mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
+@mock.patch("Updater._template_changes", {})
+@mock.patch("Updater._run_salt", side_effect=subprocess.CalledProcessError(1, "check_output"))
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
-def test_apply_updates_vms_fails(mocked_info, mocked_error, mocked_call, vm):
+def test_apply_updates_vms_fails(mocked_info, mocked_error, mocked_output, vm):
     error_calls = [
         call("An error has occurred updating {}. Please contact your administrator.".format(vm)),
-        call("Command 'check_call' returned non-zero exit status 1."),
+        call("Command 'check_output' returned non-zero exit status 1."),
     ]
     result = updater._apply_updates_vm(vm)
     assert result == UpdateStatus.UPDATES_FAILED
 
     mocked_error.assert_has_calls(error_calls)
+    # If an update fails, we cannot be sure that nothing has changed
+    assert vm in updater.get_changed_templates()
+
+
+# Output of update.qubes-vm with Salt's highstate outputter. The cmd.run state
+# that notifies dom0 of the update status always reports changes.
+HIGHSTATE_OUTPUT = """disp-mgmt-fedora-32:
+----------
+          ID: update
+    Function: pkg.uptodate
+      Result: True
+     Comment: {comment}
+     Started: 10:00:00.000000
+    Duration: 5000.0 ms
+     Changes:{changes}
+----------
+          ID: notify-updates
+    Function: cmd.run
+        Name: /usr/lib/qubes/upgrades-status-notify
+      Result: True
+     Comment: Command "/usr/lib/qubes/upgrades-status-notify" run
+     Started: 10:00:05.000000
+    Duration: 500.0 ms
+     Changes:
+              ----------
+              pid:
+                  1234
+              retcode:
+                  0
+
+Summary for disp-mgmt-fedora-32
+------------
+Succeeded: 2 (changed=1)
+Failed:    0
+"""
+
+UNCHANGED_HIGHSTATE_OUTPUT = HIGHSTATE_OUTPUT.format(
+    comment="System is already up-to-date.", changes="   "
+)
+CHANGED_HIGHSTATE_OUTPUT = HIGHSTATE_OUTPUT.format(
+    comment="Upgrade ran successfully",
+    changes="""
+              ----------
+              vim-minimal:
+                  ----------
+                  new:
+                      2:8.2.2637-1.fc32
+                  old:
+                      2:8.2.2311-1.fc32""",
+)
 
 
+@pytest.mark.parametrize(
+    "output,changed",
+    [
+        (UNCHANGED_HIGHSTATE_OUTPUT, False),
+        (CHANGED_HIGHSTATE_OUTPUT, True),
+        (
+            "  Name: update - Function: pkg.uptodate - Result: Clean Started: - Duration: 1 ms\n"
+            "  Name: /usr/lib/qubes/upgrades-status-notify - Function: cmd.run - Result: Changed\n",
+            False,
+        ),
+        (
+            "  Name: update - Function: pkg.uptodate - Result: Changed Started: - Duration: 1 ms\n",
+            True,
+        ),
+        # Without a pkg state, we cannot tell whether packages were changed
+        ("Summary for disp-mgmt-fedora-32\nSucceeded: 2\nFailed:    0\n", True),
+        ("fedora-32: OK\n", True),
+    ],
+)
+@mock.patch("Updater._template_changes", {})
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_apply_updates_vms_changes(mocked_info, mocked_error, output, changed):
+    with mock.patch("Updater._run_salt", return_value=output):
+        updater._apply_updates_vm("fedora-32")
+    assert updater.get_changed_templates() == ({"fedora-32"} if changed else set())
+
+
+@mock.patch("Updater._update_durations", {})
+@mock.patch("Updater._apply_updates_vm", side_effect=[UpdateStatus.UPDATES_OK, OSError("boom")])
+@mock.patch("Updater.time.monotonic", side_effect=[10.0, 25.0, 30.0, 31.0])
+def test_apply_updates_records_durations(mocked_monotonic, apply_vm):
+    updater._apply_updates_to("fedora-32")
+    with pytest.raises(OSError):
+        updater._apply_updates_to("whonix-gw-15")
+
+    assert updater.get_update_durations() == {"fedora-32": 15.0, "whonix-gw-15": 1.0}
+
+
+@mock.patch("Updater._update_durations", {"fedora-32": 300.0, "dom0": 12.3456})
+@mock.patch("Updater.sdlog.error")
+def test_write_update_timing(mocked_error):
+    with mock.patch("time.monotonic", side_effect=[0.0, 10.0, 400.0]):
+        timer = updater.Util.PhaseTimer()
+        timer.mark("dom0_update")
+        timer.mark("template_updates")
+
+    with TemporaryDirectory() as tmpdir, mock.patch("Updater.Util.LOG_DIRECTORY", tmpdir):
+        updater.write_update_timing(timer, UpdateStatus.UPDATES_OK)
+        records = updater.Util.read_timing_records()
+
+    assert len(set(record.pop("run") for record in records)) == 1
+    assert records == [
+        {"type": "phase", "name": "dom0_update", "duration": 10.0},
+        {"type": "phase", "name": "template_updates", "duration": 390.0},
+        {"type": "vm", "name": "dom0", "duration": 12.346},
+        {"type": "vm", "name": "fedora-32", "duration": 300.0},
+        {"type": "run", "name": "total", "duration": 400.0, "status": "0"},
+    ]
+    assert not mocked_error.called
+
+
+@mock.patch("Updater._update_durations", {})
+def test_write_update_timing_state_counts():
+    with mock.patch("time.monotonic", side_effect=[0.0, 10.0, 30.0]):
+        timer = updater.Util.PhaseTimer()
+        timer.mark("dom0_update")
+        timer.mark("dom0_state")
+
+    with mock.patch("Updater.Util.write_timing_records") as mocked_write:
+        updater.write_update_timing(timer, UpdateStatus.UPDATES_OK, {"dom0_state": 42})
+    records = mocked_write.call_args[0][0]
+    assert "states" not in records[0]
+    assert records[1]["states"] == 42
+
+
+@mock.patch("Updater.Util.write_timing_records", side_effect=OSError("disk full"))
+@mock.patch("Updater.sdlog.error")
+def test_write_update_timing_failure(mocked_error, mocked_write):
+    updater.write_update_timing(updater.Util.PhaseTimer(), UpdateStatus.UPDATES_OK)
+    mocked_error.assert_has_calls([call("Error writing update timing records"), call("disk full")])
+
+
+def test_progress_estimator_uses_default_durations():
+    estimator = updater.ProgressEstimator(phases=["dom0_update", "dom0_state"], records=[])
+    assert estimator.progress() == 0.0
+    assert estimator.remaining() == 300
+
+    with mock.patch("Updater.time.monotonic", return_value=0.0):
+        estimator.start_phase("dom0_update")
+    with mock.patch("Updater.time.monotonic", return_value=60.0):
+        assert estimator.progress() == pytest.approx(60 / 300)
+        assert estimator.remaining() == pytest.approx(240)
+
+    with mock.patch("Updater.time.monotonic", return_value=100.0):
+        estimator.start_phase("dom0_state")
+        assert estimator.progress() == pytest.approx(120 / 300)
+        assert estimator.remaining() == pytest.approx(180)
+
+
+def test_progress_estimator_uses_median_of_recent_durations():
+    records = [{"type": "phase", "name": "dom0_update", "duration": d} for d in [1000, 10, 30, 20]]
+    records.append({"type": "run", "name": "total", "duration": 5000})
+    records.append({"type": "phase", "name": "dom0_state", "duration": "invalid"})
+    with mock.patch("Updater.PROGRESS_HISTORY_RUNS", 3):
+        estimator = updater.ProgressEstimator(phases=["dom0_update", "dom0_state"], records=records)
+    assert estimator.remaining() == 20 + 180
+
+
+def test_progress_estimator_weights_vms_by_duration():
+    records = [
+        {"type": "phase", "name": "template_updates", "duration": 100},
+        {"type": "vm", "name": "fedora-32", "duration": 30},
+        {"type": "vm", "name": "sd-app-buster-template", "duration": 10},
+    ]
+    vms = ["fedora-32", "sd-app-buster-template"]
+    estimator = updater.ProgressEstimator(phases=["template_updates"], records=records)
+    with mock.patch("Updater.time.monotonic", return_value=0.0):
+        estimator.start_phase("template_updates", vms=vms)
+        estimator.complete_vm("fedora-32")
+        assert estimator.progress() == pytest.approx(0.75)
+        assert estimator.remaining() == pytest.approx(25)
+
+
+def test_progress_estimator_caps_time_based_progress():
+    estimator = updater.ProgressEstimator(phases=["dom0_state"], records=[])
+    with mock.patch("Updater.time.monotonic", return_value=0.0):
+        estimator.start_phase("dom0_state", vms=["dom0"])
+    with mock.patch("Updater.time.monotonic", return_value=1000.0):
+        assert estimator.progress() == updater.MAX_ESTIMATED_PHASE_PROGRESS
+        assert estimator.remaining() is None
+        estimator.complete_vm("dom0")
+        assert estimator.progress() == 1.0
+        assert estimator.remaining() == 0
+
+
+def test_progress_estimator_counts_states():
+    records = [
+        {"type": "phase", "name": "dom0_state", "duration": 100, "states": 40},
+        {"type": "phase", "name": "dom0_state", "duration": 100},
+    ]
+    estimator = updater.ProgressEstimator(phases=["dom0_state"], records=records)
+    with mock.patch("Updater.time.monotonic", return_value=0.0):
+        estimator.start_phase("dom0_state")
+        for _ in range(10):
+            estimator.complete_state("sd-log", True)
+        assert estimator.progress() == pytest.approx(0.25)
+        for _ in range(40):
+            estimator.complete_state("sd-log", True)
+        assert estimator.progress() == updater.MAX_ESTIMATED_PHASE_PROGRESS
+    assert estimator.get_state_counts() == {"dom0_state": 50}
+
+
+def test_progress_estimator_replace_phase():
+    estimator = updater.ProgressEstimator(phases=["template_updates", "status_flags"], records=[])
+    estimator.replace_phase("template_updates", "full_install")
+    with mock.patch("Updater.DEFAULT_PHASE_DURATIONS", {"full_install": 20, "status_flags": 5}):
+        assert estimator.remaining() == 25
+
+
+@mock.patch("Updater.Util.read_timing_records", side_effect=OSError("no such file"))
+@mock.patch("Updater.sdlog.error")
+def test_progress_estimator_read_failure(mocked_error, mocked_read):
+    estimator = updater.ProgressEstimator(phases=["status_flags"])
+    assert estimator.remaining() == updater.DEFAULT_PHASE_DURATIONS["status_flags"]
+    mocked_error.assert_has_calls(
+        [call("Error reading update timing records"), call("no such file")]
+    )
+
+
+@mock.patch("Updater.DOM0_UPDATE_CHECK_TTL", 0)
 @mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
@@ -352,6 +814,7 @@ def test_check_dom0_updates_available(mocked_info, mocked_error, mocked_call):
     assert result == UpdateStatus.UPDATES_REQUIRED
 
 
+@mock.patch("Updater.DOM0_UPDATE_CHECK_TTL", 0)
 @mock.patch("subprocess.check_call")
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
@@ -362,6 +825,116 @@ def test_check_dom0_no_updates_available(mocked_info, mocked_error, mocked_call)
     assert result == UpdateStatus.UPDATES_OK
 
 
+@mock.patch("subprocess.check_call")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_prefetch_updates(mocked_info, mocked_error, mocked_call):
+    assert updater.prefetch_updates(vms=["fedora-32", "sd-small-buster-template"]) is True
+    mocked_call.assert_called_once_with(
+        [
+            "sudo",
+            "qubesctl",
+            "--skip-dom0",
+            "--targets",
+            "fedora-32,sd-small-buster-template",
+            "--max-concurrency",
+            str(updater.UPDATE_WORKERS),
+            "state.sls",
+            "sd-update-prefetch",
+        ]
+    )
+    assert not mocked_error.called
+
+
+@mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_prefetch_updates_failed(mocked_info, mocked_error, mocked_call):
+    assert updater.prefetch_updates() is False
+    error_calls = [
+        call("An error has occurred pre-fetching updates"),
+        call("Command 'check_call' returned non-zero exit status 1."),
+    ]
+    mocked_error.assert_has_calls(error_calls)
+
+
+def _reset_dom0_update_check_cache(metadata_file):
+    os.makedirs(temp_dir, exist_ok=True)
+    if os.path.exists(status_file):
+        os.remove(status_file)
+    with open(metadata_file, "w") as f:
+        f.write("metadata")
+
+
+@mock.patch("subprocess.check_call")
+@mock_status_files()
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_check_dom0_no_updates_available_is_cached(mocked_info, mocked_error, mocked_call):
+    metadata_file = os.path.join(temp_dir, "repomd.xml")
+    _reset_dom0_update_check_cache(metadata_file)
+
+    with mock.patch("Updater.DOM0_UPDATE_CHECK_INPUTS", [metadata_file]):
+        assert updater._check_updates_dom0() == UpdateStatus.UPDATES_OK
+        assert updater._check_updates_dom0() == UpdateStatus.UPDATES_OK
+
+    mocked_call.assert_called_once_with(["sudo", "qubes-dom0-update", "--check-only"])
+    mocked_info.assert_called_with("No updates available for dom0 (checked recently)")
+    assert not mocked_error.called
+
+
+@mock.patch("subprocess.check_call", side_effect=subprocess.CalledProcessError(1, "check_call"))
+@mock_status_files()
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_check_dom0_updates_available_is_not_cached(mocked_info, mocked_error, mocked_call):
+    metadata_file = os.path.join(temp_dir, "repomd.xml")
+    _reset_dom0_update_check_cache(metadata_file)
+
+    with mock.patch("Updater.DOM0_UPDATE_CHECK_INPUTS", [metadata_file]):
+        assert updater._check_updates_dom0() == UpdateStatus.UPDATES_REQUIRED
+        assert updater._check_updates_dom0() == UpdateStatus.UPDATES_REQUIRED
+
+    assert mocked_call.call_count == 2
+    assert "dom0_update_check" not in updater.Util.read_status()
+
+
+@mock.patch("subprocess.check_call")
+@mock_status_files()
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_check_dom0_cache_invalidated_by_metadata_change(mocked_info, mocked_error, mocked_call):
+    metadata_file = os.path.join(temp_dir, "repomd.xml")
+    _reset_dom0_update_check_cache(metadata_file)
+
+    with mock.patch("Updater.DOM0_UPDATE_CHECK_INPUTS", [metadata_file]):
+        updater._check_updates_dom0()
+        with open(metadata_file, "a") as f:
+            f.write(" updated")
+        updater._check_updates_dom0()
+
+    assert mocked_call.call_count == 2
+
+
+@mock.patch("subprocess.check_call")
+@mock_status_files()
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_check_dom0_cache_expires(mocked_info, mocked_error, mocked_call):
+    metadata_file = os.path.join(temp_dir, "repomd.xml")
+    _reset_dom0_update_check_cache(metadata_file)
+    expired = datetime.now() - timedelta(seconds=updater.DOM0_UPDATE_CHECK_TTL + 60)
+
+    with mock.patch("Updater.DOM0_UPDATE_CHECK_INPUTS", [metadata_file]):
+        with mock.patch("Updater.datetime") as mocked_datetime:
+            mocked_datetime.now.return_value = expired
+            mocked_datetime.strptime.side_effect = datetime.strptime
+            updater._check_updates_dom0()
+        updater._check_updates_dom0()
+
+    assert mocked_call.call_count == 2
+
+
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
 def test_overall_update_status_results_updates_ok(mocked_info, mocked_error):
@@ -477,6 +1050,429 @@ def test_safely_shutdown_fails(mocked_info, mocked_error, mocked_call, vm):
     mocked_error.assert_has_calls(call_list)
 
 
+class FakeDomains(dict):
+    """
+    Mimics qubesadmin's app.domains: VMs are looked up by name, but iterating
+    yields the VM objects themselves.
+    """
+
+    def __iter__(self):
+        return iter(list(self.values()))
+
+
+def get_mocked_domains(running):
+    """
+    Returns a dict of mocked qubesadmin VM objects for all SDW VMs, which are
+    running if their name is in the given list.
+    """
+    domains = {}
+    for name in list(current_vms.keys()) + ["sys-net", "sys-whonix"]:
+        domain = mock.MagicMock()
+        domain.name = name
+        domain.is_running.return_value = name in running
+        domains[name] = domain
+    return FakeDomains(domains)
+
+
+@mock.patch("Updater._wait_for_shutdown")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_safely_shutdown_qubesadmin(mocked_info, mocked_error, mocked_wait):
+    app = mock.MagicMock()
+    app.domains = get_mocked_domains(running=["sd-app"])
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        updater._safely_shutdown_vm("sd-app")
+        updater._safely_shutdown_vm("sd-log")
+
+    app.domains["sd-app"].shutdown.assert_called_once_with()
+    mocked_wait.assert_called_once_with([app.domains["sd-app"]], updater.SHUTDOWN_TIMEOUT)
+    # VMs that are not running are skipped
+    assert not app.domains["sd-log"].shutdown.called
+    assert not mocked_error.called
+
+
+@mock.patch("Updater._wait_for_shutdown")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_safely_shutdown_qubesadmin_fails(mocked_info, mocked_error, mocked_wait):
+    app = mock.MagicMock()
+    app.domains = get_mocked_domains(running=["sd-app"])
+    app.domains["sd-app"].shutdown.side_effect = updater.QubesException("shutdown failed")
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        result = updater._safely_shutdown_vm("sd-app")
+
+    assert result == UpdateStatus.UPDATES_FAILED
+    assert not mocked_wait.called
+    mocked_error.assert_has_calls([call("Failed to shut down sd-app"), call("shutdown failed")])
+
+
+@mock.patch("subprocess.check_output")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_safely_start_qubesadmin(mocked_info, mocked_error, mocked_output):
+    app = mock.MagicMock()
+    app.domains = get_mocked_domains(running=["sys-net"])
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        updater._safely_start_vm("sd-app")
+        updater._safely_start_vm("sys-net")
+
+    app.domains["sd-app"].start.assert_called_once_with()
+    assert not app.domains["sys-net"].start.called
+    mocked_info.assert_has_calls([call("VMs running before start of sd-app: ['sys-net']")])
+    assert not mocked_output.called
+    assert not mocked_error.called
+
+
+@mock.patch("subprocess.check_output")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_safely_kill_qubesadmin(mocked_info, mocked_error, mocked_output):
+    app = mock.MagicMock()
+    app.domains = get_mocked_domains(running=["sys-net"])
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        updater._safely_kill_vm("sys-net")
+        updater._safely_kill_vm("sys-whonix")
+        updater._safely_kill_vm("sys-foo")
+
+    app.domains["sys-net"].kill.assert_called_once_with()
+    assert not app.domains["sys-whonix"].kill.called
+    assert not mocked_output.called
+    mocked_error.assert_has_calls([call("Error while killing system VM: sys-foo")])
+
+
+@mock.patch("subprocess.Popen")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_launch_securedrop_client(mocked_info, mocked_error, mocked_popen):
+    with pytest.raises(SystemExit) as e:
+        updater.launch_securedrop_client()
+
+    assert e.value.code == 0
+    mocked_popen.assert_called_once_with(["qvm-run", "sd-app", "gtk-launch securedrop-client"])
+    assert not mocked_error.called
+
+
+@mock.patch("Updater.Util.get_qubes_version", return_value="4.1")
+@mock.patch("subprocess.check_call")
+def test_publish_flag_to_sd_app_qubesadmin(mocked_call, mocked_version):
+    app = mock.MagicMock()
+    app.domains = {"sd-app": mock.MagicMock(features={})}
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        updater._publish_flag_to_sd_app(updater.FLAG_FILE_STATUS_SD_APP, "0")
+
+    assert app.domains["sd-app"].features == {"vm-config.sdw-update-status": "0"}
+    assert not app.domains["sd-app"].run.called
+    assert not mocked_call.called
+
+
+@mock.patch("Updater.Util.get_qubes_version", return_value="4.0")
+@mock.patch("subprocess.check_call")
+def test_publish_flag_to_sd_app_qubes_4_0(mocked_call, mocked_version):
+    flag_file_sd_app = updater.FLAG_FILE_STATUS_SD_APP
+    with mock.patch("Updater._get_qubes_app", return_value=None):
+        updater._publish_flag_to_sd_app(flag_file_sd_app, "0")
+
+    mocked_call.assert_called_once_with(
+        ["qvm-run", "sd-app", "echo '0' > {}".format(flag_file_sd_app)]
+    )
+
+
+@mock.patch("subprocess.check_call")
+def test_run_in_vm_qubesadmin(mocked_call):
+    app = mock.MagicMock()
+    app.domains = get_mocked_domains(running=[])
+    with mock.patch("Updater._get_qubes_app", return_value=app):
+        updater._run_in_vm("sd-app", "echo hello")
+
+    app.domains["sd-app"].run.assert_called_once_with("echo hello")
+    assert not mocked_call.called
+
+
+@mock.patch("Updater.qubesadmin")
+def test_get_qubes_app_cli_selected(mocked_qubesadmin):
+    with mock.patch.dict(os.environ, {updater.VM_BACKEND_ENV: "cli"}):
+        assert updater._get_qubes_app() is None
+    assert not mocked_qubesadmin.Qubes.called
+
+
+@mock.patch("Updater._qubes_app", None)
+@mock.patch("Updater.qubesadmin")
+def test_get_qubes_app_shared_connection(mocked_qubesadmin):
+    with mock.patch.dict(os.environ, {}, clear=True):
+        app = updater._get_qubes_app()
+        assert updater._get_qubes_app() is app
+    mocked_qubesadmin.Qubes.assert_called_once_with()
+
+
+def test_import_is_cheap():
+    """
+    The launcher imports this module to decide whether to run the updater, so
+    the Qubes Admin API and asyncio are only imported once they are used.
+    """
+    launcher_dir = os.path.dirname(os.path.dirname(path_to_script))
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys; from sdw_updater_gui import Updater; "
+            "print(' '.join(m for m in ['asyncio', 'qubesadmin'] if m in sys.modules))",
+        ],
+        cwd=launcher_dir,
+        universal_newlines=True,
+    )
+    assert output.strip() == ""
+
+
+@mock.patch("Updater.qubesadmin", None)
+@mock.patch("Updater._qubesadmin_available", None)
+def test_import_qubesadmin_unavailable():
+    with mock.patch.dict(sys.modules, {"qubesadmin": None}):
+        assert updater._import_qubesadmin() is False
+        assert updater._import_qubesadmin() is False
+    assert updater.qubesadmin is None
+
+
+def get_vm_state_cache(running):
+    """
+    Returns a VMStateCache for the mocked SDW VMs, without an event listener,
+    but marked as listening.
+    """
+    app = mock.MagicMock()
+    app.domains = get_mocked_domains(running)
+    for domain in app.domains.values():
+        domain.get_power_state.return_value = "Running" if domain.name in running else "Halted"
+    vm_states = updater.VMStateCache(app)
+    vm_states._refresh()
+    vm_states.listening = True
+    return vm_states
+
+
+def test_vm_state_cache_events():
+    vm_states = get_vm_state_cache(running=["sys-net", "sd-log"])
+    assert vm_states.get_state("sd-app") == "Halted"
+    assert vm_states.get_running_vms() == ["sd-log", "sys-net"]
+
+    vm_states._on_event("sd-app", "domain-pre-start")
+    assert vm_states.get_state("sd-app") == "Transient"
+    vm_states._on_event("sd-app", "domain-start")
+    vm_states._on_event("sd-log", "domain-shutdown")
+    assert vm_states.get_running_vms() == ["sd-app", "sys-net"]
+    # VMs created after the cache was populated are tracked as well
+    vm_states._on_event("sd-viewer-disp", "domain-start")
+    assert vm_states.get_state("sd-viewer-disp") == "Running"
+    assert vm_states.get_state("sd-unknown") is None
+
+
+def test_vm_state_cache_wait_for_state():
+    vm_states = get_vm_state_cache(running=["sd-app"])
+    timer = threading.Timer(0.1, vm_states._on_event, args=["sd-app", "domain-shutdown"])
+    timer.start()
+    assert vm_states.wait_for_state("sd-app", "Halted", 5) is True
+    assert vm_states.wait_for_state("sd-app", "Running", 0.1) is False
+
+
+@mock.patch("Updater.EventsDispatcher", create=True)
+def test_vm_state_cache_listener(mocked_dispatcher):
+    vm_states = get_vm_state_cache(running=[])
+    vm_states._listen()
+
+    dispatcher = mocked_dispatcher.return_value
+    mocked_dispatcher.assert_called_once_with(vm_states.app)
+    handled_events = [c[0][0] for c in dispatcher.add_handler.call_args_list]
+    assert "domain-start" in handled_events
+    assert "domain-shutdown" in handled_events
+    assert "connection-established" in handled_events
+    dispatcher.listen_for_events.assert_called_once_with()
+
+
+@mock.patch("Updater.EventsDispatcher", create=True)
+@mock.patch("Updater.sdlog.error")
+def test_vm_state_cache_listener_fails(mocked_error, mocked_dispatcher):
+    vm_states = get_vm_state_cache(running=["sd-app"])
+    mocked_dispatcher.return_value.listen_for_events.side_effect = ConnectionError("closed")
+
+    waiting = threading.Thread(target=vm_states.wait_for_state, args=["sd-app", "Halted", 5])
+    waiting.start()
+    vm_states._listen()
+    # Threads waiting for a state are woken up
+    waiting.join(1)
+    assert not waiting.is_alive()
+    assert vm_states.listening is False
+    mocked_error.assert_has_calls([call("Stopped listening for VM state changes"), call("closed")])
+
+    # The stale cache is no longer used
+    with mock.patch("Updater._get_qubes_app", return_value=vm_states.app), mock.patch(
+        "Updater.qubesadmin", create=True
+    ), mock.patch("Updater._vm_state_cache", vm_states):
+        assert updater._get_vm_state_cache() is None
+
+
+@mock.patch("Updater._vm_state_cache", None)
+@mock.patch("Updater.qubesadmin", create=True)
+@mock.patch("Updater._get_qubes_app")
+@mock.patch("Updater.VMStateCache")
+def test_get_vm_state_cache_shared_by_threads(mocked_cache, mocked_app, mocked_qubesadmin):
+    # Creating the cache takes a while, during which other threads ask for it
+    cache = mock.MagicMock(listening=True)
+    mocked_cache.side_effect = lambda app: time.sleep(0.1) or cache
+    caches = []
+    threads = [
+        threading.Thread(target=lambda: caches.append(updater._get_vm_state_cache()))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    mocked_cache.assert_called_once_with(mocked_app.return_value)
+    assert caches == [cache] * 4
+
+
+@mock.patch("subprocess.check_output")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_safely_start_with_vm_state_cache(mocked_info, mocked_error, mocked_output):
+    vm_states = get_vm_state_cache(running=["sys-net", "sys-whonix"])
+    with mock.patch("Updater._get_qubes_app", return_value=vm_states.app), mock.patch(
+        "Updater._get_vm_state_cache", return_value=vm_states
+    ):
+        updater._safely_start_vm("sd-whonix")
+        updater._safely_start_vm("sys-net")
+
+    vm_states.app.domains["sd-whonix"].start.assert_called_once_with()
+    assert not vm_states.app.domains["sys-net"].start.called
+    # The VM state is not queried again before each start
+    for domain in vm_states.app.domains.values():
+        assert domain.get_power_state.call_count == 1
+        assert not domain.is_running.called
+    mocked_info.assert_has_calls(
+        [call("VMs running before start of sd-whonix: ['sys-net', 'sys-whonix']")]
+    )
+    assert not mocked_output.called
+    assert not mocked_error.called
+
+
+@pytest.mark.parametrize("halted", [True, False])
+@mock.patch("Updater._wait_for_shutdown")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_safely_shutdown_with_vm_state_cache(mocked_info, mocked_error, mocked_wait, halted):
+    vm_states = get_vm_state_cache(running=["sd-app"])
+    domain = vm_states.app.domains["sd-app"]
+    if halted:
+        domain.shutdown.side_effect = lambda: vm_states._on_event("sd-app", "domain-shutdown")
+    with mock.patch("Updater._get_qubes_app", return_value=vm_states.app), mock.patch(
+        "Updater._get_vm_state_cache", return_value=vm_states
+    ), mock.patch("Updater.SHUTDOWN_TIMEOUT", 0.1):
+        result = updater._safely_shutdown_vm("sd-app")
+        updater._safely_shutdown_vm("sd-log")
+
+    domain.shutdown.assert_called_once_with()
+    assert not vm_states.app.domains["sd-log"].shutdown.called
+    assert not mocked_wait.called
+    if halted:
+        assert result is None
+        assert not mocked_error.called
+    else:
+        assert result == UpdateStatus.UPDATES_FAILED
+        mocked_error.assert_has_calls(
+            [call("Failed to shut down sd-app"), call("Timed out waiting for sd-app")]
+        )
+
+
+@mock.patch("Updater._wait_for_shutdown")
+@mock.patch("Updater.sdlog.error")
+def test_safely_shutdown_after_vm_state_cache_stopped(mocked_error, mocked_wait):
+    vm_states = get_vm_state_cache(running=["sd-app"])
+    domain = vm_states.app.domains["sd-app"]
+    domain.is_running.return_value = True
+
+    def stop_listening():
+        with vm_states._condition:
+            vm_states.listening = False
+            vm_states._condition.notify_all()
+
+    domain.shutdown.side_effect = stop_listening
+    with mock.patch("Updater._get_qubes_app", return_value=vm_states.app), mock.patch(
+        "Updater._get_vm_state_cache", return_value=vm_states
+    ):
+        assert updater._safely_shutdown_vm("sd-app") is None
+
+    # The shutdown is awaited without the cache, rather than timing out
+    mocked_wait.assert_called_once_with([domain], updater.SHUTDOWN_TIMEOUT)
+    assert not mocked_error.called
+
+
+@pytest.mark.parametrize(
+    "changed_templates,expected_vms",
+    [
+        (set(), set()),
+        ({"sd-large-buster-template"}, {"sd-large-buster-template"}),
+        (
+            {"sd-small-buster-template"},
+            {"sd-small-buster-template", "sd-app", "sd-gpg", "sd-log", "sd-proxy"},
+        ),
+        (
+            {"whonix-gw-15"},
+            {"whonix-gw-15", "sys-whonix", "sd-whonix", "sd-proxy"},
+        ),
+        (
+            {"fedora-32"},
+            {
+                "fedora-32",
+                "sys-usb",
+                "sys-net",
+                "sys-firewall",
+                "sys-whonix",
+                "sd-whonix",
+                "sd-proxy",
+            },
+        ),
+    ],
+)
+def test_get_vms_to_power_cycle(changed_templates, expected_vms):
+    # NetVMs are determined via the Qubes Admin API if available
+    for app in [None, get_fake_qubes_app()]:
+        assert updater._get_vms_to_power_cycle(app, changed_templates) == expected_vms
+
+
+@mock.patch("Updater._get_qubes_app", return_value=None)
+@mock.patch("Updater._safely_kill_vm")
+@mock.patch("Updater._safely_start_vm")
+@mock.patch("Updater._safely_shutdown_vm")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_shutdown_and_start_vms_changed_templates(
+    mocked_info, mocked_error, mocked_shutdown, mocked_start, mocked_kill, mocked_app
+):
+    updater.shutdown_and_start_vms(changed_templates={"whonix-gw-15"})
+    mocked_shutdown.assert_has_calls(
+        [call("whonix-gw-15"), call("sd-proxy"), call("sd-whonix"), call("sys-whonix")]
+    )
+    assert mocked_shutdown.call_count == 4
+    mocked_start.assert_has_calls([call("sys-whonix"), call("sd-whonix"), call("sd-proxy")])
+    assert mocked_start.call_count == 3
+    assert not mocked_kill.called
+    assert not mocked_error.called
+
+
+@mock.patch("Updater._get_qubes_app", return_value=None)
+@mock.patch("Updater._safely_kill_vm")
+@mock.patch("Updater._safely_start_vm")
+@mock.patch("Updater._safely_shutdown_vm")
+@mock.patch("Updater.sdlog.info")
+def test_shutdown_and_start_vms_no_changed_templates(
+    mocked_info, mocked_shutdown, mocked_start, mocked_kill, mocked_app
+):
+    updater.shutdown_and_start_vms(changed_templates=set())
+    assert not mocked_shutdown.called
+    assert not mocked_start.called
+    assert not mocked_kill.called
+    mocked_info.assert_called_once_with(
+        "No TemplateVMs were changed, skipping power cycling of VMs"
+    )
+
+
 @mock.patch("subprocess.check_output")
 @mock.patch("Updater._safely_start_vm")
 @mock.patch("Updater._safely_shutdown_vm")
@@ -569,25 +1565,159 @@ def test_shutdown_and_start_vms_sysvm_fail(
     mocked_error.assert_has_calls(error_calls)
 
 
-@pytest.mark.parametrize("status", UpdateStatus)
-@mock.patch("subprocess.check_call")
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+class FakeVM:
+    """
+    Minimal stand-in for a qubesadmin VM object
+    """
+
+    def __init__(self, name, netvm=None, template=None, tags=()):
+        self.name = name
+        self.netvm = netvm
+        if template is not None:
+            self.template = template
+            self.klass = "AppVM"
+        else:
+            self.klass = "TemplateVM"
+        self.tags = set(tags)
+
+    def __str__(self):
+        return self.name
+
+
+def get_fake_qubes_app():
+    """
+    Returns a mocked qubesadmin.Qubes() object, with the VMs relevant to
+    power cycling after updates.
+    """
+    sdw = ["sd-workstation"]
+    fedora = FakeVM("fedora-32")
+    small = FakeVM("sd-small-buster-template", tags=sdw)
+    whonix = FakeVM("whonix-gw-15")
+    sys_net = FakeVM("sys-net", template=fedora)
+    sys_firewall = FakeVM("sys-firewall", netvm=sys_net, template=fedora)
+    sys_whonix = FakeVM("sys-whonix", netvm=sys_firewall, template=whonix)
+    sd_whonix = FakeVM("sd-whonix", netvm=sys_whonix, template=whonix, tags=sdw)
+    vms = [
+        fedora,
+        small,
+        whonix,
+        FakeVM("sd-large-buster-template", tags=sdw),
+        sys_net,
+        sys_firewall,
+        sys_whonix,
+        FakeVM("sys-usb", template=fedora),
+        sd_whonix,
+        FakeVM("sd-proxy", netvm=sd_whonix, template=small, tags=sdw),
+        FakeVM("sd-app", template=small, tags=sdw),
+        FakeVM("sd-gpg", template=small, tags=sdw),
+        FakeVM("sd-log", template=small, tags=sdw),
+    ]
+    app = mock.MagicMock()
+    app.domains = FakeDomains((vm.name, vm) for vm in vms)
+    return app
+
+
+def test_get_vms_to_power_cycle_standalone_sys_vms():
+    app = get_fake_qubes_app()
+    # Standalone system VMs are not based on fedora-32, so are not power cycled
+    for vm in ["sys-net", "sys-usb"]:
+        del app.domains[vm].template
+        app.domains[vm].klass = "StandaloneVM"
+    assert updater._get_vms_to_power_cycle(app, {"fedora-32"}) == {
+        "fedora-32",
+        "sys-firewall",
+        "sys-whonix",
+        "sd-whonix",
+        "sd-proxy",
+    }
+
+
+def test_get_vm_dependencies():
+    app = get_fake_qubes_app()
+    dependencies = updater._get_vm_dependencies(app, ["sd-proxy", "sd-whonix", "sd-log", "sd-foo"])
+    # Only VMs that exist and are part of the given list are considered
+    assert dependencies == {
+        "sd-proxy": {"sd-whonix", "sd-log"},
+        "sd-whonix": {"sd-log"},
+        "sd-log": set(),
+    }
+
+
 @mock.patch("Updater.sdlog.error")
-def test_read_dom0_update_flag_from_disk(
-    mocked_error, mocked_expanduser, mocked_subprocess, status
+def test_get_shutdown_tiers(mocked_error):
+    dependencies = {
+        "sd-app": {"sd-log"},
+        "sd-proxy": {"sd-whonix", "sd-log"},
+        "sd-whonix": {"sd-log", "sys-whonix"},
+        "sd-log": set(),
+        "sys-whonix": set(),
+    }
+    assert updater._get_shutdown_tiers(dependencies) == [
+        ["sd-app", "sd-proxy"],
+        ["sd-whonix"],
+        ["sd-log", "sys-whonix"],
+    ]
+    assert not mocked_error.called
+
+    # Circular dependencies are reported, but do not prevent the VMs from being handled
+    tiers = updater._get_shutdown_tiers({"sd-app": {"sd-log"}, "sd-log": {"sd-app"}})
+    assert tiers == [["sd-app", "sd-log"]]
+    assert mocked_error.called
+
+
+@mock.patch("Updater._safely_kill_vm")
+@mock.patch("Updater._safely_start_vm")
+@mock.patch("Updater._safely_shutdown_vm")
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_shutdown_and_start_vms_by_dependencies(
+    mocked_info, mocked_error, mocked_shutdown, mocked_start, mocked_kill
 ):
-    updater._write_updates_status_flag_to_disk(status)
+    with mock.patch("Updater._get_qubes_app", return_value=get_fake_qubes_app()):
+        updater.shutdown_and_start_vms()
+
+    info_calls = [
+        call(
+            "Shutting down VMs for updates: "
+            "sd-app, sd-gpg, sd-large-buster-template, sd-proxy, sys-usb"
+        ),
+        call("Shutting down VMs for updates: sd-whonix"),
+        call("Shutting down VMs for updates: sd-log, sys-whonix"),
+        call("Shutting down VMs for updates: sd-small-buster-template, sys-firewall, whonix-gw-15"),
+        call("Killing system VM: sys-firewall"),
+        call("Shutting down VMs for updates: sys-net"),
+        call("Killing system VM: sys-net"),
+        call("Shutting down VMs for updates: fedora-32"),
+        call("Starting VMs after updates: sys-net"),
+        call("Starting VMs after updates: sys-firewall"),
+        call("Starting VMs after updates: sd-log, sys-whonix"),
+        call("Starting VMs after updates: sd-whonix"),
+        call("Starting VMs after updates: sd-app, sd-gpg, sd-proxy, sys-usb"),
+    ]
+    mocked_info.assert_has_calls(info_calls, any_order=False)
+    mocked_kill.assert_has_calls([call("sys-firewall"), call("sys-net")])
+    assert mocked_shutdown.call_count == 11
+    # TemplateVMs are not started again
+    assert sorted(c[0][0] for c in mocked_start.call_args_list) == [
+        "sd-app",
+        "sd-gpg",
+        "sd-log",
+        "sd-proxy",
+        "sd-whonix",
+        "sys-firewall",
+        "sys-net",
+        "sys-usb",
+        "sys-whonix",
+    ]
+    assert not mocked_error.called
 
-    flag_file_dom0 = updater.get_dom0_path(updater.FLAG_FILE_STATUS_DOM0)
 
-    assert os.path.exists(flag_file_dom0)
-    try:
-        with open(flag_file_dom0, "r") as f:
-            contents = json.load(f)
-            assert contents["status"] == status.value
-    except Exception:
-        pytest.fail("Error reading file")
-    assert "tmp" in flag_file_dom0
+@pytest.mark.parametrize("status", UpdateStatus)
+@mock.patch("subprocess.check_call")
+@mock_status_files()
+@mock.patch("Updater.sdlog.error")
+def test_read_dom0_update_flag_from_disk(mocked_error, mocked_subprocess, status):
+    updater._write_updates_status_flag_to_disk(status)
 
     assert updater.read_dom0_update_flag_from_disk() == status
     json_values = updater.read_dom0_update_flag_from_disk(with_timestamp=True)
@@ -596,17 +1726,32 @@ def test_read_dom0_update_flag_from_disk(
     assert not mocked_error.called
 
 
+@mock_status_files()
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_should_launch_updater_ignores_other_status_fields(mocked_info, mocked_error):
+    current_date = str(datetime.now().strftime(updater.DATE_FORMAT))
+    updater.Util.write_status(
+        status=UpdateStatus.UPDATES_OK.value,
+        last_status_update=current_date,
+        last_updated=current_date,
+    )
+
+    assert updater.read_dom0_update_flag_from_disk(with_timestamp=True) == {
+        "last_status_update": current_date,
+        "status": UpdateStatus.UPDATES_OK.value,
+    }
+    assert updater.should_launch_updater(28800) is False
+
+
 @mock.patch("subprocess.check_call")
-@mock.patch("os.path.expanduser", return_value=temp_dir)
+@mock_status_files()
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
-def test_read_dom0_update_flag_from_disk_fails(
-    mocked_info, mocked_error, mocked_expanduser, mocked_subprocess
-):
+def test_read_dom0_update_flag_from_disk_fails(mocked_info, mocked_error, mocked_subprocess):
 
-    flag_file_dom0 = updater.get_dom0_path(updater.FLAG_FILE_STATUS_DOM0)
     try:
-        with open(flag_file_dom0, "w") as f:
+        with open(status_file, "w") as f:
             f.write("something")
     except Exception:
         pytest.fail("Error writing file")
@@ -780,21 +1925,23 @@ def test_should_run_updater_invalid_status_value(mocked_write):
             assert updater.should_launch_updater(TEST_INTERVAL) is True
 
 
-@mock.patch("subprocess.check_call")
+@mock.patch("Updater._run_salt")
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
 def test_apply_dom0_state_success(mocked_info, mocked_error, mocked_subprocess):
     updater.apply_dom0_state()
     log_call_list = [call("Applying dom0 state"), call("Dom0 state applied")]
     mocked_subprocess.assert_called_once_with(
-        ["sudo", "qubesctl", "--show-output", "state.highstate"]
+        ["sudo", "qubesctl", "--show-output", "state.highstate", "-l", "info"],
+        label="dom0",
+        on_state=None,
     )
     mocked_info.assert_has_calls(log_call_list)
     assert not mocked_error.called
 
 
 @mock.patch(
-    "subprocess.check_call", side_effect=[subprocess.CalledProcessError(1, "check_call"), "0"],
+    "Updater._run_salt", side_effect=[subprocess.CalledProcessError(1, "check_call"), "0"],
 )
 @mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
@@ -805,32 +1952,143 @@ def test_apply_dom0_state_failure(mocked_info, mocked_error, mocked_subprocess):
         call("Command 'check_call' returned non-zero exit status 1."),
     ]
     mocked_subprocess.assert_called_once_with(
-        ["sudo", "qubesctl", "--show-output", "state.highstate"]
+        ["sudo", "qubesctl", "--show-output", "state.highstate", "-l", "info"],
+        label="dom0",
+        on_state=None,
     )
     mocked_info.assert_called_once_with("Applying dom0 state")
     mocked_error.assert_has_calls(log_error_calls)
 
 
-@mock.patch("os.path.exists", return_value=True)
-@mock.patch("os.listdir", return_value=["apple", "banana"])
+@mock.patch("Updater.importlib.reload")
+@mock.patch("Updater._get_qubes_app", return_value=None)
 @mock.patch("Updater.sdlog.info")
-def test_migration_is_required(m_info, m_listdir, m_existence):
-    assert updater.migration_is_required() is True
-    assert m_info.called_once_with("Migration is required, will enforce full config during update")
+def test_get_migration_reasons(mocked_info, mocked_app, mocked_reload):
+    domains = [
+        updater.Migrations.Domain(name, "TemplateVM", {"sd-workstation"})
+        for name in ["sd-app-buster-template", "sd-small-buster-template"]
+    ]
+    with mock.patch("Updater.Migrations.get_domains", return_value=domains) as mocked_domains:
+        reasons = updater.get_migration_reasons()
+    mocked_domains.assert_called_once_with(None)
+    assert mocked_reload.called
+    assert reasons == [
+        updater.Migrations.MigrationReason("template-consolidation", ["sd-app-buster-template"])
+    ]
+    mocked_info.assert_called_once_with(
+        "Migration is required for template-consolidation (sd-app-buster-template), "
+        "will enforce full config during update"
+    )
 
 
-@mock.patch("os.path.exists", return_value=False)
-@mock.patch("os.listdir", return_value=[])
+@mock.patch("Updater.importlib.reload")
+@mock.patch("Updater._get_qubes_app", return_value=None)
+@mock.patch("Updater.sdlog.error")
 @mock.patch("Updater.sdlog.info")
-def test_migration_not_required(mock_info, mock_listdir, mock_existence):
-    assert updater.migration_is_required() is False
-    assert not mock_info.called
+def test_get_migration_reasons_fails(mocked_info, mocked_error, mocked_app, mocked_reload):
+    error = subprocess.CalledProcessError(1, "qvm-ls")
+    with mock.patch("Updater.Migrations.get_domains", side_effect=error):
+        assert updater.get_migration_reasons() == [
+            updater.Migrations.MigrationReason("migration-check-failed", [])
+        ]
+    mocked_error.assert_has_calls(
+        [
+            call(
+                "Error listing VMs to check whether migration is required, "
+                "will enforce full config during update"
+            ),
+            call("Command 'qvm-ls' returned non-zero exit status 1."),
+        ]
+    )
+    assert not mocked_info.called
 
 
 @mock.patch("Updater.sdlog.info")
-@mock.patch("subprocess.check_call")
-def test_run_full_install(mock_call, mock_info):
-    MIGRATION_DIR = "potato"
+@mock.patch("Updater._run_salt")
+def test_run_full_install(mock_salt, mock_info):
     updater.run_full_install()
-    calls = [["sdw-admin", "--apply"], ["sudo", "rm", "-rf", MIGRATION_DIR]]
-    assert mock_call.has_calls(calls, any_order=False)
+    mock_salt.assert_called_once_with(["sdw-admin", "--apply"], label="sdw-admin", on_state=None)
+
+
+SALT_HIGHSTATE_OUTPUT = """local:
+----------
+          ID: dom0-packages
+    Function: pkg.installed
+      Result: True
+     Comment: All specified packages are already installed
+----------
+          ID: sd-log
+    Function: qvm.vm
+      Result: False
+     Comment: VM could not be created
+  Name: vim - Function: pkg.installed - Result: Clean Started: - 12:00:00 Duration: 1 ms
+  Name: sd-app - Function: qvm.vm - Result: Failed Started: - 12:00:01 Duration: 2 ms
+
+Summary for local
+"""
+
+
+def _salt_command(output, returncode=0):
+    script = "import sys; sys.stdout.write({!r}); sys.exit({})".format(output, returncode)
+    return [sys.executable, "-c", script]
+
+
+# Log of a Salt run at the info log level, followed by its results
+SALT_INFO_LOG_OUTPUT = """[INFO    ] Loading fresh modules for state activity
+[INFO    ] Running state [dom0-packages] at time 12:00:00.000000
+[INFO    ] Executing state pkg.installed for [dom0-packages]
+[INFO    ] All specified packages are already installed
+[INFO    ] Completed state [dom0-packages] at time 12:00:01.000000 (duration_in_ms=1000.0)
+[INFO    ] Running state [sd-log] at time 12:00:01.000000
+[INFO    ] Executing state qvm.vm for [sd-log]
+[ERROR   ] VM could not be created
+[INFO    ] Completed state [sd-log] at time 12:00:02.000000 (duration_in_ms=1000.0)
+""" + SALT_HIGHSTATE_OUTPUT
+
+
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.debug")
+def test_run_salt_reports_states_from_log(mocked_debug, mocked_error):
+    """
+    With Salt's log, states are reported as they complete, and not again when
+    their results are printed.
+    """
+    on_state = mock.MagicMock()
+    output = updater._run_salt(_salt_command(SALT_INFO_LOG_OUTPUT), "dom0", on_state=on_state)
+
+    assert output == SALT_INFO_LOG_OUTPUT
+    assert on_state.call_args_list == [call("dom0-packages", True), call("sd-log", False)]
+    assert mocked_error.call_args_list == [call("[dom0] Salt state failed: sd-log")]
+    assert mocked_debug.call_count == len(SALT_INFO_LOG_OUTPUT.splitlines())
+
+
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.debug")
+def test_run_salt_reports_states_from_results(mocked_debug, mocked_error):
+    on_state = mock.MagicMock()
+    output = updater._run_salt(_salt_command(SALT_HIGHSTATE_OUTPUT), "dom0", on_state=on_state)
+
+    assert output == SALT_HIGHSTATE_OUTPUT
+    assert on_state.call_args_list == [
+        call("dom0-packages", True),
+        call("sd-log", False),
+        call("vim", True),
+        call("sd-app", False),
+    ]
+    mocked_error.assert_has_calls(
+        [call("[dom0] Salt state failed: sd-log"), call("[dom0] Salt state failed: sd-app")]
+    )
+    mocked_debug.assert_any_call("[dom0]           ID: dom0-packages")
+
+
+@mock.patch("Updater.sdlog.error")
+@mock.patch("Updater.sdlog.info")
+def test_run_salt_failure(mocked_info, mocked_error):
+    cmd = _salt_command("fedora-32: ERROR\n", returncode=20)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        updater._run_salt(cmd, "fedora-32")
+    assert e.value.returncode == 20
+    assert e.value.output == "fedora-32: ERROR\n"
+    # The output is only logged if the command fails
+    assert not mocked_info.called
+    mocked_error.assert_called_once_with("[fedora-32] Salt output:\nfedora-32: ERROR\n")
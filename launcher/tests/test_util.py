@@ -1,7 +1,11 @@
+import json
+import logging
 import os
 import pytest
+import queue
 import re
 import subprocess
+import time
 
 from unittest import mock
 from importlib.machinery import SourceFileLoader
@@ -79,6 +83,23 @@ def test_cannot_obtain_exclusive_lock_when_busy(mocked_info, mocked_warning, moc
             assert re.search(BUSY_LOCK_REGEX, error_string) is not None
 
 
+@mock.patch("Util.sdlog.error")
+@mock.patch("Util.sdlog.info")
+def test_busy_exclusive_lock_logged_as_info_when_quiet(mocked_info, mocked_error):
+    """
+    The notifier daemon is restarted periodically, so a lock conflict is
+    expected and should not be logged as an error.
+    """
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOCK_DIRECTORY", tmpdir):
+        basename = "test-quiet-lock.lock"
+        lh1 = util.obtain_lock(basename)  # noqa: F841
+        with mock.patch("fcntl.lockf", side_effect=IOError()):
+            assert util.obtain_lock(basename, quiet=True) is None
+        assert not mocked_error.called
+        info_string = mocked_info.call_args[0][0]
+        assert re.search(BUSY_LOCK_REGEX, info_string) is not None
+
+
 @mock.patch("Util.sdlog.error")
 @mock.patch("Util.sdlog.warning")
 @mock.patch("Util.sdlog.info")
@@ -153,6 +174,236 @@ def test_stale_lockfile_has_no_effect(mocked_info, mocked_warning, mocked_error)
         assert lock_result is True
 
 
+@mock.patch("Util.sdlog.error")
+@mock.patch("Util.sdlog.warning")
+@mock.patch("Util.sdlog.info")
+def test_wait_for_lock_without_lockfile(mocked_info, mocked_warning, mocked_error):
+    """
+    Test that we do not wait for a lock if there's no lockfile
+    """
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOCK_DIRECTORY", tmpdir):
+        with mock.patch("fcntl.lockf") as mocked_lockf:
+            util.wait_for_lock("404.lock")
+            assert not mocked_lockf.called
+            assert not mocked_info.called
+
+
+@mock.patch("Util.sdlog.error")
+@mock.patch("Util.sdlog.warning")
+@mock.patch("Util.sdlog.info")
+def test_wait_for_lock_waits_for_release(mocked_info, mocked_warning, mocked_error):
+    """
+    Test that we fall back to a blocking lock if the lock is currently held
+    """
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOCK_DIRECTORY", tmpdir):
+        basename = "test-wait.lock"
+        lh = util.obtain_lock(basename)  # noqa: F841
+
+        # We're running in the same process, so obtaining a lock will succeed.
+        # Instead we're mocking the IOError lockf would raise.
+        with mock.patch("fcntl.lockf", side_effect=[IOError(), None]) as mocked_lockf:
+            util.wait_for_lock(basename)
+            assert mocked_lockf.call_count == 2
+            assert mocked_lockf.call_args[0][1] == util.fcntl.LOCK_SH
+            mocked_info.assert_called_once()
+
+
+@mock.patch("Util.LOCK_POLL_INTERVAL", 0.01)
+@mock.patch("Util.sdlog.error")
+@mock.patch("Util.sdlog.warning")
+@mock.patch("Util.sdlog.info")
+def test_wait_for_lock_with_timeout_released(mocked_info, mocked_warning, mocked_error):
+    """
+    Test that the lock is polled until it is released, if a timeout is given
+    """
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOCK_DIRECTORY", tmpdir):
+        basename = "test-wait.lock"
+        lh = util.obtain_lock(basename)  # noqa: F841
+
+        with mock.patch("fcntl.lockf", side_effect=[IOError(), IOError(), None]) as mocked_lockf:
+            assert util.wait_for_lock(basename, timeout=10) is True
+            assert mocked_lockf.call_count == 3
+            assert mocked_lockf.call_args[0][1] == util.fcntl.LOCK_SH | util.fcntl.LOCK_NB
+            mocked_info.assert_called_once()
+            assert not mocked_warning.called
+
+
+@mock.patch("Util.LOCK_POLL_INTERVAL", 0.01)
+@mock.patch("Util.sdlog.error")
+@mock.patch("Util.sdlog.warning")
+@mock.patch("Util.sdlog.info")
+def test_wait_for_lock_with_timeout_expired(mocked_info, mocked_warning, mocked_error):
+    """
+    Test that we stop waiting for a lock that is still held after the timeout
+    """
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOCK_DIRECTORY", tmpdir):
+        basename = "test-wait.lock"
+        lh = util.obtain_lock(basename)  # noqa: F841
+
+        start = time.monotonic()
+        with mock.patch("fcntl.lockf", side_effect=IOError()) as mocked_lockf:
+            assert util.wait_for_lock(basename, timeout=0.1) is False
+        assert 0.1 <= time.monotonic() - start < 5
+        assert mocked_lockf.call_count > 2
+        for call in mocked_lockf.call_args_list:
+            assert call[0][1] == util.fcntl.LOCK_SH | util.fcntl.LOCK_NB
+        mocked_info.assert_called_once()
+        mocked_warning.assert_called_once()
+
+
+def mock_status_files(tmpdir):
+    """
+    Points the status record and the legacy status files to the given
+    directory.
+    """
+    return mock.patch.multiple(
+        util,
+        STATUS_FILE=os.path.join(tmpdir, "sdw-status.json"),
+        LEGACY_STATUS_FILE=os.path.join(tmpdir, "sdw-update-status"),
+        LEGACY_LAST_UPDATED_FILE=os.path.join(tmpdir, "sdw-last-updated"),
+    )
+
+
+def test_status_is_empty_initially():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        assert util.read_status() == {}
+
+
+def test_write_status_merges_fields():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        util.write_status(status="0", last_status_update="2020-01-01 00:00:00")
+        util.write_status(last_updated="2020-01-01 00:00:00")
+
+        with open(util.STATUS_FILE) as f:
+            contents = json.load(f)
+        assert contents == {
+            "version": util.STATUS_VERSION,
+            "status": "0",
+            "last_status_update": "2020-01-01 00:00:00",
+            "last_updated": "2020-01-01 00:00:00",
+        }
+        assert util.read_status() == contents
+        # Only the status file remains, no temporary files
+        assert os.listdir(tmpdir) == ["sdw-status.json"]
+
+
+def test_read_status_is_cached():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        util.write_status(status="0")
+        with mock.patch("builtins.open") as mocked_open:
+            assert util.read_status()["status"] == "0"
+            assert not mocked_open.called
+
+
+def test_read_status_detects_changes():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        util.write_status(status="0")
+        util.read_status()
+        # Written by another process
+        with open(util.STATUS_FILE, "w") as f:
+            json.dump({"version": util.STATUS_VERSION, "status": "2", "padding": "x"}, f)
+        assert util.read_status()["status"] == "2"
+
+
+def test_read_status_returns_copy():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        util.write_status(status="0")
+        util.read_status()["status"] = "3"
+        assert util.read_status()["status"] == "0"
+
+
+@mock.patch("Util.sdlog.error")
+def test_corrupt_status_file_is_handled(mocked_error):
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        with open(util.STATUS_FILE, "w") as f:
+            f.write("something")
+        assert util.read_status() == {}
+        assert mocked_error.called
+
+        # The corrupt record is replaced on the next write
+        util.write_status(status="0")
+        assert util.read_status() == {"version": util.STATUS_VERSION, "status": "0"}
+
+
+def test_failed_status_write_keeps_previous_record():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        util.write_status(status="0")
+        with mock.patch("os.fsync", side_effect=OSError("no space left")):
+            with pytest.raises(OSError):
+                util.write_status(status="1")
+        assert util.read_status()["status"] == "0"
+        assert os.listdir(tmpdir) == ["sdw-status.json"]
+
+
+def test_legacy_status_files_are_read():
+    with TemporaryDirectory() as tmpdir, mock_status_files(tmpdir):
+        with open(util.LEGACY_STATUS_FILE, "w") as f:
+            json.dump({"last_status_update": "2020-01-01 00:00:00", "status": "2"}, f)
+        with open(util.LEGACY_LAST_UPDATED_FILE, "w") as f:
+            f.write("2019-12-31 00:00:00")
+
+        assert util.read_status() == {
+            "status": "2",
+            "last_status_update": "2020-01-01 00:00:00",
+            "last_updated": "2019-12-31 00:00:00",
+        }
+
+        # The legacy status is carried over into the status record
+        util.write_status(status="0")
+        status = util.read_status()
+        assert status["status"] == "0"
+        assert status["last_updated"] == "2019-12-31 00:00:00"
+
+
+def test_phase_timer():
+    with mock.patch("time.monotonic", side_effect=[10.0, 10.5, 12.0]):
+        timer = util.PhaseTimer()
+        assert timer.mark("imports") == 0.5
+        assert timer.mark("lock") == 1.5
+
+    assert timer.phases == [("imports", 0.5), ("lock", 1.5)]
+    assert timer.total() == 2.0
+    assert timer.summary() == "imports=0.500s lock=1.500s total=2.000s"
+
+
+def test_phase_timer_with_start_time():
+    with mock.patch("time.monotonic", return_value=5.0):
+        timer = util.PhaseTimer(start=4.0)
+        timer.mark("imports")
+
+    assert timer.phases == [("imports", 1.0)]
+
+
+def test_timing_records():
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOG_DIRECTORY", tmpdir):
+        # No records have been written yet
+        assert util.read_timing_records() == []
+
+        util.write_timing_records([{"name": "dom0_update", "duration": 1.5}])
+        with open(os.path.join(tmpdir, util.TIMING_LOG_FILE), "a") as f:
+            # Interrupted write
+            f.write('{"name": "dom0_st')
+        util.write_timing_records([{"name": "power_cycle", "duration": 2.0}])
+
+        # Only the incomplete record is skipped
+        assert util.read_timing_records() == [
+            {"name": "dom0_update", "duration": 1.5},
+            {"name": "power_cycle", "duration": 2.0},
+        ]
+
+
+def test_timing_records_are_capped():
+    with TemporaryDirectory() as tmpdir, mock.patch.multiple(
+        "Util", LOG_DIRECTORY=tmpdir, TIMING_LOG_MAX_RECORDS=3
+    ):
+        util.write_timing_records([{"duration": duration} for duration in range(2)])
+        util.write_timing_records([{"duration": duration} for duration in range(2, 5)])
+
+        assert util.read_timing_records() == [{"duration": 2}, {"duration": 3}, {"duration": 4}]
+        # No temporary files are left behind
+        assert os.listdir(tmpdir) == [util.TIMING_LOG_FILE]
+
+
 def test_log():
     """
     Test whether we can successfully write to a log file
@@ -170,32 +421,141 @@ def test_log():
         assert count == 3
 
 
+@pytest.mark.parametrize("json_format", [False, True])
+def test_log_through_queue(json_format):
+    """
+    Test whether records logged through a queue are written to the log file
+    by the time the listener is stopped
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.LOG_DIRECTORY", tmpdir):
+        basename = "test-queue.log"
+        try:
+            util.configure_logging(basename, use_queue=True, json_format=json_format)
+            util.sdlog.info("info level log entry")
+            try:
+                raise ValueError("logged exception")
+            except ValueError:
+                util.sdlog.exception("error level log entry")
+        finally:
+            util.stop_log_listener()
+            for handler in [h for h in root.handlers if h not in handlers]:
+                root.removeHandler(handler)
+        with open(os.path.join(tmpdir, basename)) as f:
+            lines = f.readlines()
+
+    if json_format:
+        entries = [json.loads(line) for line in lines]
+        assert [entry["level"] for entry in entries] == ["INFO", "ERROR"]
+        assert entries[0]["message"] == "info level log entry"
+        assert entries[0]["function"] == "test_log_through_queue"
+        assert "logged exception" in entries[1]["message"]
+    else:
+        assert "INFO: info level log entry" in lines[0]
+        assert "ValueError: logged exception" in "".join(lines)
+
+
+def test_full_log_queue_drops_records():
+    log_queue = queue.Queue(2)
+    handler = util.DroppingQueueHandler(log_queue)
+    record = logging.makeLogRecord({"msg": "entry"})
+
+    for _ in range(4):
+        handler.handle(record)
+    assert handler.dropped == 2
+    assert log_queue.get_nowait().getMessage() == "entry"
+    assert log_queue.get_nowait().getMessage() == "entry"
+
+    # The number of dropped records is logged once there is room again
+    handler.handle(record)
+    assert handler.dropped == 0
+    assert log_queue.get_nowait().getMessage() == "Dropped 2 log records"
+    assert log_queue.get_nowait().getMessage() == "entry"
+
+
+def make_fake_proc(tmpdir, processes):
+    """
+    Populates the given directory like /proc with the given list of tuples of
+    process name and command line arguments.
+    """
+    for pid, (comm, argv) in enumerate(processes, start=100):
+        os.makedirs(os.path.join(tmpdir, str(pid)))
+        with open(os.path.join(tmpdir, str(pid), "comm"), "w") as f:
+            f.write(comm[:15] + "\n")
+        with open(os.path.join(tmpdir, str(pid), "cmdline"), "wb") as f:
+            f.write(b"".join(arg.encode() + b"\0" for arg in argv))
+    # Entries that are not processes are skipped
+    os.makedirs(os.path.join(tmpdir, "sys"))
+
+
+FAKE_PROCESSES = [
+    ("bash", ["/bin/bash"]),
+    ("cmake", ["cmake", ".."]),
+    ("qubesctl", ["/usr/bin/python3", "/usr/bin/qubesctl", "state.highstate"]),
+    ("qubes-guid-long-name", ["/usr/bin/qubes-guid-long-name"]),
+]
+
+
 @pytest.mark.parametrize(
-    "return_code,expected_result", [(0, True), (1, False)],
+    "specs,expected_result",
+    [
+        (["cowsay"], False),
+        (["cowsay", "qubesctl"], True),
+        (["make"], False),
+        (["cmake"], True),
+        (["qubes-guid-long-name"], True),
+        ([("qubesctl", r"state\.highstate")], True),
+        ([("qubesctl", r"state\.sls")], False),
+        ([("bash", r"^/bin/bash$")], True),
+    ],
 )
 @mock.patch("Util.sdlog.error")
 @mock.patch("Util.sdlog.warning")
 @mock.patch("Util.sdlog.info")
-def test_for_conflicting_process(
-    mocked_info, mocked_warning, mocked_error, return_code, expected_result
-):
+def test_for_conflicting_process(mocked_info, mocked_warning, mocked_error, specs, expected_result):
     """
     Test whether we can successfully detect conflicting processes.
     """
-    # We mock the pgrep call itself, which means we _won't_ detect behavior
-    # changes at that level.
-    completed_process = subprocess.CompletedProcess(args=[], returncode=return_code)
-    with mock.patch("subprocess.run", return_value=completed_process) as mocked_run:
-        running_process = util.is_conflicting_process_running(["cowsay"])
-        mocked_run.assert_called_once()
-        if expected_result is True:
-            assert running_process is True
-            mocked_error.assert_called_once()
-            error_string = mocked_error.call_args[0][0]
-            assert re.search(CONFLICTING_PROCESS_REGEX, error_string) is not None
-        else:
-            assert running_process is False
-            assert not mocked_error.called
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.PROC_DIRECTORY", tmpdir):
+        make_fake_proc(tmpdir, FAKE_PROCESSES)
+        running_process = util.is_conflicting_process_running(specs)
+    if expected_result is True:
+        assert running_process is True
+        mocked_error.assert_called_once()
+        error_string = mocked_error.call_args[0][0]
+        assert re.search(CONFLICTING_PROCESS_REGEX, error_string) is not None
+    else:
+        assert running_process is False
+        assert not mocked_error.called
+
+
+@mock.patch("Util.sdlog.error")
+def test_for_conflicting_process_skips_exited_processes(mocked_error):
+    with TemporaryDirectory() as tmpdir, mock.patch("Util.PROC_DIRECTORY", tmpdir):
+        make_fake_proc(tmpdir, [("qubesctl", ["qubesctl"])])
+        os.remove(os.path.join(tmpdir, "100", "cmdline"))
+        os.makedirs(os.path.join(tmpdir, "101"))
+        assert util.is_conflicting_process_running([("qubesctl", "highstate")]) is False
+    assert not mocked_error.called
+
+
+@mock.patch("Util.sdlog.error")
+def test_for_conflicting_process_in_real_process_table(mocked_error):
+    process = subprocess.Popen(["sleep", "31337"])
+    try:
+        # Popen may return before the child process has executed sleep
+        comm_file = os.path.join("/proc", str(process.pid), "comm")
+        for _ in range(50):
+            with open(comm_file) as f:
+                if f.read().rstrip("\n") == "sleep":
+                    break
+            time.sleep(0.1)
+        assert util.is_conflicting_process_running([("sleep", r"^sleep 31337$")]) is True
+    finally:
+        process.kill()
+        process.wait()
+    assert util.is_conflicting_process_running([("sleep", r"^sleep 31337$")]) is False
 
 
 @pytest.mark.parametrize(
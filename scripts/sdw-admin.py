@@ -6,14 +6,63 @@ does it handle the config.
 """
 import sys
 import argparse
+import hashlib
+import json
+import re
 import subprocess
 import os
 
 SCRIPTS_PATH = "/usr/share/securedrop-workstation-dom0-config/"
+SALT_ROOT = "/srv/salt/"
 SALT_PATH = "/srv/salt/sd/"
+TOP_FILE = os.path.join(SALT_ROOT, "sd-workstation.top")
+
+# Fingerprints of the Salt states last applied successfully to each target,
+# used by incremental applies to skip targets whose states have not changed
+APPLIED_STATES_FILE = os.path.expanduser("~/.securedrop_workstation/applied-states.json")
+
+# Hash of the Salt tree when Salt was last synchronized, used to skip clearing
+# the Salt cache if no files have changed since
+SALT_SYNC_FILE = os.path.expanduser("~/.securedrop_workstation/salt-sync.json")
+SALT_CACHE_PATH = "/var/cache/salt"
+
+# Bounds for the number of VMs provisioned at the same time. Each target is
+# managed from its own management DispVM, and qubesctl fails with "did not
+# return clean data" if they cannot be started, so the initial concurrency is
+# derived from the memory Xen has not allocated to any VM, and reduced whenever
+# such errors occur. dom0's own available memory is capped by ballooning.
+# qmemman usually hands free memory to running VMs, so the initial concurrency
+# is never lower than the default that was used before it was measured.
+MIN_CONCURRENCY = 1
+DEFAULT_CONCURRENCY = 2
+MAX_CONCURRENCY = 8
+MEMORY_PER_TARGET = 1536  # in MiB, as reported by "xl info"
+CLEAN_DATA_RETRIES = 3
+CLEAN_DATA_ERROR = "did not return clean data"
+
+# References to other files in Salt states and templates, e.g.
+# "source: salt://sd/sd-app/config.json.j2" or "{% import_json "sd/config.json" as d %}".
+# A reference containing a template variable is truncated to the directory before it.
+SALT_FILE_REFERENCE = re.compile(r"salt://(?P<path>[^\s\"'{]+)")
+JINJA_FILE_REFERENCE = re.compile(
+    r"{%-?\s*(?:import_json|import_yaml|import|from|include)\s+[\"'](?P<path>[^\"']+)[\"']"
+)
+SALT_INCLUDE_ITEM = re.compile(r"^\s+-\s+(?P<name>[\w.-]+)\s*$")
+
+# Per-target summary line printed by qubesctl, e.g. "sd-app: OK", and the
+# first line of the output of a target, e.g. "sd-app:"
+QUBESCTL_TARGET_STATUS = re.compile(r"^(?P<vm>[\w.-]+): (?P<status>OK|ERROR)\b")
+QUBESCTL_TARGET_OUTPUT = re.compile(r"^(?P<vm>[\w.-]+):")
+
+# VMs provisioned before all others, in order: the logging VMs, so that sd-log
+# is ready to receive logs from the VMs configured after it, and whonix-gw-15,
+# which is not tagged with sd-workstation. sys-usb is provisioned last.
+LOGGING_VMS = ["sd-log", "sd-small-buster-template"]
+WHONIX_GATEWAY = "whonix-gw-15"
+SYS_USB = "sys-usb"
+SYS_FIREWALL = "sys-firewall"
 
 sys.path.insert(1, os.path.join(SCRIPTS_PATH, "scripts/"))
-from validate_config import SDWConfigValidator, ValidationError  # noqa: E402
 
 
 def parse_args():
@@ -25,6 +74,13 @@ def parse_args():
         action="store_true",
         help="Apply workstation configuration with Salt",
     )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        required=False,
+        action="store_true",
+        help="During apply action, only apply states to VMs whose states have changed",
+    )
     parser.add_argument(
         "--validate",
         default=False,
@@ -60,31 +116,456 @@ def parse_args():
 
 def copy_config():
     """
-    Copies config.json and sd-journalist.sec to /srv/salt/sd
+    Copies config.json and sd-journalist.sec to /srv/salt/sd. Timestamps are
+    preserved, since the secret key can only be fingerprinted by its
+    modification time (see _hash_paths()).
     """
     try:
-        subprocess.check_call(["sudo", "cp", os.path.join(SCRIPTS_PATH, "config.json"), SALT_PATH])
-        subprocess.check_call(
-            ["sudo", "cp", os.path.join(SCRIPTS_PATH, "sd-journalist.sec"), SALT_PATH]
-        )
+        for name in ["config.json", "sd-journalist.sec"]:
+            subprocess.check_call(
+                ["sudo", "cp", "--preserve=timestamps", os.path.join(SCRIPTS_PATH, name), SALT_PATH]
+            )
     except subprocess.CalledProcessError:
         raise SDWAdminException("Error copying configuration")
 
 
 def provision_all():
     """
-    Runs provision-all to apply the salt state.highstate on dom0 and all VMs
+    Creates and configures all SecureDrop Workstation VMs, by applying the
+    salt state.highstate on dom0 and all VMs
+    """
+    try:
+        configure_sys_vms()
+        apply_dom0_highstate()
+
+        # We list VMs after dom0's highstate, so that the VMs are available for
+        # listing by tag, and skip dom0, since its highstate was already enforced.
+        output = subprocess.check_output(
+            ["qvm-ls", "--tags", "sd-workstation", "--raw-list"], universal_newlines=True
+        )
+        provision_vms(LOGGING_VMS + [WHONIX_GATEWAY] + output.split() + [SYS_USB])
+    except subprocess.CalledProcessError:
+        raise SDWAdminException("Error during provisioning")
+
+
+def configure_sys_vms():
+    """
+    Configures the Fedora-based system VMs, including sys-firewall, which must
+    be done before dom0's highstate.
+    """
+    print("Configure Fedora-based system VMs")
+    subprocess.check_call(["sudo", "qubesctl", "--show-output", "state.sls", "sd-sys-vms"])
+    apply_sys_firewall_files()
+
+
+def apply_sys_firewall_files():
+    """
+    Applies the SecureDrop Workstation states of sys-firewall.
+    """
+    subprocess.check_call(
+        [
+            "sudo",
+            "qubesctl",
+            "--show-output",
+            "--skip-dom0",
+            "--targets",
+            SYS_FIREWALL,
+            "state.sls",
+            "sd-sys-firewall-files",
+        ]
+    )
+
+
+def apply_dom0_highstate():
+    """
+    Applies the highstate to dom0 only, to ensure the VMs are created (but not
+    yet configured).
+    """
+    print("Set up dom0 config files, including RPC policies, and create VMs")
+    subprocess.check_call(["sudo", "qubesctl", "--show-output", "state.highstate"])
+
+
+def provision_vms(vms, on_applied=None):
+    """
+    Applies the highstate to the given VMs in the order required for a full
+    provisioning: logging VMs first, then whonix-gw-15, then all other VMs,
+    and sys-usb last. If given, on_applied is called with the set of VMs to
+    which the highstate was applied successfully after each step.
+    """
+    vms = set(vms)
+
+    def provision(step_vms):
+        succeeded = apply_highstate(step_vms)
+        if on_applied is not None:
+            on_applied(succeeded)
+        check_highstate(step_vms, succeeded)
+
+    logging_vms = vms.intersection(LOGGING_VMS)
+    if logging_vms:
+        print("Set up logging VMs early")
+        provision(logging_vms)
+        # Reboot sd-log so it's ready to receive logs from other VMs about to be configured
+        subprocess.check_call(["qvm-shutdown", "--wait", "sd-log"])
+        subprocess.check_call(["qvm-start", "sd-log"])
+
+    if WHONIX_GATEWAY in vms:
+        # Provision whonix-gw-15 with log additions because it isn't tagged with
+        # sd-workstation (we don't want it removed after a make clean)
+        provision({WHONIX_GATEWAY})
+        subprocess.check_call(["qvm-shutdown", "--wait", WHONIX_GATEWAY])
+
+    other_vms = vms - logging_vms - {WHONIX_GATEWAY, SYS_USB}
+    if other_vms:
+        print("Provision all SecureDrop Workstation VMs with service-specific configs")
+        provision(other_vms)
+
+    if SYS_USB in vms:
+        print("Add SecureDrop export device handling to sys-usb")
+        provision({SYS_USB})
+
+
+def get_top_targets(top_file=TOP_FILE):
+    """
+    Returns a dict mapping each target of the given Salt top file to the list
+    of states applied to it, in order. Only the simple layout of
+    sd-workstation.top is supported.
+    """
+    targets = {}
+    target = None
+    with open(top_file) as f:
+        for line in f:
+            if line.strip().startswith("#"):
+                continue
+            target_match = re.match(r"^  (?P<target>[\w.-]+):\s*$", line)
+            state_match = re.match(r"^    - (?P<state>[\w.-]+)\s*$", line)
+            if target_match:
+                target = target_match.group("target")
+                targets[target] = []
+            elif re.match(r"^  \S", line):
+                # Targets matched by grain or pillar, e.g. "qubes:type:template:",
+                # are not supported, and neither are their states
+                target = None
+            elif state_match and target is not None:
+                targets[target].append(state_match.group("state"))
+    return targets
+
+
+def _get_state_path(name):
+    """
+    Returns the path of the Salt state with the given name, e.g. "sd-app".
+    """
+    return os.path.join(SALT_ROOT, name.replace(".", "/") + ".sls")
+
+
+def _get_referenced_paths(path):
+    """
+    Returns the paths of the files and directories referenced by the given
+    Salt state or template: included states, imported files and file sources.
+    """
+    try:
+        with open(path) as f:
+            contents = f.read()
+    except (OSError, UnicodeDecodeError):
+        return []
+
+    paths = []
+    for match in SALT_FILE_REFERENCE.finditer(contents):
+        paths.append(os.path.join(SALT_ROOT, match.group("path")))
+    for match in JINJA_FILE_REFERENCE.finditer(contents):
+        paths.append(os.path.join(SALT_ROOT, match.group("path")))
+
+    in_include = False
+    for line in contents.splitlines():
+        if line.rstrip() == "include:":
+            in_include = True
+            continue
+        match = SALT_INCLUDE_ITEM.match(line)
+        if in_include and match:
+            paths.append(_get_state_path(match.group("name")))
+        else:
+            in_include = False
+    return paths
+
+
+def _hash_paths(paths):
+    """
+    Returns a SHA-256 hash of the names and contents of the given files and
+    of all files in the given directories. Files that cannot be read, e.g.
+    secrets copied into place by root, are included by modification time and
+    size, and missing files by name only.
+    """
+    files = set()
+    for path in paths:
+        path = os.path.normpath(path)
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.update(os.path.join(root, name) for name in names)
+        else:
+            files.add(path)
+
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        digest.update(path.encode() + b"\0")
+        try:
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except PermissionError:  # noqa: F821
+            stat = os.stat(path)
+            digest.update("{}:{}".format(stat.st_mtime_ns, stat.st_size).encode())
+        except OSError:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+def get_state_fingerprints(targets):
+    """
+    Returns a dict mapping each of the given targets, as returned by
+    get_top_targets(), to a fingerprint of the Salt states applied to it,
+    including all files those states include, import or install, and the
+    configuration they read.
+    """
+    fingerprints = {}
+    for target, states in targets.items():
+        pending = [_get_state_path(state) for state in states]
+        inputs = set()
+        while pending:
+            path = os.path.normpath(pending.pop())
+            if path in inputs:
+                continue
+            inputs.add(path)
+            if path.endswith((".sls", ".j2")) and os.path.isfile(path):
+                pending.extend(_get_referenced_paths(path))
+        fingerprints[target] = _hash_paths(inputs)
+    return fingerprints
+
+
+def _read_json(path):
+    """
+    Returns the dict stored in the given JSON file, or an empty dict if it
+    does not exist or cannot be parsed.
     """
     try:
-        subprocess.check_call([os.path.join(SCRIPTS_PATH, "scripts/provision-all")])
+        with open(path) as f:
+            contents = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return contents if isinstance(contents, dict) else {}
+
+
+def _write_json(path, contents):
+    """
+    Atomically replaces the given JSON file with the given dict.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(contents, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, path)
+
+
+def read_applied_fingerprints():
+    """
+    Returns the dict of applied state fingerprints written by
+    write_applied_fingerprints(), or an empty dict if none are available.
+    """
+    return _read_json(APPLIED_STATES_FILE)
+
+
+def write_applied_fingerprints(fingerprints):
+    """
+    Records the fingerprints of the Salt states last applied to each target.
+    """
+    _write_json(APPLIED_STATES_FILE, fingerprints)
+
+
+def list_vms():
+    """
+    Returns the set of names of all VMs on the system.
+    """
+    try:
+        output = subprocess.check_output(["qvm-ls", "--raw-list"], universal_newlines=True)
     except subprocess.CalledProcessError:
-        raise SDWAdminException("Error during provision-all")
+        raise SDWAdminException("Error listing VMs")
+    return set(output.split())
+
+
+def get_available_memory():
+    """
+    Returns the memory Xen has not allocated to any VM (in MiB), or None if it
+    cannot be determined.
+    """
+    try:
+        output = subprocess.check_output(["sudo", "xl", "info"], universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in output.splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() == "free_memory":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def get_initial_concurrency():
+    """
+    Returns the number of VMs to provision at the same time, based on the
+    memory Xen has not allocated to any VM. Concurrency is only reduced below
+    DEFAULT_CONCURRENCY when retrying targets (see apply_highstate()).
+    """
+    memory = get_available_memory()
+    if memory is None:
+        return DEFAULT_CONCURRENCY
+    return max(DEFAULT_CONCURRENCY, min(MAX_CONCURRENCY, memory // MEMORY_PER_TARGET))
+
+
+def apply_highstate(vms):
+    """
+    Applies the highstate to the given VMs, as many at the same time as
+    available memory allows, and returns the set of VMs to which it was
+    applied successfully. Targets that fail with "did not return clean data"
+    are retried with reduced concurrency, up to CLEAN_DATA_RETRIES times.
+    """
+    pending = set(vms)
+    succeeded = set()
+    concurrency = min(get_initial_concurrency(), len(pending))
+    for attempt in range(CLEAN_DATA_RETRIES + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            concurrency = max(MIN_CONCURRENCY, min(concurrency // 2, len(pending)))
+            targets = ", ".join(sorted(pending))
+            print("Retrying {} with max concurrency {}".format(targets, concurrency))
+        attempt_succeeded, unclean = run_highstate(pending, max_concurrency=concurrency)
+        succeeded.update(attempt_succeeded)
+        pending = unclean
+    return succeeded
+
+
+def check_highstate(vms, succeeded):
+    """
+    Raises SDWAdminException if the highstate was not applied to all of the
+    given VMs.
+    """
+    failed = set(vms) - succeeded
+    if failed:
+        raise SDWAdminException("Error applying highstate to {}".format(", ".join(sorted(failed))))
+
+
+def run_highstate(vms, max_concurrency):
+    """
+    Applies the highstate to the given VMs with a single qubesctl run. Output
+    is printed as it is received.
+
+    Returns a tuple of the set of VMs to which the highstate was applied
+    successfully, and the set of VMs that failed with "did not return clean
+    data", which may succeed if retried. If such an error cannot be attributed
+    to a VM, all VMs that did not succeed are considered retryable.
+    """
+    cmd = [
+        "sudo",
+        "qubesctl",
+        "--show-output",
+        "--max-concurrency",
+        str(max_concurrency),
+        "--skip-dom0",
+        "--targets",
+        ",".join(sorted(vms)),
+        "state.highstate",
+    ]
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1
+    )
+    succeeded = set()
+    unclean = set()
+    unattributed_unclean = False
+    target = None
+    with process.stdout:
+        for line in process.stdout:
+            sys.stdout.write(line)
+            match = QUBESCTL_TARGET_STATUS.match(line)
+            if match and match.group("status") == "OK":
+                succeeded.add(match.group("vm"))
+            match = QUBESCTL_TARGET_OUTPUT.match(line)
+            if match and match.group("vm") in vms:
+                target = match.group("vm")
+            if CLEAN_DATA_ERROR in line:
+                if target is not None:
+                    unclean.add(target)
+                else:
+                    unattributed_unclean = True
+    process.wait()
+
+    succeeded &= set(vms)
+    if unattributed_unclean:
+        unclean = set(vms) - succeeded
+    return succeeded, unclean - succeeded
+
+
+def apply_incremental():
+    """
+    Applies the highstate only to targets of the top file whose Salt states
+    have changed since they were last applied successfully, in the same order
+    as provision_all(). VMs that are created by the dom0 highstate are always
+    provisioned.
+    """
+    fingerprints = get_state_fingerprints(get_top_targets())
+    applied = read_applied_fingerprints()
+    changed = set(target for target in fingerprints if applied.get(target) != fingerprints[target])
+
+    if not changed:
+        print("Salt states have not changed since they were last applied")
+        return
+
+    def record_applied(targets):
+        applied.update((target, fingerprints[target]) for target in targets)
+        write_applied_fingerprints(applied)
+
+    existing_vms = list_vms()
+    try:
+        if "dom0" in changed:
+            # Configuring system VMs also applies the states of sys-firewall
+            configure_sys_vms()
+            apply_dom0_highstate()
+            record_applied(changed.intersection(["dom0", SYS_FIREWALL]))
+            changed.difference_update(["dom0", SYS_FIREWALL])
+
+            # Newly created VMs need all of their states
+            created_vms = list_vms() - existing_vms
+            changed.update(target for target in fingerprints if target in created_vms)
+            existing_vms.update(created_vms)
+        elif SYS_FIREWALL in changed:
+            apply_sys_firewall_files()
+            record_applied([SYS_FIREWALL])
+            changed.discard(SYS_FIREWALL)
+
+        vms = changed & existing_vms
+        if vms:
+            print("Applying highstate to {}".format(", ".join(sorted(vms))))
+            provision_vms(vms, on_applied=record_applied)
+    except subprocess.CalledProcessError:
+        raise SDWAdminException("Error during provisioning")
+
+
+def record_applied_states():
+    """
+    Records all Salt states as applied, after a full provisioning, so that
+    subsequent incremental applies only apply states that have changed.
+    """
+    try:
+        write_applied_fingerprints(get_state_fingerprints(get_top_targets()))
+    except OSError as e:
+        print("Could not record applied Salt states: {}".format(e))
 
 
 def validate_config(path):
     """
     Calls the validate_config script to validate the config present in the staging/prod directory
     """
+    # Imported here since the validator requires the Qubes Admin API
+    from validate_config import SDWConfigValidator, ValidationError
+
     try:
         validator = SDWConfigValidator(path)  # noqa: F841
     except ValidationError:
@@ -94,10 +575,20 @@ def validate_config(path):
 def refresh_salt():
     """
     Cleans the Salt cache and synchronizes Salt to ensure we are applying states
-    from the currently installed version
+    from the currently installed version. This is skipped if no files in the
+    Salt tree have changed since Salt was last synchronized, and the cache
+    still exists.
     """
+    salt_hash = _hash_paths([SALT_ROOT])
+    if _read_json(SALT_SYNC_FILE).get("hash") == salt_hash and os.path.isdir(SALT_CACHE_PATH):
+        print("Salt files have not changed since Salt was last synchronized")
+        return
+
+    # Forget the previous hash first, so that an interrupted refresh is retried
+    _write_json(SALT_SYNC_FILE, {})
+
     try:
-        subprocess.check_call(["sudo", "rm", "-rf", "/var/cache/salt"])
+        subprocess.check_call(["sudo", "rm", "-rf", SALT_CACHE_PATH])
     except subprocess.CalledProcessError:
         raise SDWAdminException("Error while clearing Salt cache")
 
@@ -106,6 +597,8 @@ def refresh_salt():
     except subprocess.CalledProcessError:
         raise SDWAdminException("Error while synchronizing Salt")
 
+    _write_json(SALT_SYNC_FILE, {"hash": salt_hash})
+
 
 def perform_uninstall(keep_template_rpm=False):
 
@@ -162,7 +655,11 @@ def main():
         validate_config(SCRIPTS_PATH)
         copy_config()
         refresh_salt()
-        provision_all()
+        if args.incremental:
+            apply_incremental()
+        else:
+            provision_all()
+            record_applied_states()
     elif args.uninstall:
         print(
             "Uninstalling will remove all packages and destroy all VMs associated\n"